@@ -4,9 +4,39 @@ import json
 from datetime import datetime
 import os
 import sys # For platform check in open_selected_pdf
+import argparse
+import csv
+import time
+import threading
+import queue
+import hashlib
+import zlib
+import shutil
+import platform
+import statistics
+import tempfile
+import atexit
+import sqlite3
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import MutableMapping
+from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+try: import resource # Unix only; used for peak RSS in benchmarks
+except ImportError: resource = None
+try: import fcntl # Advisory file locks on Unix
+except ImportError: fcntl = None
+try: import msvcrt # ...and on Windows
+except ImportError: msvcrt = None
+try: import numpy as np # Optional; vectorizes document pricing
+except ImportError: np = None
+from reportlab import Version as REPORTLAB_VERSION
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer #, Image (Import Image if you use it)
+from reportlab.platypus import SimpleDocTemplate, Table, LongTable, TableStyle, Paragraph, Spacer, Flowable, PageBreak #, Image (Import Image if you use it)
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
 
@@ -16,6 +46,28 @@ BUSINESS_DETAILS_FILE = 'business_details.json'
 CLIENTS_PROSPECTS_FILE = 'clients_prospects.json'
 ITEMS_FILE = 'items.json'
 HISTORY_DATA_FILE = 'data.json' # For storing invoice/quote history metadata
+PDF_CACHE_DIR = 'pdf_cache' # Content-addressed copies of rendered PDFs (opt-in)
+SEQUENCES_FILE = 'sequences.json' # Last issued invoice/quote numbers
+DOCUMENTS_DIR = 'documents' # Contents of each issued document, one JSON file per number; history keeps only a summary
+HISTORY_JOURNAL_FILE = 'data.jsonl' # New history records, one JSON line each, folded into data.json by compaction
+HISTORY_GENERATION_FILE = 'data.generation' # Counts rewrites of the history (not appends), so indexes over it know to rebuild
+HISTORY_COMPACT_RECORDS = 1000 # Journal length that triggers a background compaction
+STORE_POLL_MS = 2000 # How often the GUI checks for changes saved by other instances
+HISTORY_PAGE_SIZE = 100 # History records read at a time as the History tab is scrolled
+HISTORY_INDEX_CHUNK = 5000 # History records indexed per event-loop turn when the History filters are first used
+ITEM_CATALOG_FILE = 'items.bin' # Binary copy of items.json, memory-mapped at startup when item_catalog_binary is on; written as items.<n>.bin
+BACKUP_REPO_DIR = 'backups' # Deduplicated backup repository: chunks/ and snapshots/
+SQLITE_DB_FILE = 'megabooks.db' # Used instead of the JSON stores when storage_backend is 'sqlite'
+DOCUMENT_NUMBER_PREFIXES = {'invoice': 'INV', 'quote': 'QUO'}
+CHECK_RUNNING_TOTALS = os.environ.get('MEGABOOKS_CHECK_TOTALS') == '1' # Debug: verify the editor's running totals on every read
+
+DEFAULT_APP_SETTINGS = {
+    'selected_country': 'Australia', 'tax_name': 'GST', 'tax_rate': 10.0,
+    'apply_tax_default': True, 'theme': 'Light', 'font_size': '12',
+    'pdf_cache_enabled': False, 'pdf_cache_max_mb': 200, 'storage_backend': 'json',
+    'save_delay_ms': 500, 'item_catalog_binary': False, 'tax_rounding': 'document'
+}
+TAX_ROUNDING_MODES = ('document', 'line') # Round tax once on the document's taxed subtotal, or per line and add up
 
 DEFAULT_COUNTRY_DATA = {
     "Australia": {"tax_name": "GST", "tax_rate": 10.0, "currency_symbol": "$", "tax_id_label": "ABN"},
@@ -94,14 +146,2001 @@ LIGHT_THEME = {
     "warning_color": "#b58900"  # Warning message color
 }
 
+_theme_specs = {} # (theme name, font size) -> compiled style spec
+
+def get_theme_spec(theme_name, font_size):
+    """Return the cached style spec for this theme and font size, compiling it on first use. A spec
+    maps (what, name) to options: ('configure' | 'map', ttk style), ('window', None) for the root
+    window and ('heading', None) for the tabs' main heading labels. Every spec has the same keys."""
+    key = (theme_name, font_size)
+    spec = _theme_specs.get(key)
+    if spec is None:
+        c = DARK_THEME if theme_name == 'Dark' else LIGHT_THEME
+        tree_row_font_size = font_size - 1 if font_size > 10 else font_size
+        spec = _theme_specs[key] = {
+            ('window', None): {'bg': c["bg"]},
+            ('configure', '.'): {'font': ('Helvetica', font_size)}, # Default font for all ttk widgets
+            ('configure', 'TFrame'): {'background': c["bg"]},
+            ('configure', 'TLabel'): {'background': c["bg"], 'foreground': c["fg"]},
+            ('configure', 'TButton'): {'padding': 6, 'background': c["button_bg"], 'foreground': c["button_fg"], 'bordercolor': c["button_bg"]},
+            ('map', 'TButton'): {'background': [('active', c["button_active_bg"]), ('pressed', c["button_active_bg"])],
+                                 'foreground': [('active', c["button_fg"]), ('pressed', c["button_fg"])]},
+            ('configure', 'TEntry'): {'fieldbackground': c["entry_bg"], 'foreground': c["entry_fg"], 'insertcolor': c["entry_fg"]},
+            ('map', 'TCombobox'): {'fieldbackground': [('readonly', c["entry_bg"])], 'foreground': [('readonly', c["entry_fg"])],
+                                   'selectbackground': [('readonly', c["entry_bg"])], 'selectforeground': [('readonly', c["entry_fg"])],
+                                   'background': [('readonly', c["entry_bg"])]},
+            ('configure', 'TCombobox'): {'lightcolor': [('readonly', c["entry_bg"])], 'darkcolor': [('readonly', c["entry_bg"])]},
+            ('configure', 'Treeview'): {'background': c["tree_bg"], 'foreground': c["tree_fg"], 'fieldbackground': c["tree_bg"],
+                                        'font': ('Helvetica', tree_row_font_size), 'rowheight': int(font_size * 1.8)},
+            ('configure', 'Treeview.Heading'): {'background': c["button_bg"], 'foreground': c["button_fg"],
+                                                'font': ('Helvetica', font_size, 'bold'), 'relief': 'flat', 'padding': (3,3)},
+            ('map', 'Treeview.Heading'): {'relief': [('active','groove'),('pressed','sunken')]},
+            ('map', 'Treeview'): {'background': [('selected', c["tree_selected_bg"])], 'foreground': [('selected', c["tree_selected_fg"])]},
+            ('configure', 'TNotebook'): {'background': c["bg"]},
+            ('configure', 'TNotebook.Tab'): {'background': c["tab_bg"], 'foreground': c["tab_fg"],
+                                             'padding': [font_size, font_size//2], 'font': ('Helvetica', font_size)},
+            ('map', 'TNotebook.Tab'): {'background': [('selected', c["tab_selected_bg"])], 'foreground': [('selected', c["tab_selected_fg"])],
+                                       'font': [('selected', ('Helvetica', font_size, 'bold'))]}, # Bold active tab
+            ('configure', 'TCheckbutton'): {'background': c["bg"], 'foreground': c["fg"],
+                                            'indicatorforeground': c["fg"], 'indicatorbackground': c["entry_bg"]},
+            ('map', 'TCheckbutton'): {'background': [('active', c["bg"])]},
+            ('configure', 'TLabelframe'): {'background': c["bg"], 'bordercolor': c.get("labelframe_fg", c["fg"])},
+            ('configure', 'TLabelframe.Label'): {'background': c["bg"], 'foreground': c["labelframe_fg"], 'font': ('Helvetica', font_size, 'bold')},
+            ('heading', None): {'font': ('Arial', font_size + 4, 'bold'), 'foreground': c["heading_fg"]},
+        }
+    return spec
+
+def theme_spec_changes(applied, spec):
+    """(what, name, options) for each entry of spec with options that differ from the applied spec
+    (all of them if nothing has been applied yet), with only those options."""
+    changes = []
+    for (what, name), options in spec.items():
+        before = applied[(what, name)] if applied else {}
+        changed = {option: value for option, value in options.items() if option not in before or before[option] != value}
+        if changed: changes.append((what, name, changed))
+    return changes
+
+# --- Storage ---
+def write_json_atomic(path, data):
+    """Write data to a temp file beside path, fsync it and swap it in, so readers see the old or new file, never half of one.
+    Returns the SHA-256 of the bytes written."""
+    raw = json.dumps(data, indent=4).encode('utf-8')
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(raw); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    return hashlib.sha256(raw).hexdigest()
+
+def file_stamp(path):
+    """(mtime, size, inode) of path, or None if it doesn't exist; a cheap first check for changes."""
+    try: st = os.stat(path)
+    except FileNotFoundError: return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+# --- Merging changes from other processes ---
+# Items and contacts are compared as {id: (kind, record)}, kind being 'item', 'client' or 'prospect'.
+# A 'base' holds a fingerprint per id of the store as this process last saw it on disk, which is
+# enough to tell, for each record, which side changed it since.
+def record_fingerprint(kind, record):
+    return hash((kind, tuple(sorted(record.items()))))
+
+def keyed_records(lists):
+    """{id: (kind, record)} from {kind: [records]}."""
+    return {record['id']: (kind, record) for kind, records in lists.items() for record in records}
+
+def fingerprint_records(records):
+    return {record_id: record_fingerprint(kind, record) for record_id, (kind, record) in records.items()}
+
+def merge_for_write(base, ours, theirs):
+    """Three-way merge of what this process is about to save (ours) with what another process saved
+    since base (theirs). A record changed on one side only takes that side's version; a record both
+    sides changed keeps ours. Returns {id: (kind, record)}, ours in order followed by their additions."""
+    merged = {}
+    for record_id, (kind, record) in ours.items():
+        if base.get(record_id) != record_fingerprint(kind, record): merged[record_id] = (kind, record) # Ours changed, or new
+        elif record_id in theirs: merged[record_id] = theirs[record_id]
+        # else: unchanged here and deleted there
+    for record_id, entry in theirs.items():
+        if record_id not in ours and record_id not in base: merged[record_id] = entry # Added there; not deleted here
+    return merged
+
+def merge_external_changes(lists, base, theirs):
+    """Apply another process's changes (base -> theirs) to the in-memory {kind: [records]} lists in place.
+    Records edited or deleted locally since base are left as they are; they win when next saved.
+    Returns (added, updated, removed) ids."""
+    mine = keyed_records(lists)
+    added, updated, removed = [], [], []
+    for record_id, (kind, record) in theirs.items():
+        base_fp = base.get(record_id)
+        if base_fp == record_fingerprint(kind, record): continue # They didn't change it
+        if record_id not in mine:
+            if base_fp is None: lists[kind].append(dict(record)); added.append(record_id)
+            continue # Otherwise deleted here; stays deleted
+        my_kind, my_record = mine[record_id]
+        if base_fp is None or record_fingerprint(my_kind, my_record) != base_fp: continue # Changed here too; ours wins
+        if isinstance(lists[my_kind], list):
+            my_record.update(record)
+            if my_kind != kind:
+                del lists[my_kind][next(i for i, r in enumerate(lists[my_kind]) if r is my_record)]; lists[kind].append(my_record)
+        else: # An indexed store (ItemCatalog, ContactView) keeps its indexes current; appending a known id re-homes it
+            lists[my_kind].update(record_id, record)
+            if my_kind != kind: lists[kind].append(my_record)
+        updated.append(record_id)
+    removed = [record_id for record_id, base_fp in base.items()
+               if record_id not in theirs and record_id in mine and record_fingerprint(*mine[record_id]) == base_fp]
+    gone = set(removed)
+    for kind in lists:
+        if not gone: break
+        if isinstance(lists[kind], list): lists[kind][:] = [record for record in lists[kind] if record['id'] not in gone]
+        else: lists[kind].remove_ids(gone)
+    return added, updated, removed
+
+class WriteBehindWriter:
+    """Coalesces saves of the JSON stores. mark_dirty() only records that a file needs writing; a
+    background thread writes it (atomically) once 'delay' seconds have passed since it was first
+    marked, so a burst of edits costs one write. snapshot is called at write time, on the writer
+    thread, and it or write must copy what is saved: an edit racing a write marks the file dirty
+    again, so the next write picks it up. With delay <= 0 every save is written immediately."""
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.io_lock = threading.Lock() # Held while writing, so flush() also waits for a write in progress
+        self.pending = {} # path -> (snapshot, time first marked)
+        self.requested = self.written = 0
+        self.closed = False
+        self.thread = None
+
+    def mark_dirty(self, path, snapshot, write=None):
+        """write(path, data) stores the snapshot; write_json_atomic by default."""
+        write = write or write_json_atomic
+        with self.lock:
+            self.requested += 1
+            if self.delay > 0 and not self.closed:
+                self.pending[path] = (snapshot, write, self.pending[path][2] if path in self.pending else time.monotonic())
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run, daemon=True); self.thread.start()
+                self.wake.notify()
+                return
+        with self.io_lock: self._write(path, snapshot, write)
+
+    def _take(self, due_only):
+        with self.lock:
+            now = time.monotonic()
+            paths = [p for p, (_, _, marked) in self.pending.items() if not due_only or marked + self.delay <= now]
+            return [(p,) + self.pending.pop(p)[:2] for p in paths]
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed: self.wake.wait()
+                if self.closed: return
+                wait = min(marked for _, _, marked in self.pending.values()) + self.delay - time.monotonic()
+                if wait > 0: self.wake.wait(wait); continue
+            with self.io_lock:
+                for path, snapshot, write in self._take(due_only=True): self._write(path, snapshot, write)
+
+    def _write(self, path, snapshot, write):
+        try:
+            write(path, snapshot())
+            with self.lock: self.written += 1
+        except Exception as e: print(f"Error saving {path}: {e}") # Anything escaping would end the writer thread, stranding later saves
+
+    def flush(self):
+        """Write everything pending now, on the calling thread."""
+        with self.io_lock:
+            for path, snapshot, write in self._take(due_only=False): self._write(path, snapshot, write)
+
+    def close(self):
+        self.flush()
+        with self.lock: self.closed = True; self.wake.notify()
+
+    def stats_text(self):
+        with self.lock: saved = self.requested - self.written - len(self.pending)
+        return f"{self.requested} save(s) requested, {self.written} file write(s), {max(saved, 0)} saved by coalescing"
+
+class ItemCatalogFile:
+    """Read side of items.bin: a header, one fixed-width row per item (id, price and the offset and
+    length of its name and description) and a UTF-8 string table, all read through mmap, so opening
+    the file costs the same however many items it holds."""
+    MAGIC = b'MBITEMS1'
+    HEADER = struct.Struct('<8sIIQ') # magic, item count, item id counter, string table offset
+    ROW = struct.Struct('<16sdIIII') # id, price, name offset/length, description offset/length
+    FIELDS = ('id', 'name', 'description', 'price')
+
+    def __init__(self, path):
+        with open(path, 'rb') as f: self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.counter, self.strings = self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or self.strings != self.HEADER.size + self.count * self.ROW.size or self.strings > len(self.mm):
+            self.mm.close(); raise ValueError(f"{path} is not an item catalog")
+
+    def field(self, index, key):
+        item_id, price, name_off, name_len, desc_off, desc_len = self.ROW.unpack_from(self.mm, self.HEADER.size + index * self.ROW.size)
+        if key == 'id': return item_id.rstrip(b'\0').decode('utf-8')
+        if key == 'price': return price
+        offset, length = (name_off, name_len) if key == 'name' else (desc_off, desc_len)
+        return self.mm[self.strings + offset:self.strings + offset + length].decode('utf-8')
+
+    def items(self):
+        return list(map(CatalogItem, [self] * self.count, range(self.count)))
+
+    @staticmethod
+    def generations(path):
+        """[(generation, file)] of the catalog at path, oldest first. Each write makes a new file,
+        items.<n>.bin, rather than replacing one this or another process may have mapped (which
+        Windows refuses); an items.bin from older versions is generation 0."""
+        root, ext = os.path.splitext(path)
+        directory, prefix = os.path.dirname(root), os.path.basename(root) + '.'
+        found = [(0, path)] if os.path.exists(path) else []
+        for name in os.listdir(directory or '.'):
+            middle = name[len(prefix):len(name) - len(ext)] if name.startswith(prefix) and name.endswith(ext) else ''
+            if middle.isdigit(): found.append((int(middle), os.path.join(directory, name)))
+        return sorted(found)
+
+    @classmethod
+    def latest(cls, path):
+        found = cls.generations(path)
+        return found[-1][1] if found else None
+
+    @classmethod
+    def write(cls, path, data):
+        """data is (items, counter). Written as the next generation of path, so no mapped file is replaced;
+        older generations are then removed, except any still mapped on Windows, which a later write
+        retries. Call with the items file's lock held, so two writers never pick the same generation.
+        Returns the file written."""
+        items, counter = data
+        rows, strings = bytearray(), bytearray()
+        for item in items:
+            item_id, name, desc = item['id'].encode('utf-8'), item['name'].encode('utf-8'), item['description'].encode('utf-8')
+            if len(item_id) > 16: raise ValueError(f"Item id '{item['id']}' is too long for {path}")
+            rows += cls.ROW.pack(item_id, float(item['price']), len(strings), len(name), len(strings) + len(name), len(desc))
+            strings += name + desc
+        older = cls.generations(path)
+        root, ext = os.path.splitext(path)
+        target = f"{root}.{older[-1][0] + 1 if older else 1}{ext}"
+        tmp_file = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(items), counter, cls.HEADER.size + len(rows)))
+            f.write(rows); f.write(strings); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_file, target) # A new name, so nothing is mapped there
+        for _, old_file in older:
+            try: os.remove(old_file) # Mappings of it stay valid on POSIX
+            except OSError: pass
+        return target
+
+class CatalogItem(MutableMapping):
+    """An item backed by a row of an ItemCatalogFile. Behaves like the usual item dict, but a field
+    is only decoded when it is first read; edits are kept in memory on top of the row."""
+    __slots__ = ('catalog', 'index', 'values')
+
+    def __init__(self, catalog, index):
+        self.catalog, self.index, self.values = catalog, index, None # values: decoded or edited fields
+
+    def __getitem__(self, key):
+        if self.values is None: self.values = {}
+        if key not in self.values:
+            if key not in ItemCatalogFile.FIELDS or self.catalog is None: raise KeyError(key)
+            self.values[key] = self.catalog.field(self.index, key)
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        if self.values is None: self.values = {}
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        for field in ItemCatalogFile.FIELDS: self[field] # Decode the rest so a deleted field stays deleted
+        self.catalog = None; del self.values[key]
+
+    def __iter__(self):
+        if self.catalog is None: return iter(self.values)
+        return iter(ItemCatalogFile.FIELDS + tuple(k for k in self.values or () if k not in ItemCatalogFile.FIELDS))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    @property
+    def item_id(self): # Without decoding the rest of the row
+        return self.values['id'] if self.values and 'id' in self.values else self.catalog.field(self.index, 'id')
+
+class ItemRecord(MutableMapping):
+    """A library item. Reads and writes like the item dicts used elsewhere (item['price']), but keeps
+    its four fields in slots instead of a per-item dict."""
+    __slots__ = ItemCatalogFile.FIELDS
+
+    def __init__(self, id, name, description, price):
+        self.id, self.name, self.description, self.price = id, name, description, price
+
+    @classmethod
+    def from_mapping(cls, item):
+        return cls(item['id'], item['name'], item['description'], item['price'])
+
+    @property
+    def item_id(self): return self.id
+
+    def __getitem__(self, key):
+        if key not in ItemCatalogFile.FIELDS: raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in ItemCatalogFile.FIELDS: raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("Item fields can't be deleted")
+
+    def __iter__(self):
+        return iter(ItemCatalogFile.FIELDS)
+
+    def __len__(self):
+        return len(ItemCatalogFile.FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def normalize_name(name):
+    return ' '.join(name.split()).casefold()
+
+class ChangeFeed:
+    """Ids a store added, updated and removed since the last drain(), for views that patch only the
+    rows that changed. An id added and removed in between is dropped; one removed and added again
+    (moved to the end) is reported as both, removals being applied first."""
+    __slots__ = ('added', 'updated', 'removed')
+
+    def __init__(self):
+        self.added, self.updated, self.removed = {}, {}, {}
+
+    def __bool__(self): return bool(self.added or self.updated or self.removed)
+
+    def add(self, record_id):
+        self.added[record_id] = None; self.updated.pop(record_id, None)
+
+    def update(self, record_id):
+        if record_id not in self.added: self.updated[record_id] = None
+
+    def remove(self, record_id):
+        self.updated.pop(record_id, None)
+        if record_id in self.added: del self.added[record_id]
+        else: self.removed[record_id] = None
+
+    def drain(self):
+        """(added, updated, removed) id lists, in the order they happened; the feed starts over."""
+        changes = (list(self.added), list(self.updated), list(self.removed))
+        self.added, self.updated, self.removed = {}, {}, {}
+        return changes
+
+class ItemCatalog:
+    """The item library: records in insertion order, indexed by id and by (normalized) name, so
+    get, update and delete are O(1). Rows read from items.bin stay lazy CatalogItems; anything else
+    is stored as an ItemRecord. Iterates like the list of item dicts the storage layer saves. Edits
+    are recorded in 'changes' for the item library view, and made under 'lock', which snapshot()
+    also takes, so the writer thread can copy the catalog while the UI edits it."""
+    def __init__(self, items=()):
+        records = (item if isinstance(item, (ItemRecord, CatalogItem)) else ItemRecord.from_mapping(item) for item in items)
+        self.by_id = {record.item_id: record for record in records}
+        self.by_name = None # normalized name -> {id: None}; built on first use, then kept up to date
+        self.changes = ChangeFeed()
+        self.lock = threading.RLock()
+
+    def __len__(self): return len(self.by_id)
+    def __contains__(self, item_id): return item_id in self.by_id
+    def __iter__(self): return iter(list(self.by_id.values())) # A copy: the writer thread iterates while the UI edits
+
+    def get(self, item_id, default=None):
+        return self.by_id.get(item_id, default)
+
+    def snapshot(self):
+        """Plain dict copies of every item, taken under the lock."""
+        with self.lock: return [dict(record) for record in self.by_id.values()]
+
+    def append(self, item):
+        record = item if isinstance(item, (ItemRecord, CatalogItem)) else ItemRecord.from_mapping(item)
+        item_id = record.item_id
+        with self.lock:
+            if item_id in self.by_id: self.delete(item_id)
+            self.by_id[item_id] = record; self.changes.add(item_id)
+            if self.by_name is not None: self.by_name.setdefault(normalize_name(record['name']), {})[item_id] = None
+        return record
+
+    def update(self, item_id, fields):
+        with self.lock:
+            record = self.by_id[item_id]
+            renamed = self.by_name is not None and 'name' in fields and fields['name'] != record['name']
+            if renamed: self._unindex_name(record)
+            record.update(fields)
+            if renamed: self.by_name.setdefault(normalize_name(record['name']), {})[item_id] = None
+            self.changes.update(item_id)
+        return record
+
+    def delete(self, item_id):
+        with self.lock:
+            record = self.by_id.pop(item_id); self.changes.remove(item_id)
+            if self.by_name is not None: self._unindex_name(record)
+        return record
+
+    def remove_ids(self, item_ids):
+        for item_id in item_ids:
+            if item_id in self.by_id: self.delete(item_id)
+
+    def find_by_name(self, name):
+        """Items whose name matches, ignoring case and spacing."""
+        if self.by_name is None:
+            self.by_name = {}
+            for item_id, record in self.by_id.items(): self.by_name.setdefault(normalize_name(record['name']), {})[item_id] = None
+        return [self.by_id[item_id] for item_id in self.by_name.get(normalize_name(name), ())]
+
+    def _unindex_name(self, record):
+        key = normalize_name(record['name']); ids = self.by_name.get(key, {})
+        ids.pop(record.item_id, None)
+        if not ids: self.by_name.pop(key, None)
+
+class ContactDirectory:
+    """Clients and prospects in one store. Each contact is a dict with a stable 'id'; whether it is a
+    client or a prospect is a status kept beside it, so converting a prospect flips that status
+    rather than moving the record. Indexed by id, normalized name and email. The clients and
+    prospects attributes are views of each kind, in the shape the storage layer saves; changes[kind]
+    records the edits to each kind's list, so a conversion is a removal from one and an addition to the other.
+    Edits are made under 'lock', as in ItemCatalog."""
+    KINDS = ('client', 'prospect')
+
+    def __init__(self, clients=(), prospects=()):
+        self.lock = threading.RLock()
+        self.by_id, self.kind = {}, {}
+        self.members = {kind: {} for kind in self.KINDS} # kind -> {id: None}, in display order
+        self.by_name, self.by_email = {}, {} # normalized name / email -> {id: None}
+        self.clients, self.prospects = ContactView(self, 'client'), ContactView(self, 'prospect')
+        self.changes = {kind: ChangeFeed() for kind in self.KINDS}
+        for contact in clients: self.add(contact, 'client')
+        for contact in prospects: self.add(contact, 'prospect')
+        for feed in self.changes.values(): feed.drain() # Views start from the loaded lists
+
+    def __len__(self): return len(self.by_id)
+    def __contains__(self, contact_id): return contact_id in self.by_id
+
+    def get(self, contact_id, default=None):
+        return self.by_id.get(contact_id, default)
+
+    def kind_of(self, contact_id):
+        return self.kind.get(contact_id)
+
+    def of_kind(self, kind):
+        return [c for c in map(self.by_id.get, list(self.members[kind])) if c is not None] # Copied: the writer thread iterates too
+
+    def snapshot(self, kind):
+        """Plain dict copies of one kind's contacts, taken under the lock."""
+        with self.lock: return [dict(self.by_id[contact_id]) for contact_id in self.members[kind]]
+
+    def add(self, contact, kind):
+        """Add a contact, or, if its id is already here, update it and give it this kind."""
+        contact_id = contact['id']
+        with self.lock:
+            if contact_id in self.by_id:
+                if self.by_id[contact_id] is not contact: self.update(contact_id, contact)
+                self.set_kind(contact_id, kind); return self.by_id[contact_id]
+            self.by_id[contact_id], self.kind[contact_id] = contact, kind
+            self.members[kind][contact_id] = None; self.changes[kind].add(contact_id)
+            self._index(contact)
+        return contact
+
+    def update(self, contact_id, fields):
+        with self.lock:
+            contact = self.by_id[contact_id]
+            self._unindex(contact); contact.update(fields); self._index(contact)
+            self.changes[self.kind[contact_id]].update(contact_id)
+        return contact
+
+    def set_kind(self, contact_id, kind):
+        with self.lock:
+            old_kind = self.kind[contact_id]
+            if old_kind != kind:
+                del self.members[old_kind][contact_id]; self.changes[old_kind].remove(contact_id)
+                self.members[kind][contact_id] = None; self.kind[contact_id] = kind; self.changes[kind].add(contact_id)
+        return self.by_id[contact_id]
+
+    def delete(self, contact_id):
+        with self.lock:
+            contact = self.by_id.pop(contact_id)
+            kind = self.kind.pop(contact_id)
+            del self.members[kind][contact_id]; self.changes[kind].remove(contact_id)
+            self._unindex(contact)
+        return contact
+
+    def remove_ids(self, contact_ids):
+        for contact_id in contact_ids:
+            if contact_id in self.by_id: self.delete(contact_id)
+
+    def find_by_name(self, name, kind=None):
+        return self._find(self.by_name, normalize_name(name), kind)
+
+    def find_by_email(self, email, kind=None):
+        email = email.strip().casefold()
+        return self._find(self.by_email, email, kind) if email else []
+
+    def _find(self, index, key, kind):
+        return [self.by_id[i] for i in index.get(key, ()) if kind is None or self.kind[i] == kind]
+
+    def _keys(self, contact):
+        return ((self.by_name, normalize_name(contact.get('name', ''))), (self.by_email, contact.get('email', '').strip().casefold()))
+
+    def _index(self, contact):
+        for index, key in self._keys(contact): index.setdefault(key, {})[contact['id']] = None
+
+    def _unindex(self, contact):
+        for index, key in self._keys(contact):
+            ids = index.get(key, {}); ids.pop(contact['id'], None)
+            if not ids: index.pop(key, None)
+
+class ContactView:
+    """One kind of contact in a ContactDirectory, iterable and appendable like the old per-kind lists."""
+    __slots__ = ('directory', 'kind')
+
+    def __init__(self, directory, kind):
+        self.directory, self.kind = directory, kind
+
+    def __iter__(self): return iter(self.directory.of_kind(self.kind))
+    def __len__(self): return len(self.directory.members[self.kind])
+    def append(self, contact): return self.directory.add(contact, self.kind)
+    def snapshot(self): return self.directory.snapshot(self.kind)
+    def update(self, contact_id, fields): return self.directory.update(contact_id, fields)
+    def remove_ids(self, contact_ids): self.directory.remove_ids(contact_ids)
+
+# Both backends take the full in-memory lists plus optional deltas: 'changed' records and 'deleted' ids.
+# JsonStorage ignores the deltas and rewrites the file; SqliteStorage writes only the affected rows
+# (with no deltas it replaces the whole table). Contacts are passed as (kind, contact) pairs, kind
+# being 'client' or 'prospect'.
+class JsonStorage:
+    """The original storage: one indented JSON file per store, rewritten in full on every save.
+    History is the exception: data.json is a snapshot and new records are appended to the
+    data.jsonl journal, which is folded into the snapshot in the background once it grows long."""
+    name = 'json'
+
+    def __init__(self, writer=None, binary_catalog=False):
+        self.writer = writer # WriteBehindWriter for the item and contact files; None writes them immediately
+        self.binary_catalog = binary_catalog # Also keep items.bin and load items from it while it is current
+        self._journal_records = None # Journal length, counted on the first append; decides when to compact
+        self._compactor = None
+        self._history_index = {} # path -> (file stamp, journal base, record offsets)
+        self._sync_lock = threading.Lock()
+        self._synced = {} # path -> (file stamp, SHA-256, base fingerprints or a callable building them) as last loaded/saved
+
+    @staticmethod
+    def _items_from_json(data):
+        return {item['id']: ('item', item) for item in data.get('items', [])}, data.get('counter', 0)
+
+    @staticmethod
+    def _items_to_json(records, counter):
+        return {'items': [item for _, item in records.values()], 'counter': counter}
+
+    @staticmethod
+    def _contacts_from_json(data):
+        records = {c['id']: ('client', c) for c in data.get('clients', []) if 'id' in c}
+        records.update((p['id'], ('prospect', p)) for p in data.get('prospects', []) if 'id' in p)
+        return records, data.get('counter', 0)
+
+    @staticmethod
+    def _contacts_to_json(records, counter):
+        return {'clients': [c for kind, c in records.values() if kind == 'client'],
+                'prospects': [p for kind, p in records.values() if kind == 'prospect'], 'counter': counter}
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f: raw = f.read()
+        return hashlib.sha256(raw).hexdigest(), json.loads(raw)
+
+    def _load(self, path):
+        """(stamp, digest, data) read under the file's lock, so the three belong together."""
+        with file_lock(path): return (file_stamp(path),) + self._read(path)
+
+    def load_items(self):
+        if not os.path.exists(ITEMS_FILE): self._synced[ITEMS_FILE] = (None, None, {}); return [], 0
+        if self.binary_catalog:
+            # items.json stays the master copy; items.bin is only used if written after it
+            catalog_file = ItemCatalogFile.latest(ITEM_CATALOG_FILE)
+            catalog_stamp = file_stamp(catalog_file) if catalog_file else None # None if another process just replaced it
+            if catalog_stamp and catalog_stamp[0] >= os.stat(ITEMS_FILE).st_mtime_ns:
+                try:
+                    catalog = ItemCatalogFile(catalog_file)
+                    # The catalog's fingerprints are only worked out if another process changes items.json
+                    self._synced[ITEMS_FILE] = (file_stamp(ITEMS_FILE), None, lambda: fingerprint_records(keyed_records({'item': catalog.items()})))
+                    return catalog.items(), catalog.counter
+                except (OSError, ValueError, struct.error) as e: print(f"Error reading {catalog_file}: {e}")
+        stamp, digest, data = self._load(ITEMS_FILE)
+        records, counter = self._items_from_json(data)
+        self._synced[ITEMS_FILE] = (stamp, digest, fingerprint_records(records))
+        items = [item for _, item in records.values()]
+        if self.binary_catalog:
+            with file_lock(ITEMS_FILE): ItemCatalogFile.write(ITEM_CATALOG_FILE, (items, counter))
+        return items, counter
+
+    def save_items(self, items, counter, changed=None, deleted=None):
+        snapshot = self._snapshot(items)
+        self._save(ITEMS_FILE, lambda: ({'item': snapshot()}, counter), write=self._write_items)
+
+    def _write_items(self, path, data):
+        def _write_catalog(records, counter): # Under the same lock, so items.bin never outdates a newer items.json
+            if self.binary_catalog: ItemCatalogFile.write(ITEM_CATALOG_FILE, ([item for _, item in records.values()], counter))
+        self._write_merged(path, data, self._items_from_json, self._items_to_json, _write_catalog)
+
+    def load_contacts(self):
+        if not os.path.exists(CLIENTS_PROSPECTS_FILE): self._synced[CLIENTS_PROSPECTS_FILE] = (None, None, {}); return [], [], 0
+        stamp, digest, data = self._load(CLIENTS_PROSPECTS_FILE)
+        self._synced[CLIENTS_PROSPECTS_FILE] = (stamp, digest, fingerprint_records(self._contacts_from_json(data)[0]))
+        return data.get('clients', []), data.get('prospects', []), data.get('counter', 0)
+
+    def save_contacts(self, clients, prospects, counter, changed=None, deleted=None):
+        clients, prospects = self._snapshot(clients), self._snapshot(prospects)
+        self._save(CLIENTS_PROSPECTS_FILE, lambda: ({'client': clients(), 'prospect': prospects()}, counter), write=self._write_contacts)
+
+    def _write_contacts(self, path, data):
+        self._write_merged(path, data, self._contacts_from_json, self._contacts_to_json)
+
+    def _write_merged(self, path, data, from_json, to_json, after_write=None):
+        """Save a store under its file lock. If another process saved it since we last synced, merge
+        their changes in rather than overwriting them."""
+        lists, counter = data
+        with self._sync_lock, file_lock(path):
+            ours = {record_id: (kind, dict(record)) for record_id, (kind, record) in keyed_records(lists).items()}
+            stamp, digest, base = self._synced.get(path, (None, None, {}))
+            merged_theirs = False
+            current = file_stamp(path)
+            if current is not None and current != stamp:
+                their_digest, their_data = self._read(path)
+                if their_digest != digest:
+                    theirs, their_counter = from_json(their_data)
+                    merged = merge_for_write(base() if callable(base) else base, ours, theirs)
+                    merged_theirs, ours, counter = merged != ours, merged, max(counter, their_counter)
+            digest = write_json_atomic(path, to_json(ours, counter))
+            if after_write is not None: after_write(ours, counter)
+            # After merging their changes keep the old sync point, so refresh_*() still brings them into memory
+            if not merged_theirs: self._synced[path] = (file_stamp(path), digest, fingerprint_records(ours))
+
+    def refresh_items(self, items):
+        """Merge changes another process saved to items.json into items, in place.
+        Returns (added, updated, removed ids, their counter), or None if nothing changed."""
+        return self._refresh(ITEMS_FILE, {'item': items}, self._items_from_json)
+
+    def refresh_contacts(self, clients, prospects):
+        return self._refresh(CLIENTS_PROSPECTS_FILE, {'client': clients, 'prospect': prospects}, self._contacts_from_json)
+
+    def _refresh(self, path, lists, from_json):
+        with self._sync_lock:
+            stamp, digest, base = self._synced.get(path, (None, None, {}))
+            if file_stamp(path) in (None, stamp): return None
+            current, their_digest, data = self._load(path)
+            if their_digest == digest: self._synced[path] = (current, digest, base); return None # Touched, not changed
+            theirs, their_counter = from_json(data)
+            changes = merge_external_changes(lists, base() if callable(base) else base, theirs)
+            self._synced[path] = (current, their_digest, fingerprint_records(theirs))
+            return changes + (their_counter,)
+
+    def history_token(self):
+        """Changes whenever another process (or this one) adds to the history."""
+        return tuple(file_stamp(path) for path in (HISTORY_DATA_FILE, HISTORY_JOURNAL_FILE + '.compacting', HISTORY_JOURNAL_FILE))
+
+    @staticmethod
+    def _snapshot(records):
+        """Callable copying records when the save is written. An indexed store (ItemCatalog, ContactView)
+        is copied then, under its lock, so a burst of edits costs one copy, made off the Tk thread;
+        a plain list is copied now."""
+        if hasattr(records, 'snapshot'): return records.snapshot
+        records = [dict(r) for r in records]
+        return lambda: records
+
+    def _save(self, path, snapshot, write=write_json_atomic):
+        if self.writer is not None: self.writer.mark_dirty(path, snapshot, write)
+        else: write(path, snapshot())
+
+    def _open_history(self):
+        """Open and index the snapshot, any journal left mid-compaction and the live journal.
+        Returns [(file, record offsets)], oldest first. Call with the history lock held so the three agree."""
+        self._upgrade_snapshot()
+        segments, total = [], 0
+        for path in (HISTORY_DATA_FILE, HISTORY_JOURNAL_FILE + '.compacting', HISTORY_JOURNAL_FILE):
+            try: f = open(path, 'rb')
+            except FileNotFoundError: continue
+            base, offsets = self._index_file(path, f)
+            # A compaction interrupted after replacing the snapshot leaves records that are already in it
+            if base is not None: offsets = offsets[max(0, total - base):]
+            segments.append((f, offsets)); total += len(offsets)
+        return segments
+
+    def _index_file(self, path, f):
+        """(journal base, record line offsets) of one history file, cached until the file changes."""
+        st = os.fstat(f.fileno())
+        stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._history_index.get(path)
+        if cached and cached[0] == stamp: return cached[1], cached[2]
+        base, offsets, offset, journal = None, array('q'), 0, path != HISTORY_DATA_FILE
+        f.seek(0)
+        for line in f:
+            line_start, offset = offset, offset + len(line)
+            if not line.startswith(b'{') or not line.endswith(b'\n'): continue # Brackets, or a torn final line
+            if journal:
+                if base is None and not offsets and line.startswith(b'{"_journal_base"'):
+                    base = json.loads(line)['_journal_base']; continue
+                try: json.loads(line)
+                except ValueError: continue # Torn line from a crash mid-append
+            offsets.append(line_start)
+        self._history_index[path] = (stamp, base, offsets)
+        return base, offsets
+
+    @staticmethod
+    def _read_line(f, offset):
+        f.seek(offset)
+        return f.readline().rstrip(b',\r\n')
+
+    def _iter_raw(self, segments):
+        for f, offsets in segments:
+            for offset in offsets: yield self._read_line(f, offset)
+
+    @staticmethod
+    def _close_segments(segments):
+        for f, _ in segments: f.close()
+
+    def _write_snapshot(self, raw_records):
+        """Atomically write data.json as a JSON array with one record per line, so pages can be read by offset."""
+        tmp_file = f"{HISTORY_DATA_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(b'[')
+            for n, raw in enumerate(raw_records): f.write((b',\n' if n else b'\n') + raw)
+            f.write(b'\n]\n'); f.flush(); os.fsync(f.fileno())
+        os.replace(tmp_file, HISTORY_DATA_FILE)
+
+    def _upgrade_snapshot(self):
+        """Rewrite an indented data.json from older versions in the one-record-per-line form."""
+        if not os.path.exists(HISTORY_DATA_FILE): return
+        with open(HISTORY_DATA_FILE, 'rb') as f: first, second = f.readline(), f.readline()
+        if first.rstrip(b'\r\n') == b'[' and second[:1] in (b'{', b']'): return
+        with open(HISTORY_DATA_FILE, 'r') as f: records = json.load(f)
+        self._write_snapshot(json.dumps(record).encode('utf-8') for record in records)
+
+    def _start_journal(self, base):
+        with open(HISTORY_JOURNAL_FILE, 'w') as f:
+            f.write(json.dumps({'_journal_base': base}) + '\n'); f.flush(); os.fsync(f.fileno())
+
+    def history_count(self):
+        with file_lock(HISTORY_DATA_FILE): segments = self._open_history()
+        self._close_segments(segments)
+        return sum(len(offsets) for _, offsets in segments)
+
+    def history_page(self, start, count):
+        """Up to count records, newest first, after skipping the start newest. Only those records are parsed."""
+        with file_lock(HISTORY_DATA_FILE): segments = self._open_history()
+        try:
+            total = sum(len(offsets) for _, offsets in segments)
+            return self._read_records(segments, range(total - 1 - start, max(total - start - count, 0) - 1, -1))
+        finally: self._close_segments(segments)
+
+    def history_records(self, keys):
+        """The records with these scan_history() keys, in the order given. For this backend a key is
+        the record's position, oldest first."""
+        with file_lock(HISTORY_DATA_FILE): segments = self._open_history()
+        try: return self._read_records(segments, keys)
+        finally: self._close_segments(segments)
+
+    def scan_history(self, after=-1, count=HISTORY_PAGE_SIZE):
+        """Up to count (key, record) pairs, oldest first, for the records after key 'after'."""
+        with file_lock(HISTORY_DATA_FILE): segments = self._open_history()
+        try:
+            total = sum(len(offsets) for _, offsets in segments)
+            positions = range(after + 1, min(after + 1 + count, total))
+            return list(zip(positions, self._read_records(segments, positions)))
+        finally: self._close_segments(segments)
+
+    def _read_records(self, segments, positions):
+        bounds, first = [], 0 # (first position, file, offsets) per segment, oldest first
+        for f, offsets in segments: bounds.append((first, f, offsets)); first += len(offsets)
+        records = []
+        for position in positions:
+            seg_first, f, offsets = next(b for b in reversed(bounds) if b[0] <= position)
+            records.append(json.loads(self._read_line(f, offsets[position - seg_first])))
+        return records
+
+    def iter_history(self):
+        """Every record, oldest first, parsed one at a time."""
+        with file_lock(HISTORY_DATA_FILE): segments = self._open_history()
+        try:
+            for raw in self._iter_raw(segments): yield json.loads(raw)
+        finally: self._close_segments(segments)
+
+    def load_history(self):
+        return list(self.iter_history())
+
+    def append_history(self, entries):
+        """Append entries to the journal with one fsync'd write; the cost does not depend on the history size."""
+        with file_lock(HISTORY_DATA_FILE):
+            if not os.path.exists(HISTORY_JOURNAL_FILE):
+                segments = self._open_history(); self._close_segments(segments)
+                self._start_journal(sum(len(offsets) for _, offsets in segments))
+            if self._journal_records is None: # First append this session: count what earlier sessions left
+                with open(HISTORY_JOURNAL_FILE, 'rb') as f: self._journal_records = len(self._index_file(HISTORY_JOURNAL_FILE, f)[1])
+            with open(HISTORY_JOURNAL_FILE, 'a+b') as f:
+                lines = ''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8')
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n': lines = b'\n' + lines # Don't glue onto a torn line
+                f.write(lines); f.flush(); os.fsync(f.fileno())
+        self._journal_records += len(entries)
+        if self._journal_records >= HISTORY_COMPACT_RECORDS: self.compact_history()
+
+    def save_documents(self, documents):
+        """Store the contents ({number: data}) of issued documents, which history records refer to by number."""
+        os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+        for number, data in documents.items(): write_json_atomic(os.path.join(DOCUMENTS_DIR, f"{number}.json"), data)
+
+    def document_data(self, number):
+        """Contents saved by save_documents, or None."""
+        try:
+            with open(os.path.join(DOCUMENTS_DIR, f"{number}.json"), 'r') as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def save_history(self, records):
+        with file_lock(HISTORY_DATA_FILE):
+            generation = self.history_generation() + 1
+            self._write_snapshot(json.dumps(record).encode('utf-8') for record in records)
+            for path in (HISTORY_JOURNAL_FILE + '.compacting', HISTORY_JOURNAL_FILE):
+                if os.path.exists(path): os.remove(path)
+            write_json_atomic(HISTORY_GENERATION_FILE, generation)
+        self._journal_records = 0
+
+    def history_generation(self):
+        """Changes when the history is rewritten (save_history), but not when it is appended to or compacted."""
+        try:
+            with open(HISTORY_GENERATION_FILE, 'r') as f: return int(json.load(f))
+        except (OSError, ValueError, TypeError): return 0
+
+    def compact_history(self, wait=False):
+        """Fold the journal into the data.json snapshot on a background thread. Appends carry on into a fresh journal."""
+        if self._compactor is not None and self._compactor.is_alive():
+            if wait: self._compactor.join()
+            return
+        self._journal_records = 0
+        self._compactor = threading.Thread(target=self._compact, daemon=True)
+        self._compactor.start()
+        if wait: self._compactor.join()
+
+    def _compact(self):
+        pending = HISTORY_JOURNAL_FILE + '.compacting'
+        try:
+            with file_lock(HISTORY_DATA_FILE):
+                if not os.path.exists(pending): # Otherwise finish the one an earlier run left behind
+                    if not os.path.exists(HISTORY_JOURNAL_FILE): return
+                    os.replace(HISTORY_JOURNAL_FILE, pending)
+                segments = self._open_history()
+                if not os.path.exists(HISTORY_JOURNAL_FILE): self._start_journal(sum(len(offsets) for _, offsets in segments))
+                pending_stat = os.stat(pending)
+            try: self._write_snapshot(self._iter_raw(segments)) # The slow part, outside the lock; records are copied, not parsed
+            finally: self._close_segments(segments)
+            with file_lock(HISTORY_DATA_FILE):
+                current = os.stat(pending) if os.path.exists(pending) else None
+                if current and (current.st_ino, current.st_size) == (pending_stat.st_ino, pending_stat.st_size): os.remove(pending)
+        except (OSError, ValueError) as e: print(f"Error compacting history: {e}")
+
+    def close(self):
+        if self.writer is not None: self.writer.flush()
+        if self._compactor is not None: self._compactor.join()
+
+class SqliteStorage:
+    """Row-level storage in one SQLite database (WAL mode), so a single edit costs one row write
+    however large the stores grow."""
+    name = 'sqlite'
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, name TEXT, description TEXT, price REAL, seq INTEGER);
+        CREATE INDEX IF NOT EXISTS items_seq ON items (seq);
+        CREATE TABLE IF NOT EXISTS contacts (id TEXT PRIMARY KEY, kind TEXT, name TEXT, email TEXT, address TEXT, phone TEXT, seq INTEGER);
+        CREATE INDEX IF NOT EXISTS contacts_kind_seq ON contacts (kind, seq);
+        CREATE INDEX IF NOT EXISTS contacts_name ON contacts (name);
+        CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY AUTOINCREMENT, date TEXT, type TEXT, client TEXT, number TEXT, record TEXT);
+        CREATE INDEX IF NOT EXISTS history_date ON history (date);
+        CREATE INDEX IF NOT EXISTS history_client ON history (client);
+        CREATE TABLE IF NOT EXISTS documents (number TEXT PRIMARY KEY, data TEXT);
+    """
+
+    def __init__(self, path=SQLITE_DB_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL") # Durable at checkpoints; WAL keeps the file consistent
+        self.conn.executescript(self.SCHEMA)
+        self._synced = {} # store -> (version, base fingerprints) as last loaded/saved by this connection
+
+    def _get_meta(self, key, default=0):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else default
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _bump_version(self, store):
+        """Count a change to store (inside the write's transaction); returns the version before it."""
+        version = self._get_meta(store + '_version')
+        self._set_meta(store + '_version', version + 1)
+        return version
+
+    def _read_store(self, store, read):
+        """(version, read()) from one consistent read snapshot."""
+        self.conn.execute("BEGIN")
+        try: return self._get_meta(store + '_version'), read()
+        finally: self.conn.execute("COMMIT")
+
+    def _saved(self, store, version_before, records, deleted, replace):
+        """Move the sync point past our own write, unless another process wrote since the last sync
+        (then refresh_*() has to merge their change first)."""
+        synced_version, base = self._synced.get(store, (None, {}))
+        if synced_version != version_before: return
+        base = {} if replace else dict(base)
+        base.update(fingerprint_records(records))
+        for record_id in deleted or (): base.pop(record_id, None)
+        self._synced[store] = (version_before + 1, base)
+
+    def _next_seq(self, table):
+        return self.conn.execute(f"SELECT COALESCE(MAX(seq), 0) + 1 FROM {table}").fetchone()[0]
+
+    def _select_items(self):
+        rows = self.conn.execute("SELECT id, name, description, price FROM items ORDER BY seq").fetchall()
+        return [{'id': r[0], 'name': r[1], 'description': r[2], 'price': r[3]} for r in rows], self._get_meta('item_counter')
+
+    def load_items(self):
+        version, (items, counter) = self._read_store('items', self._select_items)
+        self._synced['items'] = (version, fingerprint_records(keyed_records({'item': items})))
+        return items, counter
+
+    def refresh_items(self, items):
+        """Merge rows another process changed into items, in place. Same contract as JsonStorage.refresh_items."""
+        if self._get_meta('items_version') == self._synced.get('items', (None,))[0]: return None
+        version, (theirs, counter) = self._read_store('items', self._select_items)
+        theirs = keyed_records({'item': theirs})
+        changes = merge_external_changes({'item': items}, self._synced.get('items', (None, {}))[1], theirs)
+        self._synced['items'] = (version, fingerprint_records(theirs))
+        return changes + (counter,)
+
+    def save_items(self, items, counter, changed=None, deleted=None):
+        with self.conn:
+            version = self._bump_version('items')
+            if changed is None and deleted is None:
+                self.conn.execute("DELETE FROM items")
+                self.conn.executemany("INSERT INTO items (id, name, description, price, seq) VALUES (?, ?, ?, ?, ?)",
+                                      [(i['id'], i['name'], i['description'], i['price'], n) for n, i in enumerate(items)])
+            for item in changed or ():
+                updated = self.conn.execute("UPDATE items SET name = ?, description = ?, price = ? WHERE id = ?",
+                                            (item['name'], item['description'], item['price'], item['id'])).rowcount
+                if not updated:
+                    self.conn.execute("INSERT INTO items (id, name, description, price, seq) VALUES (?, ?, ?, ?, ?)",
+                                      (item['id'], item['name'], item['description'], item['price'], self._next_seq('items')))
+            for item_id in deleted or ():
+                self.conn.execute("DELETE FROM items WHERE id = ?", (item_id,))
+            self._set_meta('item_counter', max(counter, self._get_meta('item_counter')))
+        self._saved('items', version, keyed_records({'item': items if changed is None and deleted is None else changed or []}),
+                    deleted, replace=changed is None and deleted is None)
+
+    def _select_contacts(self):
+        clients, prospects = [], []
+        for kind, cid, name, email, address, phone in self.conn.execute(
+                "SELECT kind, id, name, email, address, phone FROM contacts ORDER BY seq"):
+            (clients if kind == 'client' else prospects).append({'id': cid, 'name': name, 'email': email, 'address': address, 'phone': phone})
+        return clients, prospects, self._get_meta('contact_counter')
+
+    def load_contacts(self):
+        version, (clients, prospects, counter) = self._read_store('contacts', self._select_contacts)
+        self._synced['contacts'] = (version, fingerprint_records(keyed_records({'client': clients, 'prospect': prospects})))
+        return clients, prospects, counter
+
+    def refresh_contacts(self, clients, prospects):
+        if self._get_meta('contacts_version') == self._synced.get('contacts', (None,))[0]: return None
+        version, (their_clients, their_prospects, counter) = self._read_store('contacts', self._select_contacts)
+        theirs = keyed_records({'client': their_clients, 'prospect': their_prospects})
+        changes = merge_external_changes({'client': clients, 'prospect': prospects}, self._synced.get('contacts', (None, {}))[1], theirs)
+        self._synced['contacts'] = (version, fingerprint_records(theirs))
+        return changes + (counter,)
+
+    def save_contacts(self, clients, prospects, counter, changed=None, deleted=None):
+        replace = changed is None and deleted is None
+        with self.conn:
+            version = self._bump_version('contacts')
+            if replace:
+                changed = [('client', c) for c in clients] + [('prospect', p) for p in prospects]
+                self.conn.execute("DELETE FROM contacts")
+                self.conn.executemany("INSERT INTO contacts (id, kind, name, email, address, phone, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [(c['id'], kind, c['name'], c['email'], c['address'], c['phone'], n) for n, (kind, c) in enumerate(changed)])
+            for kind, contact in () if replace else changed or ():
+                updated = self.conn.execute(
+                    "UPDATE contacts SET kind = ?, name = ?, email = ?, address = ?, phone = ?, seq = CASE WHEN kind = ? THEN seq ELSE ? END WHERE id = ?",
+                    (kind, contact['name'], contact['email'], contact['address'], contact['phone'], kind, self._next_seq('contacts'), contact['id'])).rowcount
+                if not updated:
+                    self.conn.execute("INSERT INTO contacts (id, kind, name, email, address, phone, seq) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      (contact['id'], kind, contact['name'], contact['email'], contact['address'], contact['phone'], self._next_seq('contacts')))
+            for contact_id in deleted or ():
+                self.conn.execute("DELETE FROM contacts WHERE id = ?", (contact_id,))
+            self._set_meta('contact_counter', max(counter, self._get_meta('contact_counter')))
+        self._saved('contacts', version, {contact['id']: (kind, contact) for kind, contact in changed or ()}, deleted, replace)
+
+    def history_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def history_page(self, start, count):
+        """Up to count records, newest first, after skipping the start newest."""
+        return [json.loads(r[0]) for r in self.conn.execute("SELECT record FROM history ORDER BY id DESC LIMIT ? OFFSET ?", (count, start))]
+
+    def history_records(self, keys):
+        """The records with these scan_history() keys (row ids), in the order given."""
+        keys, records = list(keys), {}
+        for n in range(0, len(keys), 500): # Under SQLite's bound-parameter limit
+            chunk = keys[n:n + 500]
+            records.update(self.conn.execute(f"SELECT id, record FROM history WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        return [json.loads(records[key]) for key in keys]
+
+    def scan_history(self, after=-1, count=HISTORY_PAGE_SIZE):
+        """Up to count (key, record) pairs, oldest first, for the records after key 'after'."""
+        return [(r[0], json.loads(r[1])) for r in self.conn.execute("SELECT id, record FROM history WHERE id > ? ORDER BY id LIMIT ?", (after, count))]
+
+    def iter_history(self):
+        for r in self.conn.execute("SELECT record FROM history ORDER BY id"): yield json.loads(r[0])
+
+    def load_history(self):
+        return list(self.iter_history())
+
+    def history_token(self):
+        return self._get_meta('history_version')
+
+    def append_history(self, entries):
+        with self.conn:
+            self._bump_version('history')
+            self._insert_history(entries)
+
+    def history_generation(self):
+        return self._get_meta('history_rewrite_version')
+
+    def save_documents(self, documents):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO documents (number, data) VALUES (?, ?)",
+                                  [(number, json.dumps(data)) for number, data in documents.items()])
+
+    def document_data(self, number):
+        row = self.conn.execute("SELECT data FROM documents WHERE number = ?", (number,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_history(self, records):
+        with self.conn: # One transaction, so a failure part way leaves the old history, never an empty one
+            self._bump_version('history'); self._bump_version('history_rewrite')
+            self.conn.execute("DELETE FROM history")
+            self._insert_history(records)
+
+    def _insert_history(self, entries):
+        self.conn.executemany("INSERT INTO history (date, type, client, number, record) VALUES (?, ?, ?, ?, ?)",
+                              [(e.get('date'), e.get('type'), e.get('client'), e.get('number'), json.dumps(e)) for e in entries])
+
+    def close(self):
+        self.conn.close()
+
+def open_storage(app_settings, writer=None):
+    """Storage backend selected by the 'storage_backend' app setting. writer only applies to the JSON backend."""
+    if app_settings.get('storage_backend') == 'sqlite': return SqliteStorage(SQLITE_DB_FILE)
+    return JsonStorage(writer, binary_catalog=bool(app_settings.get('item_catalog_binary')))
+
+def assign_contact_ids(clients, prospects, counter):
+    """Give contacts from older files a stable id; returns the updated counter."""
+    for contact in clients + prospects:
+        if not contact.get('id'):
+            counter += 1; contact['id'] = f"CONT{counter:04d}"
+    return counter
+
+def migrate_json_to_sqlite(db_path=SQLITE_DB_FILE, force=False):
+    """One-shot import of items.json, clients_prospects.json and data.json into a SQLite database,
+    then switch app_config.json to the sqlite backend."""
+    target = SqliteStorage(db_path)
+    existing = sum(target.conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ('items', 'contacts', 'history'))
+    if existing and not force:
+        target.close()
+        print(f"{db_path} already holds {existing} record(s); re-run with --force to overwrite them."); return 1
+    source = JsonStorage()
+    items, item_counter = source.load_items()
+    clients, prospects, contact_counter = source.load_contacts()
+    contact_counter = assign_contact_ids(clients, prospects, contact_counter)
+    history = source.load_history()
+    target.save_items(items, item_counter)
+    target.save_contacts(clients, prospects, contact_counter)
+    target.save_history(history)
+    target.close()
+
+    app_settings = {}
+    if os.path.exists(APP_CONFIG_FILE):
+        with open(APP_CONFIG_FILE, 'r') as f: app_settings = json.load(f)
+    app_settings['storage_backend'] = 'sqlite'
+    with open(APP_CONFIG_FILE, 'w') as f: json.dump(app_settings, f, indent=4)
+    print(f"Migrated {len(items)} item(s), {len(clients) + len(prospects)} contact(s) and {len(history)} history record(s) into {db_path}.")
+    print("The JSON files were left in place; app_config.json now selects the sqlite backend.")
+    return 0
+
+# --- History Search ---
+def history_date_key(date):
+    """A history date ('YYYY-MM-DD HH:MM') as the number YYYYMMDDHHMM, for range queries; a bare date is midnight."""
+    digits = ''.join(ch for ch in str(date or '')[:16] if ch.isdigit())
+    return int(digits[:12].ljust(12, '0')) if digits else 0
+
+class HistoryIndex:
+    """In-memory index over the stored history, for the History tab's filters. Records are numbered
+    by position, oldest first, beside their storage key. Per position it keeps the client (a number
+    into 'clients'), document type, date key and total as flat arrays. Client names are split into
+    tokens in an inverted index (token -> client numbers), each client and type has a posting list
+    of positions, and dates and totals get sorted orders for bisect range queries. query() scans the
+    most selective filter's positions and checks the rest against the arrays (with NumPy if installed)."""
+    def __init__(self):
+        self.keys = array('q') # Storage key per position, for history_records()
+        self.client_of, self.type_of = array('i'), array('i')
+        self.dates, self.totals = array('q'), array('d')
+        self.clients, self.client_numbers = [], {} # Client name per number, and back
+        self.client_postings = [] # Positions per client number
+        self.tokens = {} # Word of a client name -> client numbers
+        self.sorted_tokens = None # For prefix lookups; rebuilt when a new client adds words
+        self.types, self.type_postings = {}, [] # Casefolded type -> number; positions per type number
+        self.by_date = self.by_total = None # (sorted values, positions); built on the first range query, then kept sorted
+        self.generation = self.last_digest = None # Storage's history_generation() and a digest of the last record indexed
+
+    def __len__(self): return len(self.keys)
+
+    @staticmethod
+    def _digest(record):
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_current(self, storage):
+        """False if the stored history was rewritten since this index was built, rather than only added
+        to: its generation moved on, it got shorter, or the last record indexed is no longer the same
+        (a data file replaced by a restore, for example)."""
+        if storage.history_generation() != self.generation: return False
+        if not self.keys: return True
+        if storage.history_count() < len(self.keys): return False
+        try: return self._digest(storage.history_records([self.keys[-1]])[0]) == self.last_digest
+        except (KeyError, IndexError, StopIteration): return False
+
+    def build(self, storage, count=HISTORY_INDEX_CHUNK):
+        """Index up to count records saved since the last call. True once it has caught up."""
+        if not self.keys: self.generation = storage.history_generation()
+        records = storage.scan_history(self.keys[-1] if self.keys else -1, count)
+        for key, record in records: self.add(key, record)
+        if records: self.last_digest = self._digest(records[-1][1])
+        return len(records) < count
+
+    def add(self, key, record):
+        position = len(self.keys)
+        self.keys.append(key)
+        client = record.get('client') or ''
+        number = self.client_numbers.get(client)
+        if number is None:
+            number = self.client_numbers[client] = len(self.clients)
+            self.clients.append(client); self.client_postings.append(array('i'))
+            for token in set(normalize_name(client).split()): self.tokens.setdefault(token, []).append(number)
+            self.sorted_tokens = None
+        self.client_of.append(number); self.client_postings[number].append(position)
+        type_number = self.types.setdefault((record.get('type') or '').casefold(), len(self.types))
+        if type_number == len(self.type_postings): self.type_postings.append(array('i'))
+        self.type_of.append(type_number); self.type_postings[type_number].append(position)
+        date, total = history_date_key(record.get('date')), _record_total(record)
+        self.dates.append(date); self.totals.append(total)
+        for order, value in ((self.by_date, date), (self.by_total, total)):
+            if order is not None: # History mostly arrives in date order, so this is usually an append
+                at = bisect_right(order[0], value); order[0].insert(at, value); order[1].insert(at, position)
+
+    def match_clients(self, text):
+        """Numbers of the clients with, for every word of text, a name word starting with it."""
+        if self.sorted_tokens is None: self.sorted_tokens = sorted(self.tokens)
+        matches = None
+        for word in normalize_name(text).split():
+            numbers, at = set(), bisect_left(self.sorted_tokens, word)
+            while at < len(self.sorted_tokens) and self.sorted_tokens[at].startswith(word):
+                numbers.update(self.tokens[self.sorted_tokens[at]]); at += 1
+            matches = numbers if matches is None else matches & numbers
+            if not matches: break
+        return sorted(matches or ())
+
+    def _range(self, name, column, low, high):
+        """(start, end, positions): positions[start:end] have a value in the inclusive range."""
+        order = getattr(self, name)
+        if order is None:
+            if np is not None: positions = array('i', np.argsort(np.frombuffer(column, dtype=column.typecode), kind='stable').astype(np.int32).tobytes())
+            else: positions = array('i', sorted(range(len(column)), key=column.__getitem__))
+            order = (array(column.typecode, map(column.__getitem__, positions)), positions); setattr(self, name, order)
+        start = 0 if low is None else bisect_left(order[0], low)
+        end = len(order[0]) if high is None else bisect_right(order[0], high)
+        return start, max(start, end), order[1]
+
+    def query(self, client='', doc_type='', date_from=None, date_to=None, min_total=None, max_total=None):
+        """Positions, ascending (oldest first), of the records matching every filter given. client
+        matches as in match_clients(), doc_type exactly (ignoring case); the date (history_date_key()
+        values) and total ranges are inclusive, and either end may be None."""
+        candidates = [] # (size, filter, positions to scan) per filter given
+        clients = type_number = None
+        if client.split():
+            clients = self.match_clients(client)
+            candidates.append((sum(len(self.client_postings[n]) for n in clients), 'client', lambda: [self.client_postings[n] for n in clients] or [array('i')]))
+        if doc_type:
+            type_number = self.types.get(doc_type.casefold(), -1)
+            posting = self.type_postings[type_number] if type_number >= 0 else array('i')
+            candidates.append((len(posting), 'type', lambda: [posting]))
+        ranges = {}
+        for name, column, low, high in (('date', self.dates, date_from, date_to), ('total', self.totals, min_total, max_total)):
+            if low is None and high is None: continue
+            ranges[name] = (column, low, high)
+            start, end, positions = self._range('by_' + name, column, low, high)
+            candidates.append((end - start, name, lambda start=start, end=end, positions=positions: [positions[start:end]]))
+        if not candidates: return range(len(self.keys))
+        _, scanned, postings = min(candidates, key=lambda c: c[0])
+        postings = postings()
+        if np is not None: return self._check_numpy(postings, scanned, clients, type_number, ranges)
+        positions = postings[0] if len(postings) == 1 else sorted(p for posting in postings for p in posting)
+        checks = []
+        if clients is not None and scanned != 'client': checks.append((self.client_of, set(clients).__contains__))
+        if type_number is not None and scanned != 'type': checks.append((self.type_of, type_number.__eq__))
+        for name, (column, low, high) in ranges.items():
+            if name != scanned: checks.append((column, lambda value, low=low, high=high: (low is None or value >= low) and (high is None or value <= high)))
+        matches = [p for p in positions if all(check(column[p]) for column, check in checks)] if checks else list(positions)
+        return sorted(matches) if scanned in ranges else matches # A range's positions come in value order
+
+    def _check_numpy(self, postings, scanned, clients, type_number, ranges):
+        positions = np.concatenate([np.frombuffer(posting, dtype=np.int32) for posting in postings])
+        if len(postings) > 1 or scanned in ranges: positions.sort()
+        mask = np.ones(len(positions), dtype=bool)
+        if clients is not None and scanned != 'client':
+            mask &= np.isin(np.frombuffer(self.client_of, dtype=np.int32)[positions], clients)
+        if type_number is not None and scanned != 'type':
+            mask &= np.frombuffer(self.type_of, dtype=np.int32)[positions] == type_number
+        for name, (column, low, high) in ranges.items():
+            if name == scanned: continue
+            values = np.frombuffer(column, dtype=column.typecode)[positions]
+            if low is not None: mask &= values >= low
+            if high is not None: mask &= values <= high
+        return positions[mask]
+
+# --- PDF Rendering ---
+PDF_FONT_SIZE = 10 # Base font size for PDF
+LARGE_DOCUMENT_ROWS = 500 # Line items at which generate_pdf switches to the streamed, bounded-memory table
+
+class PdfTemplate:
+    """The parts of a rendered document that depend only on business details, app settings and doc type:
+    styles, table style, column widths, the business header and the payment/terms footer.
+    Built once via get_pdf_template(); build_story() only adds the per-document flowables."""
+    def __init__(self, doc_type, business_details, app_settings):
+        self.doc_type = doc_type
+        styles = getSampleStyleSheet()
+        font_size_pdf = PDF_FONT_SIZE
+
+        # PDF Styles
+        title_style = ParagraphStyle('PdfTitle', parent=styles['h1'], fontSize=18, spaceAfter=0.8*cm, alignment=1, textColor=colors.HexColor("#002b36"))
+        self.heading_style = ParagraphStyle('PdfHeading', parent=styles['h2'], fontSize=font_size_pdf + 2, spaceBefore=0.4*cm, spaceAfter=0.15*cm, textColor=colors.HexColor("#268bd2"))
+        self.normal_style = normal_style = ParagraphStyle('PdfNormal', parent=styles['Normal'], fontSize=font_size_pdf, leading=font_size_pdf+2)
+        self.normal_bold_style = normal_bold_style = ParagraphStyle('PdfNormalBold', parent=normal_style, fontName='Helvetica-Bold')
+        table_header_style = ParagraphStyle('PdfTableHeader', parent=normal_bold_style, alignment=1, textColor=colors.whitesmoke)
+        self.table_cell_style = ParagraphStyle('PdfTableCell', parent=normal_style, alignment=0) # Left default
+        self.table_cell_right_style = ParagraphStyle('PdfTableCellRight', parent=self.table_cell_style, alignment=2) # Right
+        self.totals_style_right = ParagraphStyle('TotalsRight', parent=normal_style, alignment=2)
+        self.total_amount_style = ParagraphStyle('TotalAmountPdf', parent=ParagraphStyle('TotalsBoldRight', parent=normal_bold_style, alignment=2), fontSize=font_size_pdf+2)
+
+        self.currency_sym = currency_sym_pdf = business_details.get('currency_symbol', '$')
+        self.tax_name = tax_name_pdf = app_settings.get('tax_name', 'Tax')
+
+        # --- Header ---
+        self.header = [Paragraph(f"{business_details.get('name', 'Your Business Name')}", title_style)] # Use title style for business name
+        self.header.append(Paragraph(f"{business_details.get('address', 'Your Address')}", normal_style))
+        if business_details.get('phone'): self.header.append(Paragraph(f"Phone: {business_details['phone']}", normal_style))
+        if business_details.get('email'): self.header.append(Paragraph(f"Email: {business_details['email']}", normal_style))
+        tax_id_label_pdf = DEFAULT_COUNTRY_DATA.get(app_settings.get('selected_country'), {}).get('tax_id_label', 'Tax ID')
+        tax_id_value_pdf = business_details.get('tax_identifier_value', '')
+        if tax_id_value_pdf: self.header.append(Paragraph(f"{tax_id_label_pdf}: {tax_id_value_pdf}", normal_style))
+        self.header.append(Spacer(1, 0.8*cm))
+        self.header.append(Paragraph(f"<b>{doc_type.capitalize()}</b>", ParagraphStyle('DocTypeTitle', fontSize=16, alignment=0, spaceAfter=0.2*cm)))
+
+        self.table_header_row = [
+            Paragraph("Description", table_header_style), Paragraph("Qty", table_header_style),
+            Paragraph(f"Unit Price ({currency_sym_pdf})", table_header_style),
+            Paragraph(f"{tax_name_pdf} ({currency_sym_pdf})", table_header_style),
+            Paragraph(f"Total ({currency_sym_pdf})", table_header_style)
+        ]
+        page_width = A4[0] - 3*cm # margins
+        self.col_widths = [page_width*0.40, page_width*0.10, page_width*0.18, page_width*0.12, page_width*0.20]
+        # Header row height as Table lays it out: tallest cell + the 8pt top/bottom padding set below
+        self.table_header_height = max(p.wrap(w - 12, A4[1])[1] for p, w in zip(self.table_header_row, self.col_widths)) + 16
+        self.table_style = TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#268bd2")), # Header background
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, 0), 'CENTER'), # Header text center
+            ('ALIGN', (0, 1), (0, -1), 'LEFT'),   # Description left
+            ('ALIGN', (1, 1), (-1, -1), 'RIGHT'), # Other columns right
+            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+            ('TOPPADDING', (0, 0), (-1, 0), 8),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.lightgrey)
+        ])
+
+        # --- Footer ---
+        self.footer = []
+        if doc_type == 'invoice':
+            self.footer.append(Paragraph("Payment Details:", self.heading_style))
+            if business_details.get('bank'): self.footer.append(Paragraph(f"Bank: {business_details['bank']}", normal_style))
+            if business_details.get('bsb'): self.footer.append(Paragraph(f"BSB: {business_details['bsb']}", normal_style))
+            if business_details.get('account'): self.footer.append(Paragraph(f"Account No: {business_details['account']}", normal_style))
+            self.footer.append(Spacer(1, 0.5*cm))
+        if business_details.get('invoice_terms'):
+            self.footer.append(Paragraph("Terms & Conditions:", self.heading_style))
+            self.footer.append(Paragraph(business_details['invoice_terms'].replace('\n', '<br/>\n'), normal_style))
+
+    def build_story(self, data, date_text=None):
+        currency_sym_pdf, normal_style = self.currency_sym, self.normal_style
+        story = list(self.header)
+        if data.get('number'): story.append(Paragraph(f"{self.doc_type.capitalize()} No: {data['number']}", self.normal_bold_style))
+        story.append(Paragraph(f"Date: {date_text or datetime.now().strftime('%d %B %Y')}", normal_style))
+        story.append(Spacer(1, 0.5*cm))
+
+        story.append(Paragraph("Bill To:", self.heading_style))
+        story.append(Paragraph(f"{data['client_name']}", self.normal_bold_style))
+        story.append(Paragraph(f"{data['client_address']}", normal_style))
+        story.append(Paragraph(f"{data['client_email']}", normal_style))
+        story.append(Spacer(1, 0.8*cm))
+
+        if len(data['items']) >= LARGE_DOCUMENT_ROWS:
+            story.append(_StreamedItemTable(self, self._iter_large_rows(data['items'])))
+        else: story.append(self._item_table(data['items']))
+        story.append(Spacer(1, 0.5*cm))
+
+        story.append(Paragraph(f"Subtotal: {currency_sym_pdf}{data['subtotal']}", self.totals_style_right))
+        story.append(Paragraph(f"{self.tax_name}: {currency_sym_pdf}{data['tax']}", self.totals_style_right))
+        story.append(Paragraph(f"<b>Total: {currency_sym_pdf}{data['total']}</b>", self.total_amount_style))
+        story.append(Spacer(1, 0.8*cm))
+        story.extend(self.footer)
+        return story
+
+    def _item_table(self, items):
+        currency_sym_pdf = self.currency_sym
+        item_data_for_pdf = [self.table_header_row]
+        for item_values in items: # item_id, name, description, qty, price_str, tax_str, total_str
+            desc_text = f"<b>{item_values[1]}</b><br/><font size='{PDF_FONT_SIZE-1}'>{item_values[2]}</font>"
+            item_data_for_pdf.append([
+                Paragraph(desc_text, self.table_cell_style), Paragraph(str(item_values[3]), self.table_cell_right_style),
+                Paragraph(item_values[4].replace(currency_sym_pdf, ''), self.table_cell_right_style),
+                Paragraph(item_values[5].replace(currency_sym_pdf, ''), self.table_cell_right_style),
+                Paragraph(item_values[6].replace(currency_sym_pdf, ''), self.table_cell_right_style)
+            ])
+        table = Table(item_data_for_pdf, colWidths=self.col_widths, repeatRows=1)
+        table.setStyle(self.table_style)
+        return table
+
+    def _iter_large_rows(self, items):
+        # Only the description needs wrapping; numeric cells stay plain strings, which Table lays out far more cheaply.
+        currency_sym_pdf, desc_width = self.currency_sym, self.col_widths[0] - 12
+        for item_values in items:
+            desc = Paragraph(f"<b>{item_values[1]}</b><br/><font size='{PDF_FONT_SIZE-1}'>{item_values[2]}</font>", self.table_cell_style)
+            height = max(desc.wrap(desc_width, A4[1])[1], PDF_FONT_SIZE * 1.2) + 6 # Table's default 3pt top/bottom padding
+            yield [desc, str(item_values[3]), item_values[4].replace(currency_sym_pdf, ''),
+                   item_values[5].replace(currency_sym_pdf, ''), item_values[6].replace(currency_sym_pdf, '')], height
+
+    def _rows_table(self, rows):
+        table = LongTable([self.table_header_row] + rows, colWidths=self.col_widths, repeatRows=1)
+        table.setStyle(self.table_style)
+        return table
+
+    def render(self, data, pdf_file):
+        doc = SimpleDocTemplate(pdf_file, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
+        doc.build(self.build_story(data))
+        return pdf_file
+
+class _StreamedItemTable(Flowable):
+    """Line-item table for very large documents, fed from a row iterator.
+    Each split materializes only the rows that fit in the current frame as its own table with the header row,
+    so peak memory stays flat and layout is linear in the row count (splitting one huge Table re-lays out
+    every remaining row on every page)."""
+    def __init__(self, template, rows, pending=None):
+        Flowable.__init__(self)
+        self.template, self._rows = template, rows
+        self._pending = pending or [] # (cells, height) pulled from the iterator but not yet placed
+        self._table = None
+
+    def _fit(self, avail_height):
+        # Number of pending rows that fit below the header; pulls more rows from the iterator as needed.
+        used, fitted = self.template.table_header_height, 0
+        while True:
+            if fitted == len(self._pending):
+                try: self._pending.append(next(self._rows))
+                except StopIteration: return fitted
+            used += self._pending[fitted][1]
+            if used > avail_height: return fitted
+            fitted += 1
+
+    def wrap(self, availWidth, availHeight):
+        fitted = self._fit(availHeight)
+        if fitted == len(self._pending): # Everything left fits in this frame
+            self._table = self.template._rows_table([cells for cells, _ in self._pending])
+            return self._table.wrap(availWidth, availHeight)
+        return availWidth, availHeight + 1 # Too tall; the frame will ask us to split
+
+    def split(self, availWidth, availHeight):
+        fitted = self._fit(availHeight)
+        if not fitted: return [] # Not even one row fits; move on to the next frame
+        piece = self.template._rows_table([cells for cells, _ in self._pending[:fitted]])
+        rest = self._pending[fitted:]
+        self._pending = [] # Rows now belong to piece/remainder
+        if not rest:
+            try: rest = [next(self._rows)]
+            except StopIteration: return [piece]
+        return [piece, _StreamedItemTable(self.template, self._rows, rest)]
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self._table.drawOn(canvas, x, y, _sW)
+
+class _StreamedStory(list):
+    """Story list that pulls flowables from a generator as doc.build() consumes them,
+    so only a small look-ahead is ever materialized."""
+    LOOKAHEAD = 8
+
+    def __init__(self, flowables):
+        list.__init__(self)
+        self._source = iter(flowables)
+        self._refill()
+
+    def _refill(self):
+        while self._source is not None and list.__len__(self) < self.LOOKAHEAD:
+            try: self.append(next(self._source))
+            except StopIteration: self._source = None
+
+    def __len__(self):
+        self._refill()
+        return list.__len__(self)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._refill()
+
+class _OutlineEntry(Flowable):
+    """Zero-size flowable that bookmarks the page it lands on and adds it to the PDF outline."""
+    def __init__(self, key, title, level=0):
+        Flowable.__init__(self)
+        self.key, self.title, self.level = key, title, level
+
+    def wrap(self, availWidth, availHeight):
+        return 0, 0
+
+    def draw(self):
+        self.canv.bookmarkPage(self.key)
+        self.canv.addOutlineEntry(self.title, self.key, level=self.level, closed=self.level == 0)
+
+def _record_total(record):
+    """Numeric total of a history record, tolerating the formatted '$123.00' strings of older records."""
+    total = record.get('total')
+    if isinstance(total, (int, float)): return float(total)
+    if 'data' in record: return float(record['data']['total'])
+    try: return float(''.join(ch for ch in total or '' if ch.isdigit() or ch in '.-'))
+    except ValueError: return 0.0
+
+def history_total_text(record):
+    """A history record's total as shown: records store it as a number beside their currency symbol."""
+    total = record.get('total')
+    return f"{record.get('currency', '')}{total:.2f}" if isinstance(total, (int, float)) else total or ''
+
+def filter_history_records(records, client=None, date_from=None, date_to=None):
+    """Yield history records for a client and/or an inclusive YYYY-MM-DD date range."""
+    for record in records:
+        day = record.get('date', '')[:10]
+        if client and record.get('client') != client: continue
+        if date_from and day < date_from: continue
+        if date_to and day > date_to: continue
+        yield record
+
+def _statement_flowables(records, business_details, app_settings, title, document_data=None):
+    template = get_pdf_template('invoice', business_details, app_settings)
+    yield _OutlineEntry('statement', title)
+    yield Paragraph(business_details.get('name', 'Your Business Name'), template.header[0].style)
+    yield Paragraph(f"<b>{title}</b>", ParagraphStyle('StatementTitle', fontSize=16, alignment=0, spaceAfter=0.4*cm))
+    yield Paragraph(f"Generated {datetime.now().strftime('%d %B %Y')}", template.normal_style)
+
+    count, totals, month = 0, {}, None
+    currency_sym = business_details.get('currency_symbol', '$')
+    for index, record in enumerate(records):
+        yield PageBreak()
+        record_month = record.get('date', '')[:7]
+        if record_month != month:
+            month = record_month
+            yield _OutlineEntry(f"month-{month}", month or "Undated", level=0)
+        label = f"{record.get('date', '')} {record.get('number', record.get('type', ''))} - {record.get('client', '')}"
+        yield _OutlineEntry(f"doc-{index}", label, level=1)
+        doc_type = record.get('type', 'Invoice').lower()
+        data = record.get('data') # Older entries embedded the contents; newer ones are looked up by number
+        if data is None and document_data is not None and record.get('number') and record.get('status') != 'Void':
+            data = document_data(record['number'])
+        if data is not None:
+            try: date_text = datetime.strptime(record['date'], '%Y-%m-%d %H:%M').strftime('%d %B %Y')
+            except (KeyError, ValueError): date_text = record.get('date')
+            yield from get_pdf_template(doc_type, business_details, app_settings).build_story(data, date_text)
+        elif record.get('status') == 'Void':
+            yield Paragraph(f"<b>{record.get('type', '')} {record.get('number', '')} - VOID</b>", template.heading_style)
+            for line in (f"Date: {record.get('date', '')}", f"Client: {record.get('client', '')}",
+                         f"This number was allocated but no document was issued: {record.get('void_reason', '')}"):
+                yield Paragraph(line, template.normal_style)
+        else: # Older history entries only kept a summary
+            yield Paragraph(f"<b>{record.get('type', '')}</b>", template.heading_style)
+            for line in (f"Date: {record.get('date', '')}", f"Client: {record.get('client', '')}", f"Total: {history_total_text(record)}",
+                         f"Line items were not recorded for this document. Original PDF: {record.get('pdf_path', '')}"):
+                yield Paragraph(line, template.normal_style)
+        count += 1
+        totals[record.get('type', '')] = totals.get(record.get('type', ''), 0.0) + _record_total(record)
+
+    yield PageBreak()
+    yield _OutlineEntry('summary', "Summary")
+    yield Paragraph("Summary", template.heading_style)
+    yield Paragraph(f"Documents: {count}", template.normal_style)
+    for doc_type, total in sorted(totals.items()):
+        yield Paragraph(f"{doc_type} total: {currency_sym}{total:.2f}", template.normal_style)
+
+def build_statement(records, pdf_file, business_details, app_settings, title="Statement", document_data=None):
+    """Stream any number of history records into one PDF, one document per page run, with outline
+    bookmarks grouped by month. Stories are generated one document at a time as the build consumes them.
+    document_data(number) supplies the contents of records that don't embed them (storage.document_data)."""
+    doc = SimpleDocTemplate(pdf_file, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm, leftMargin=1.5*cm, rightMargin=1.5*cm,
+                            title=title)
+    doc.build(_StreamedStory(_statement_flowables(records, business_details, app_settings, title, document_data)))
+    return pdf_file
+
+_pdf_templates = {}
+
+def get_pdf_template(doc_type, business_details, app_settings):
+    """Return the cached PdfTemplate for this combination, compiling it on first use."""
+    key = (doc_type, json.dumps(business_details, sort_keys=True), json.dumps(app_settings, sort_keys=True))
+    template = _pdf_templates.get(key)
+    if template is None:
+        template = _pdf_templates[key] = PdfTemplate(doc_type, business_details, app_settings)
+    return template
+
+def invalidate_pdf_templates():
+    # Keys include every input, so stale templates are never served; this just drops ones that can no longer be hit.
+    _pdf_templates.clear()
+
+class PdfRenderCache:
+    """Content-addressed store of rendered PDFs, keyed by a hash of the document's content, with the
+    number it was issued under beside each. Generating the same content again reuses that document
+    and number instead of issuing a duplicate. A file's mtime is its last use, so LRU eviction needs
+    no index and stays consistent if several processes share the directory."""
+    def __init__(self, cache_dir=PDF_CACHE_DIR, max_bytes=200 * 1024 * 1024):
+        self.cache_dir, self.max_bytes = cache_dir, max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key_for(data, doc_type, business_details, app_settings):
+        # Content only: the number and the date are those of the document a hit reuses
+        data = {key: value for key, value in data.items() if key != 'number'}
+        tax_settings = {key: app_settings.get(key) for key in ('selected_country', 'tax_name', 'tax_rate')}
+        normalized = {'doc_type': doc_type, 'data': data, 'business_details': business_details, 'tax_settings': tax_settings}
+        # Round-tripping through JSON turns tuples into lists so tree rows and snapshots hash the same
+        canonical = json.dumps(json.loads(json.dumps(normalized)), sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def lookup(self, key):
+        """Number of the document already issued with this content, or None."""
+        cached = self._path(key)
+        try:
+            with open(cached[:-4] + '.number', 'r') as f: number = f.read().strip() or None
+        except OSError: number = None
+        with self._lock:
+            if number is None or not os.path.exists(cached):
+                self.misses += 1; return None
+            os.utime(cached) # Mark as most recently used
+            self.hits += 1
+            return number
+
+    def fetch(self, key, pdf_file):
+        """Place a cached copy at pdf_file (hard link, or copy across filesystems). Returns False on a miss."""
+        cached = self._path(key)
+        with self._lock:
+            if not os.path.exists(cached): return False
+            if os.path.exists(pdf_file): os.remove(pdf_file)
+            try: os.link(cached, pdf_file)
+            except OSError: shutil.copyfile(cached, pdf_file)
+            return True
+
+    def store(self, key, pdf_file, number):
+        with self._lock:
+            cached = self._path(key)
+            tmp_file = f"{cached}.{os.getpid()}.tmp"
+            shutil.copyfile(pdf_file, tmp_file)
+            os.replace(tmp_file, cached)
+            with open(cached[:-4] + '.number', 'w') as f: f.write(number)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pdf'): continue
+            st = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries): # Oldest use first
+            if total <= self.max_bytes: break
+            try: os.remove(os.path.join(self.cache_dir, name))
+            except OSError: continue
+            try: os.remove(os.path.join(self.cache_dir, name[:-4] + '.number'))
+            except OSError: pass
+            total -= size; self.evictions += 1
+
+    def size_bytes(self):
+        return sum(os.path.getsize(os.path.join(self.cache_dir, n)) for n in os.listdir(self.cache_dir) if n.endswith('.pdf'))
+
+    def stats_text(self):
+        return f"{self.hits} hit(s), {self.misses} miss(es), {self.evictions} eviction(s), {self.size_bytes() / (1024 * 1024):.1f} MB cached"
+
+def render_pdf(data, doc_type, business_details, app_settings, pdf_file=None, cache=None):
+    """Render one invoice/quote to PDF. Has no Tk dependency so it can run in worker processes.
+    With a PdfRenderCache, the render is stored there under its content and number, so generating
+    the same content again can reuse it (PdfRenderCache.lookup). Raises on failure; returns the path
+    of the written file."""
+    if pdf_file is None:
+        pdf_file = f"{doc_type.capitalize()}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf" # underscore in time
+    get_pdf_template(doc_type, business_details, app_settings).render(data, pdf_file)
+    if cache is not None: cache.store(cache.key_for(data, doc_type, business_details, app_settings), pdf_file, data.get('number'))
+    return pdf_file
+
+@contextmanager
+def file_lock(path):
+    """Exclusive advisory lock on path + '.lock', held across processes and threads for the duration of the block."""
+    with open(path + '.lock', 'a+b') as lock_file:
+        if fcntl is not None: fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            while True:
+                try: lock_file.seek(0); msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1); break
+                except OSError: continue # LK_LOCK gives up after ~10s; keep waiting
+        try: yield
+        finally:
+            if fcntl is not None: fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None: lock_file.seek(0); msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+class DocumentNumberAllocator:
+    """Persistent invoice/quote number sequences shared by every process using the data directory.
+    Numbers are handed out in contiguous blocks under an exclusive file lock, so concurrent
+    renderers never collide and the sequence has no holes as long as every allocated number is used
+    (failed renders are recorded as void history entries)."""
+    def __init__(self, path=SEQUENCES_FILE):
+        self.path = path
+
+    @staticmethod
+    def format(doc_type, n):
+        return f"{DOCUMENT_NUMBER_PREFIXES.get(doc_type, doc_type[:3].upper())}-{n:06d}"
+
+    def allocate(self, doc_type, count=1):
+        """Reserve the next count numbers for doc_type and return them formatted, in order."""
+        with file_lock(self.path):
+            sequences = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f: sequences = json.load(f)
+            first = sequences.get(doc_type, 0) + 1
+            sequences[doc_type] = first + count - 1
+            write_json_atomic(self.path, sequences)
+        return [self.format(doc_type, n) for n in range(first, first + count)]
+
+    def next_counter(self, name, at_least=0):
+        """Next value of a plain counter (item and contact ids), unique across processes. at_least seeds
+        it from a store's own counter the first time."""
+        with file_lock(self.path):
+            sequences = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f: sequences = json.load(f)
+            sequences[name] = max(sequences.get(name, 0), at_least) + 1
+            write_json_atomic(self.path, sequences)
+        return sequences[name]
+
+def document_pdf_path(doc_type, number, output_dir='.'):
+    return os.path.join(output_dir, f"{doc_type.capitalize()}_{number}.pdf")
+
+def void_history_entry(doc_type, number, client, reason):
+    """History record that accounts for an allocated number whose document was never produced."""
+    return {'date': datetime.now().strftime('%Y-%m-%d %H:%M'), 'type': doc_type.capitalize(), 'client': client,
+            'total': None, 'pdf_path': '', 'number': number, 'status': 'Void', 'void_reason': reason}
+
+def unique_pdf_path(doc_type, reserved=()):
+    """Timestamped PDF filename that neither exists on disk nor is reserved by a pending render."""
+    base = f"{doc_type[:1].upper()}{doc_type[1:]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    pdf_file, n = f"{base}.pdf", 1
+    while os.path.exists(pdf_file) or pdf_file in reserved:
+        n += 1; pdf_file = f"{base}_{n}.pdf"
+    return pdf_file
+
+class RenderCancelled(Exception):
+    """Error delivered to a render job's on_done when the queue is cancelled before the job started."""
+
+class PdfRenderQueue:
+    """Renders documents on a worker thread so doc.build() never blocks the Tk main loop.
+    Tk is not thread-safe, so the worker only renders; completions are delivered on the
+    main thread by polling through window.after."""
+    POLL_MS = 100
+
+    def __init__(self, window, on_status_change=None):
+        self.window = window
+        self.on_status_change = on_status_change
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = {} # pdf_file -> job description, in submission order
+        self._in_progress = None
+        self._polling = False
+        threading.Thread(target=self._worker, name="pdf-render", daemon=True).start()
+
+    def submit(self, data, doc_type, business_details, app_settings, on_done, cache=None, pdf_file=None):
+        """Queue a render. data is snapshotted here; on_done(pdf_file, error) runs on the main thread."""
+        pdf_file = pdf_file or unique_pdf_path(doc_type, reserved=self._pending)
+        data, business_details, app_settings = json.loads(json.dumps(data)), dict(business_details), dict(app_settings)
+        render = lambda: render_pdf(data, doc_type, business_details, app_settings, pdf_file, cache)
+        return self.submit_task(f"{doc_type.capitalize()} for {data['client_name']}", pdf_file, render, on_done)
+
+    def submit_task(self, description, pdf_file, render, on_done):
+        """Queue any render callable that writes pdf_file; the caller is responsible for snapshotting its inputs."""
+        self._pending[pdf_file] = description
+        self._jobs.put((pdf_file, render, on_done))
+        self._notify()
+        if not self._polling:
+            self._polling = True
+            self.window.after(self.POLL_MS, self._poll)
+        return pdf_file
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def cancel_pending(self):
+        """Drop the jobs not yet started, wait for the one in progress, and deliver every outcome now;
+        dropped jobs get RenderCancelled. Called before the window closes, so no on_done is lost."""
+        while True:
+            try: pdf_file, render, on_done = self._jobs.get_nowait()
+            except queue.Empty: break
+            self._results.put((pdf_file, RenderCancelled("Closed before this document was rendered"), on_done))
+            self._jobs.task_done()
+        self._jobs.join()
+        self._poll()
+
+    def status_text(self):
+        if not self._pending: return ""
+        current = self._pending.get(self._in_progress)
+        if not current: return f"{len(self._pending)} document(s) queued for rendering..."
+        queued = len(self._pending) - 1
+        return f"Rendering {current}..." + (f" ({queued} queued)" if queued else "")
+
+    def _worker(self):
+        while True:
+            pdf_file, render, on_done = self._jobs.get()
+            self._in_progress = pdf_file
+            try: render(); error = None
+            except Exception as e: error = e
+            self._results.put((pdf_file, error, on_done))
+            self._in_progress = None
+            self._jobs.task_done()
+
+    def _poll(self):
+        while True:
+            try: pdf_file, error, on_done = self._results.get_nowait()
+            except queue.Empty: break
+            self._pending.pop(pdf_file, None)
+            on_done(pdf_file, error)
+        self._notify()
+        if self._pending: self.window.after(self.POLL_MS, self._poll)
+        else: self._polling = False
+
+    def _notify(self):
+        if self.on_status_change: self.on_status_change(self.status_text())
+
+# --- Document Editing ---
+MAX_LINE_CENTS = 10 ** 12 # Keeps every product in price_lines well inside int64
+
+PRICE_SCALE = 10000 # Unit prices are kept in ten-thousandths, so sub-cent prices (0.0035) are exact; only line amounts round to cents
+
+def to_fixed(value, scale):
+    """value * scale as an integer, rounding half up on the decimal value as typed."""
+    value = Decimal(str(value))
+    if not value.is_finite(): raise ValueError(f"Not a finite amount: {value}")
+    return int((value * scale).quantize(Decimal(1), ROUND_HALF_UP))
+
+def to_hundredths(value):
+    """Money to cents (or a quantity to hundredths)."""
+    return to_fixed(value, 100)
+
+def to_price_units(value):
+    """A unit price to ten-thousandths."""
+    return to_fixed(value, PRICE_SCALE)
+
+def cents_text(cents):
+    return f"{'-' if cents < 0 else ''}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+def price_text(units):
+    """A unit price in ten-thousandths, with two decimals unless it has more."""
+    digits = f"{abs(units) % PRICE_SCALE:04d}".rstrip('0').ljust(2, '0')
+    return f"{'-' if units < 0 else ''}{abs(units) // PRICE_SCALE}.{digits}"
+
+def price_lines(qty, price, taxed, rate_bp):
+    """Price document lines in integer cents, all lines at once. qty (hundredths), price
+    (ten-thousandths) and taxed (0/1) are equal-length array('q') columns, so qty * price is in
+    millionths; rate_bp is the tax rate in hundredths of a percent. Amounts round half up. Returns (line subtotals, line taxes, (subtotal, taxed subtotal,
+    sum of line taxes)). Uses NumPy when it is installed."""
+    if np is not None and len(qty):
+        q, p, t = (np.frombuffer(column, dtype=np.int64) for column in (qty, price, taxed))
+        subtotals = (q * p + 5000) // 10000
+        taxed_subtotals = subtotals * t
+        taxes = (taxed_subtotals * rate_bp + 5000) // 10000
+        return (array('q', subtotals.tobytes()), array('q', taxes.tobytes()),
+                (int(subtotals.sum()), int(taxed_subtotals.sum()), int(taxes.sum())))
+    subtotals = array('q', [(a * b + 5000) // 10000 for a, b in zip(qty, price)])
+    taxes = array('q', [(sub * rate_bp + 5000) // 10000 if flag else 0 for sub, flag in zip(subtotals, taxed)])
+    return subtotals, taxes, (sum(subtotals), sum(sub for sub, flag in zip(subtotals, taxed) if flag), sum(taxes))
+
+def document_totals(sums, rate_bp, rounding):
+    """(subtotal, tax, total) in cents from price_lines' sums."""
+    subtotal, taxed_subtotal, line_taxes = sums
+    tax = line_taxes if rounding == 'line' else (taxed_subtotal * rate_bp + 5000) // 10000
+    return subtotal, tax, subtotal + tax
+
+class LineItem:
+    """One line as added to a document: what, how many, at what unit price (ex tax), and whether
+    tax applies to it."""
+    __slots__ = ('item_id', 'name', 'description', 'qty', 'unit_price', 'taxed')
+
+    def __init__(self, item_id, name, description, qty, unit_price, taxed):
+        self.item_id, self.name, self.description = item_id, name, description
+        self.qty, self.unit_price, self.taxed = qty, unit_price, taxed
+
+class DocumentDraft:
+    """The lines of the invoice or quote being edited. Rows are keyed by row id (also the row's
+    Treeview iid); the numbers live here in integer columns and the Treeview only shows them.
+    Each line's subtotal and tax are kept priced at the current tax rate, and the document's sums
+    are adjusted by each add, remove or quantity change, so reading totals costs the same however
+    long the document is. A rate or tax change reprices every line in one price_lines pass. With
+    check on, every read of the totals is compared to a full recompute. Unit prices are kept in
+    ten-thousandths (PRICE_SCALE), so only the line amounts round to cents."""
+    def __init__(self, tax_rate=0.0, rounding='document', check=CHECK_RUNNING_TOTALS):
+        self.row_ids, self.info = [], [] # Per column index: row id and (item id, name, description); None once removed
+        self.row_index = {} # row id -> column index
+        self.qty, self.price, self.taxed = array('q'), array('q'), array('q')
+        self.line_subtotals, self.line_taxes = array('q'), array('q')
+        self.sums = [0, 0, 0] # Subtotal, taxed subtotal and sum of line taxes, in cents
+        self.rows_added = 0
+        self.rate_bp, self.rounding = to_hundredths(tax_rate), rounding
+        self.check = check
+
+    def __len__(self): return len(self.row_index)
+
+    def _account(self, index, sign):
+        self.sums[0] += sign * self.line_subtotals[index]
+        if self.taxed[index]: self.sums[1] += sign * self.line_subtotals[index]
+        self.sums[2] += sign * self.line_taxes[index]
+
+    def _price(self, index): # Same arithmetic as price_lines, for one line
+        subtotal = (self.qty[index] * self.price[index] + 5000) // 10000
+        if subtotal > MAX_LINE_CENTS: raise ValueError("Line amount too large")
+        self.line_subtotals[index] = subtotal
+        self.line_taxes[index] = (subtotal * self.rate_bp + 5000) // 10000 if self.taxed[index] else 0
+
+    def add(self, line):
+        index = len(self.qty)
+        self.qty.append(to_hundredths(line.qty)); self.price.append(to_price_units(line.unit_price)); self.taxed.append(1 if line.taxed else 0)
+        self.line_subtotals.append(0); self.line_taxes.append(0)
+        try: self._price(index)
+        except ValueError:
+            for column in (self.qty, self.price, self.taxed, self.line_subtotals, self.line_taxes): column.pop()
+            raise
+        self.rows_added += 1; row_id = f"L{self.rows_added}"
+        self.row_ids.append(row_id); self.info.append((line.item_id, line.name, line.description))
+        self.row_index[row_id] = index; self._account(index, 1)
+        return row_id
+
+    def remove(self, row_id):
+        index = self.row_index.pop(row_id, None)
+        if index is None: return
+        self._account(index, -1)
+        self.qty[index] = self.price[index] = self.taxed[index] = self.line_subtotals[index] = self.line_taxes[index] = 0
+        self.row_ids[index] = self.info[index] = None
+        if len(self.qty) > 64 and len(self.row_index) < len(self.qty) // 2: self._compact()
+
+    def _compact(self):
+        keep = [index for index, row_id in enumerate(self.row_ids) if row_id is not None]
+        for name in ('qty', 'price', 'taxed', 'line_subtotals', 'line_taxes'):
+            column = getattr(self, name); setattr(self, name, array('q', [column[i] for i in keep]))
+        self.row_ids = [self.row_ids[i] for i in keep]; self.info = [self.info[i] for i in keep]
+        self.row_index = {row_id: index for index, row_id in enumerate(self.row_ids)}
+
+    def set_qty(self, row_id, qty):
+        index = self.row_index[row_id]
+        old_qty = self.qty[index]
+        self._account(index, -1); self.qty[index] = to_hundredths(qty)
+        try: self._price(index)
+        except ValueError: self.qty[index] = old_qty; self._price(index); raise
+        finally: self._account(index, 1)
+
+    def set_taxed(self, taxed):
+        self.taxed = array('q', [1 if taxed else 0]) * len(self.qty)
+        self.reprice()
+
+    def set_pricing(self, tax_rate, rounding):
+        rate_bp = to_hundredths(tax_rate)
+        if rate_bp != self.rate_bp: self.rate_bp = rate_bp; self.reprice()
+        self.rounding = rounding # Only affects how the sums are combined
+
+    def reprice(self):
+        self.line_subtotals, self.line_taxes, sums = price_lines(self.qty, self.price, self.taxed, self.rate_bp)
+        self.sums = list(sums)
+
+    def totals(self):
+        """(subtotal, tax, total) in cents."""
+        if self.check:
+            expected = price_lines(self.qty, self.price, self.taxed, self.rate_bp)[2]
+            if tuple(self.sums) != expected:
+                print(f"Running totals out of step: {tuple(self.sums)} vs {expected}"); self.sums = list(expected)
+        return document_totals(self.sums, self.rate_bp, self.rounding)
+
+    def line(self, row_id):
+        index = self.row_index[row_id]
+        return LineItem(*self.info[index], self.qty[index] / 100, self.price[index] / PRICE_SCALE, bool(self.taxed[index]))
+
+    def _row(self, index, currency_sym):
+        subtotal, tax = self.line_subtotals[index], self.line_taxes[index]
+        return [*self.info[index], cents_text(self.qty[index]), f"{currency_sym}{price_text(self.price[index])}",
+                f"{currency_sym}{cents_text(tax)}", f"{currency_sym}{cents_text(subtotal + tax)}"]
+
+    def row_values(self, row_id, currency_sym):
+        return self._row(self.row_index[row_id], currency_sym)
+
+    def display_rows(self, currency_sym):
+        """[(row id, values)] in document order."""
+        return [(row_id, self._row(index, currency_sym)) for index, row_id in enumerate(self.row_ids) if row_id is not None]
+
+    def rows(self, currency_sym):
+        """The lines as passed to the PDF renderer."""
+        return [values for _, values in self.display_rows(currency_sym)]
+
+class SearchIndex:
+    """Case-insensitive substring search over a list of strings. A trigram index narrows a query to
+    the entries holding its rarest trigram. The index is built a chunk at a time by build(), so a
+    large list doesn't stall the UI; until it is complete, and for queries under three characters,
+    entries are scanned."""
+    def __init__(self, values):
+        self.values = list(values)
+        self.lowered = [value.lower() for value in self.values]
+        self.trigrams = {} # trigram -> array of indices into values, ascending
+        self.indexed = 0 # Entries indexed so far
+
+    def build(self, count):
+        """Index up to count more entries; returns True once everything is indexed."""
+        stop, trigrams = min(self.indexed + count, len(self.lowered)), self.trigrams
+        for index in range(self.indexed, stop):
+            text = self.lowered[index]
+            for trigram in {text[i:i + 3] for i in range(len(text) - 2)}:
+                postings = trigrams.get(trigram)
+                if postings is None: trigrams[trigram] = postings = array('i')
+                postings.append(index)
+        self.indexed = stop
+        return stop == len(self.lowered)
+
+    def search(self, query, within=None):
+        """Indices of the values containing query, ascending. within: the result of an earlier
+        search for a substring of query, which this result must be a subset of."""
+        query, lowered = query.lower(), self.lowered
+        if not query: return list(range(len(lowered)))
+        if within is not None: candidates = within
+        elif len(query) >= 3 and self.indexed == len(lowered):
+            candidates = min((self.trigrams.get(query[i:i + 3], ()) for i in range(len(query) - 2)), key=len)
+        else: candidates = range(len(lowered))
+        return [index for index in candidates if query in lowered[index]]
+
 class SearchableCombobox(ttk.Frame):
+    DEBOUNCE_MS = 150 # Wait for a pause in typing before searching
+    MAX_RESULTS = 200 # Rows shown in the dropdown; the rest are summed up in a last "N more" row
+    INDEX_CHUNK = 500 # Entries indexed per step, about 20 ms
+
     def __init__(self, parent, width=30, **kwargs):
         super().__init__(parent)
         self.width = width
+        self.listbox = None
         self._create_widgets()
         self._setup_bindings()
-        self._items = []
-        self._filtered_items = []
+        self._index = SearchIndex([])
+        self._matches = [] # Indices into _index.values matching the current search
+        self._last_query = ''
+        self._search_job = self._index_job = None
         self._selected_item = None
         self.dropdown_window = None
         
@@ -125,20 +2164,32 @@ class SearchableCombobox(ttk.Frame):
         self.search_entry.bind('<Up>', self._on_up)
         
     def _on_search_change(self, *args):
-        search_text = self.search_var.get().lower()
-        self._filtered_items = [item for item in self._items if search_text in item.lower()]
+        if self._search_job: self.after_cancel(self._search_job)
+        self._search_job = self.after(self.DEBOUNCE_MS, self._run_search)
+
+    def _run_search(self):
+        self._search_job = None
+        query = self.search_var.get().lower()
+        # Typing on extends the query, so only the previous matches need checking
+        within = self._matches if self._last_query and self._last_query in query else None
+        self._matches = self._index.search(query, within)
+        self._last_query = query
         self._update_listbox()
         
     def _update_listbox(self):
-        if hasattr(self, 'listbox') and self.listbox:
+        if self.listbox:
             self.listbox.delete(0, tk.END)
-            for item in self._filtered_items:
-                self.listbox.insert(tk.END, item)
+            values = self._index.values
+            self.listbox.insert(tk.END, *[values[index] for index in self._matches[:self.MAX_RESULTS]])
+            if len(self._matches) > self.MAX_RESULTS:
+                self.listbox.insert(tk.END, f"... {len(self._matches) - self.MAX_RESULTS} more, keep typing to narrow")
+                self.listbox.itemconfig(tk.END, foreground='grey')
             
     def _on_select(self, event):
         if self.listbox.curselection():
             index = self.listbox.curselection()[0]
-            self._selected_item = self._filtered_items[index]
+            if index >= min(len(self._matches), self.MAX_RESULTS): return # The "N more" row
+            self._selected_item = self._index.values[self._matches[index]]
             self.search_var.set(self._selected_item)
             self.hide_dropdown()
             self.event_generate('<<ComboboxSelected>>')
@@ -151,7 +2202,7 @@ class SearchableCombobox(ttk.Frame):
         self.after(200, self.hide_dropdown)
         
     def _on_return(self, event):
-        if self.listbox.curselection():
+        if self.listbox and self.listbox.curselection():
             self._on_select(None)
         return "break"
         
@@ -160,7 +2211,7 @@ class SearchableCombobox(ttk.Frame):
         return "break"
         
     def _on_down(self, event):
-        if not self.dropdown_window.winfo_ismapped():
+        if not self.dropdown_window or not self.dropdown_window.winfo_ismapped():
             self.show_dropdown()
         else:
             current = self.listbox.curselection()
@@ -172,7 +2223,7 @@ class SearchableCombobox(ttk.Frame):
         return "break"
         
     def _on_up(self, event):
-        if self.dropdown_window.winfo_ismapped():
+        if self.dropdown_window and self.dropdown_window.winfo_ismapped():
             current = self.listbox.curselection()
             if current:
                 next_idx = max(current[0] - 1, 0)
@@ -245,18 +2296,174 @@ class SearchableCombobox(ttk.Frame):
         self._selected_item = value
         
     def configure(self, **kwargs):
-        if 'values' in kwargs:
-            self._items = kwargs['values']
-            self._filtered_items = self._items.copy()
+        if 'values' in kwargs: # A list of strings, or a SearchIndex shared with other comboboxes
+            values = kwargs['values']
+            self._index = values if isinstance(values, SearchIndex) else SearchIndex(values)
+            self._matches, self._last_query = list(range(len(self._index.values))), ''
+            if self._index_job: self.after_cancel(self._index_job); self._index_job = None
+            self._build_index()
             self._update_listbox()
         if 'width' in kwargs:
             self.width = kwargs['width']
             self.search_entry.configure(width=self.width)
-            self.listbox.configure(width=self.width)
+            if self.listbox: self.listbox.configure(width=self.width)
+
+    def _build_index(self):
+        self._index_job = None if self._index.build(self.INDEX_CHUNK) else self.after(1, self._build_index)
             
     def config(self, **kwargs):
         self.configure(**kwargs)
 
+class VirtualTreeview(ttk.Frame):
+    """A Treeview that only holds the rows in view, for stores too large to insert row by row.
+    count() gives the number of records and fetch(start, count) the (key, values) pairs at those
+    offsets; scrolling moves an offset into the records and refetches the rows in view, a block at
+    a time. Keys are the row iids, and the selected key (one row, as in 'browse' mode) is kept while
+    its row scrolls out of view. heading(), column(), bind(), selection() and item(key, 'values')
+    work as on a Treeview. Rows already shown are diffed against the refetched ones by key, so
+    scrolling or an edit only inserts, updates or deletes the rows that changed. A store with a
+    ChangeFeed is shown with set_keys(), after which only its changes are applied."""
+    def __init__(self, parent, columns, block_rows=100, **kwargs):
+        super().__init__(parent)
+        self.tree = ttk.Treeview(self, columns=columns, show='headings', selectmode='browse', **kwargs)
+        self.scrollbar = ttk.Scrollbar(self, orient='vertical', command=self._on_scrollbar)
+        self.scrollbar.pack(side='right', fill='y')
+        self.tree.pack(side='left', fill='both', expand=True)
+        self.count, self.fetch = (lambda: 0), (lambda start, count: [])
+        self.block_rows = block_rows
+        self.blocks = {} # block number -> fetched (key, values) pairs; a few around the view
+        self.total = self.offset = 0
+        self.visible = int(kwargs.get('height', 10)) # Rows that fit; measured once the tree is drawn
+        self.measured = False # Measuring needs a drawn row, so a tree that starts empty measures when rows arrive
+        self.rows = {} # key -> values of the rows in view
+        self.selected, self.selected_values = None, None
+        self.keys = self.values_for = self.feed = None # Set for an in-memory store shown with set_keys()
+        self.tree.bind('<<TreeviewSelect>>', self._on_select)
+        self.tree.bind('<Configure>', self._on_resize)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'): self.tree.bind(sequence, self._on_wheel)
+        self.tree.bind('<Up>', lambda e: self._move(-1)); self.tree.bind('<Down>', lambda e: self._move(1))
+        self.tree.bind('<Prior>', lambda e: self._move(-self.visible)); self.tree.bind('<Next>', lambda e: self._move(self.visible))
+        self.tree.bind('<Home>', lambda e: self._move(-self.total)); self.tree.bind('<End>', lambda e: self._move(self.total))
+
+    def heading(self, *args, **kwargs): return self.tree.heading(*args, **kwargs)
+    def column(self, *args, **kwargs): return self.tree.column(*args, **kwargs)
+    def bind(self, sequence=None, func=None, add=None): return self.tree.bind(sequence, func, add)
+
+    def selection(self):
+        return (self.selected,) if self.selected is not None else ()
+
+    def item(self, key, option=None):
+        values = self.rows.get(key, self.selected_values if key == self.selected else None)
+        if values is None: raise tk.TclError(f"Item {key} not found")
+        return values if option == 'values' else {'values': values}
+
+    def set_source(self, count, fetch, offset=None):
+        """Show another set of records (or re-read the same one); offset, if given, is the new top row."""
+        self.count, self.fetch = count, fetch
+        self.keys = self.values_for = self.feed = None
+        self.refresh(offset)
+
+    def set_keys(self, keys, values_for, feed):
+        """Show an in-memory store: keys are its record ids in display order, values_for(key) a row's
+        values (None once the record is gone) and feed its ChangeFeed. Called again with the same
+        feed, only the changes recorded since are applied, keeping the selection and scroll position."""
+        if feed is self.feed: return self.patch(*feed.drain())
+        feed.drain()
+        self.count, self.fetch = (lambda: len(self.keys)), self._fetch_keys
+        self.keys, self.values_for, self.feed = list(keys), values_for, feed
+        self.refresh(0)
+
+    def patch(self, added=(), updated=(), removed=()):
+        """Apply a store's changes: removed keys leave the order, added ones go at the end. Rows
+        above the view that were removed shift it up, so the same rows stay in view."""
+        if not (added or updated or removed): return
+        offset = self.offset
+        if removed:
+            removed = set(removed); gone = removed.difference(added)
+            offset -= sum(1 for key in self.keys[:self.offset] if key in removed)
+            self.keys = [key for key in self.keys if key not in removed]
+            if self.selected in gone: self.selected = self.selected_values = None
+        self.keys.extend(added)
+        if self.selected is not None and self.selected in updated: self.selected_values = self.values_for(self.selected)
+        self.refresh(offset)
+
+    def _fetch_keys(self, start, count):
+        keys = self.keys[start:start + count]
+        values = list(map(self.values_for, keys))
+        if any(v is None for v in values): # Gone without a change in the feed: drop the keys, so blocks stay aligned with offsets
+            gone = {key for key, v in zip(keys, values) if v is None}
+            self.keys = [key for key in self.keys if key not in gone]
+            self.blocks.clear(); self.total = len(self.keys)
+            if self.selected in gone: self.selected = self.selected_values = None
+            return self._fetch_keys(start, count)
+        return list(zip(keys, values))
+
+    def refresh(self, offset=None):
+        self.blocks.clear()
+        self.total = self.count()
+        self._show(self.offset if offset is None else offset)
+
+    def clear_selection(self):
+        self.selected = self.selected_values = None
+        self.tree.selection_remove(*self.tree.selection())
+
+    def _fetch_rows(self, start, count):
+        rows, block = [], start // self.block_rows
+        while len(rows) < count and block * self.block_rows < self.total:
+            if block not in self.blocks:
+                if len(self.blocks) >= 8: del self.blocks[next(iter(self.blocks))] # Oldest first
+                self.blocks[block] = self.fetch(block * self.block_rows, self.block_rows)
+            rows.extend(self.blocks[block][max(start - block * self.block_rows, 0):])
+            block += 1
+        return rows[:count]
+
+    def _show(self, offset):
+        self.offset = max(min(offset, self.total - self.visible), 0)
+        try: rows = self._fetch_rows(self.offset, self.visible)
+        except Exception as e: print(f"Error reading rows: {e}"); rows = []
+        shown, self.rows = self.rows, dict(rows)
+        stale = [key for key in shown if key not in self.rows]
+        if stale: self.tree.delete(*stale)
+        for index, (key, values) in enumerate(rows): # Rows kept keep their order, so new ones slot in by index
+            if key not in shown: self.tree.insert('', index, iid=key, values=values)
+            elif shown[key] != values: self.tree.item(key, values=values)
+        if self.selected in self.rows: self.tree.selection_set(self.selected)
+        if self.total: self.scrollbar.set(self.offset / self.total, min((self.offset + self.visible) / self.total, 1.0))
+        else: self.scrollbar.set(0, 1)
+        if rows and not self.measured: self.tree.after_idle(self._on_resize)
+
+    def _on_select(self, event=None):
+        selection = self.tree.selection()
+        if selection: self.selected = selection[0]; self.selected_values = self.rows.get(self.selected)
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto': self._show(int(float(amount) * self.total))
+        else: self._show(self.offset + int(amount) * (self.visible if unit == 'pages' else 1))
+
+    def _on_wheel(self, event):
+        step = -1 if event.num == 4 or getattr(event, 'delta', 0) > 0 else 1
+        self._show(self.offset + 3 * step)
+        return "break"
+
+    def _on_resize(self, event=None):
+        children = self.tree.get_children()
+        box = self.tree.bbox(children[0]) if children else None
+        if not box: return
+        self.measured = True
+        visible = max((self.tree.winfo_height() - box[1]) // max(box[3], 1), 1)
+        if visible != self.visible: self.visible = visible; self._show(self.offset)
+
+    def _move(self, step):
+        """Move the selection by step rows, scrolling to keep it in view."""
+        position = self.offset + list(self.rows).index(self.selected) if self.selected in self.rows else self.offset - 1
+        target = max(min(position + step, self.total - 1), 0)
+        if target < self.offset: self._show(target)
+        elif target >= self.offset + self.visible: self._show(target - self.visible + 1)
+        keys = list(self.rows)
+        if 0 <= target - self.offset < len(keys):
+            self.tree.selection_set(keys[target - self.offset]); self.tree.see(keys[target - self.offset])
+        return "break"
+
 class InvoiceSystem:
     def __init__(self):
         self.window = tk.Tk()
@@ -267,12 +2474,14 @@ class InvoiceSystem:
         self.window.configure(bg=LIGHT_THEME["bg"])
 
         self.style = ttk.Style()
+        self.applied_theme_spec = self.applied_pricing = None # What update_ui_for_app_settings last applied
 
-        self.app_settings = {
-            'selected_country': 'Australia', 'tax_name': 'GST', 'tax_rate': 10.0,
-            'apply_tax_default': True, 'theme': 'Light', 'font_size': '12'
-        }
+        self.app_settings = dict(DEFAULT_APP_SETTINGS)
         self.load_app_settings()
+        self.writer = WriteBehindWriter(max(int(self.app_settings.get('save_delay_ms', 500)), 0) / 1000)
+        atexit.register(self.writer.close) # Flush pending saves however the app exits
+        self.render_cache = None
+        self.configure_render_cache()
 
         self.business_details = {
             'name': '', 'address': '', 'phone': '', 'email': '',
@@ -283,16 +2492,27 @@ class InvoiceSystem:
         self.business_entries = {}
         self.load_business_details()
 
-        self.clients = []
-        self.prospects = []
+        self.storage = open_storage(self.app_settings, self.writer)
+        self.contacts = ContactDirectory()
+        self.contact_counter = 0
         self.load_clients_prospects()
 
-        self.items = []
+        self.items = ItemCatalog()
         self.item_counter = 0
         self.load_items()
 
-        self.history_records = []
-        self.load_history_data()
+        self.history_loaded = False # The History tab reads its first page when first shown
+        self.history_index = None # HistoryIndex, built the first time the History filters are used
+        self.history_filters_shown, self._history_filter_job, self._history_index_job = None, None, None
+        self.number_allocator = DocumentNumberAllocator()
+        self.drafts = {doc_type: DocumentDraft(self.app_settings.get('tax_rate', 0.0), self.app_settings.get('tax_rounding', 'document'))
+                       for doc_type in ('invoice', 'quote')} # Lines of the open invoice and quote
+
+        # Packed before the notebook so it keeps its space at the bottom of the window
+        self.render_status_label = ttk.Label(self.window, text="", anchor="w")
+        self.render_status_label.pack(side='bottom', fill='x', padx=12, pady=(0,5))
+        self.render_queue = PdfRenderQueue(self.window, on_status_change=lambda text: self.render_status_label.config(text=text))
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
 
         self.notebook = ttk.Notebook(self.window)
         self.notebook.pack(expand=True, fill='both', padx=10, pady=(5,10)) # Added bottom pady
@@ -334,7 +2554,29 @@ class InvoiceSystem:
         self.update_quote_client_dropdown()
         self.update_item_selection()       # Updates invoice item combobox
         self.update_item_selection_quote() # Updates quote item combobox
-        self.update_history_display()
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+        self.history_token = self.storage.history_token()
+        self.window.after(STORE_POLL_MS, self.check_external_changes)
+
+    def check_external_changes(self):
+        """Pick up items, contacts and history saved by other instances sharing the data directory.
+        Only a store whose file (or version) changed is re-read, and its changes are merged into the lists."""
+        try:
+            changes = self.storage.refresh_items(self.items)
+            if changes:
+                self.item_counter = max(self.item_counter, changes[3])
+                self.update_items_list(); self.update_item_selection(); self.update_item_selection_quote()
+            changes = self.storage.refresh_contacts(self.contacts.clients, self.contacts.prospects)
+            if changes:
+                self.contact_counter = max(self.contact_counter, changes[3])
+                self.update_clients_list(); self.update_prospects_list()
+                self.update_client_dropdown(); self.update_quote_client_dropdown()
+            token = self.storage.history_token()
+            if token != self.history_token:
+                self.history_token = token
+                self.update_history_display()
+        except Exception as e: print(f"Error checking for external changes: {e}")
+        self.window.after(STORE_POLL_MS, self.check_external_changes)
 
     def load_app_settings(self):
         try:
@@ -345,10 +2587,7 @@ class InvoiceSystem:
                         self.app_settings[key] = loaded_settings.get(key, default_value)
         except Exception as e:
             print(f"Error loading app settings: {e}. Using defaults.")
-            self.app_settings = {
-                'selected_country': 'Australia', 'tax_name': 'GST', 'tax_rate': 10.0,
-                'apply_tax_default': True, 'theme': 'Light', 'font_size': '12'
-            }
+            self.app_settings = dict(DEFAULT_APP_SETTINGS)
 
     def save_app_settings(self):
         try:
@@ -358,11 +2597,27 @@ class InvoiceSystem:
                 try: self.app_settings['tax_rate'] = float(self.tax_rate_var.get())
                 except ValueError: messagebox.showerror("Error", "Invalid tax rate."); return False
             if hasattr(self, 'apply_tax_default_var'): self.app_settings['apply_tax_default'] = self.apply_tax_default_var.get()
+            if hasattr(self, 'tax_rounding_var'): self.app_settings['tax_rounding'] = self.tax_rounding_var.get()
             if hasattr(self, 'theme_var_app'): self.app_settings['theme'] = self.theme_var_app.get()
             if hasattr(self, 'font_size_var_app'): self.app_settings['font_size'] = self.font_size_var_app.get()
-
-            with open(APP_CONFIG_FILE, 'w') as f:
-                json.dump(self.app_settings, f, indent=4)
+            if hasattr(self, 'pdf_cache_enabled_var'): self.app_settings['pdf_cache_enabled'] = self.pdf_cache_enabled_var.get()
+            if hasattr(self, 'pdf_cache_max_mb_var'):
+                try: self.app_settings['pdf_cache_max_mb'] = int(self.pdf_cache_max_mb_var.get())
+                except ValueError: messagebox.showerror("Error", "Invalid cache size."); return False
+
+            if hasattr(self, 'save_delay_ms_var'):
+                try: self.app_settings['save_delay_ms'] = max(int(self.save_delay_ms_var.get()), 0)
+                except ValueError: messagebox.showerror("Error", "Invalid save delay."); return False
+                self.writer.delay = self.app_settings['save_delay_ms'] / 1000
+            if hasattr(self, 'item_catalog_binary_var'):
+                self.app_settings['item_catalog_binary'] = self.item_catalog_binary_var.get()
+                if hasattr(self.storage, 'binary_catalog') and self.storage.binary_catalog != self.app_settings['item_catalog_binary']:
+                    self.storage.binary_catalog = self.app_settings['item_catalog_binary']
+                    if self.storage.binary_catalog: self.save_items() # Writes items.bin
+
+            write_json_atomic(APP_CONFIG_FILE, self.app_settings) # Small, and written now, so a failure is reported below
+            invalidate_pdf_templates()
+            self.configure_render_cache()
             messagebox.showinfo("Success", "App settings saved successfully!") # Removed restart message for now
             self.update_ui_for_app_settings()
             return True
@@ -399,6 +2654,10 @@ class InvoiceSystem:
         self.apply_tax_default_var = tk.BooleanVar(value=self.app_settings.get('apply_tax_default', True))
         self.apply_tax_checkbutton = ttk.Checkbutton(self.loc_frame_gs, text="Apply tax by default on new Invoices/Quotes", variable=self.apply_tax_default_var)
         self.apply_tax_checkbutton.grid(row=3, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+
+        ttk.Label(self.loc_frame_gs, text="Round Tax:").grid(row=4, column=0, padx=5, pady=5, sticky="w")
+        self.tax_rounding_var = tk.StringVar(value=self.app_settings.get('tax_rounding', 'document'))
+        ttk.Combobox(self.loc_frame_gs, textvariable=self.tax_rounding_var, values=TAX_ROUNDING_MODES, width=30, state="readonly").grid(row=4, column=1, padx=5, pady=5, sticky="w")
         self.loc_frame_gs.columnconfigure(1, weight=1)
 
 
@@ -417,9 +2676,55 @@ class InvoiceSystem:
         self.font_size_combo.grid(row=1, column=1, padx=5, pady=5, sticky="ew")
         self.ui_frame_gs.columnconfigure(1, weight=1)
 
+        self.perf_frame_gs = ttk.LabelFrame(frame, text="PDF Render Cache")
+        self.perf_frame_gs.grid(row=row_idx, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
+        row_idx +=1
+
+        self.pdf_cache_enabled_var = tk.BooleanVar(value=self.app_settings.get('pdf_cache_enabled', False))
+        ttk.Checkbutton(self.perf_frame_gs, text="Reuse identical PDFs instead of re-rendering them", variable=self.pdf_cache_enabled_var).grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        ttk.Label(self.perf_frame_gs, text="Max Cache Size (MB):").grid(row=1, column=0, padx=5, pady=5, sticky="w")
+        self.pdf_cache_max_mb_var = tk.StringVar(value=str(self.app_settings.get('pdf_cache_max_mb', 200)))
+        ttk.Entry(self.perf_frame_gs, textvariable=self.pdf_cache_max_mb_var, width=10).grid(row=1, column=1, padx=5, pady=5, sticky="w")
+        self.pdf_cache_stats_label = ttk.Label(self.perf_frame_gs, text="")
+        self.pdf_cache_stats_label.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        self.perf_frame_gs.columnconfigure(1, weight=1)
+        self.update_render_cache_stats()
+
+        self.saving_frame_gs = ttk.LabelFrame(frame, text="Saving")
+        self.saving_frame_gs.grid(row=row_idx, column=0, columnspan=2, padx=10, pady=10, sticky="ew")
+        row_idx +=1
+
+        ttk.Label(self.saving_frame_gs, text="Save Delay (ms):").grid(row=0, column=0, padx=5, pady=5, sticky="w")
+        self.save_delay_ms_var = tk.StringVar(value=str(self.app_settings.get('save_delay_ms', 500)))
+        ttk.Entry(self.saving_frame_gs, textvariable=self.save_delay_ms_var, width=10).grid(row=0, column=1, padx=5, pady=5, sticky="w")
+        self.item_catalog_binary_var = tk.BooleanVar(value=self.app_settings.get('item_catalog_binary', False))
+        ttk.Checkbutton(self.saving_frame_gs, text="Keep a binary copy of the item library for faster startup (large libraries)", variable=self.item_catalog_binary_var).grid(row=1, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        self.save_stats_label = ttk.Label(self.saving_frame_gs, text="")
+        self.save_stats_label.grid(row=2, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        self.saving_frame_gs.columnconfigure(1, weight=1)
+        self.update_save_stats()
+
         ttk.Button(frame, text="Save App Settings", command=self.save_app_settings).grid(row=row_idx, column=0, columnspan=2, pady=20)
         frame.columnconfigure(0, weight=1)
 
+    def configure_render_cache(self):
+        if self.app_settings.get('pdf_cache_enabled'):
+            max_bytes = int(self.app_settings.get('pdf_cache_max_mb', 200)) * 1024 * 1024
+            if self.render_cache is None: self.render_cache = PdfRenderCache(PDF_CACHE_DIR, max_bytes)
+            else: self.render_cache.max_bytes = max_bytes
+        else: self.render_cache = None
+        self.update_render_cache_stats()
+
+    def update_save_stats(self):
+        if not hasattr(self, 'save_stats_label'): return
+        self.save_stats_label.config(text=self.writer.stats_text())
+        self.window.after(2000, self.update_save_stats)
+
+    def update_render_cache_stats(self):
+        if not hasattr(self, 'pdf_cache_stats_label'): return
+        text = self.render_cache.stats_text() if self.render_cache else "Cache disabled"
+        self.pdf_cache_stats_label.config(text=text)
+
     def on_country_selected(self, event=None):
         # ... (same as before)
         selected_country_name = self.country_var.get()
@@ -435,130 +2740,58 @@ class InvoiceSystem:
                 self.tax_id_label_widget.config(text=country_data['tax_id_label'] + ":")
 
     def update_ui_for_app_settings(self):
-        current_theme_name = self.app_settings.get('theme', 'Light')
-        theme_colors = DARK_THEME if current_theme_name == 'Dark' else LIGHT_THEME
+        """Bring the UI in line with the app settings and business details. Only the styles that
+        differ from the applied theme spec are set, and the tax labels, document lines and item
+        prices are redone only when the currency or tax settings changed."""
         font_size = int(self.app_settings.get('font_size', 12))
-        heading_font_size = font_size + 4 # Larger for main headings
-        tree_heading_font_size = font_size # Same as base or slightly smaller
-        tree_row_font_size = font_size -1 if font_size > 10 else font_size
-
-        self.window.configure(bg=theme_colors["bg"])
-        self.style.theme_use('default') # IMPORTANT: Reset to apply custom styles cleanly
-
-        # General widget styles
-        self.style.configure(".", font=('Helvetica', font_size)) # Default font for all ttk widgets
-        self.style.configure("TFrame", background=theme_colors["bg"])
-        self.style.configure("TLabel", background=theme_colors["bg"], foreground=theme_colors["fg"])
-        self.style.configure("TButton", padding=6,
-                             background=theme_colors["button_bg"], foreground=theme_colors["button_fg"],
-                             bordercolor=theme_colors["button_bg"]) # Ensure border matches
-        self.style.map("TButton",
-                       background=[('active', theme_colors["button_active_bg"]), ('pressed', theme_colors["button_active_bg"])],
-                       foreground=[('active', theme_colors["button_fg"]), ('pressed', theme_colors["button_fg"])])
-        
-        self.style.configure("TEntry", fieldbackground=theme_colors["entry_bg"], foreground=theme_colors["entry_fg"],
-                             insertcolor=theme_colors["entry_fg"]) # Cursor color
-        
-        # Combobox styling needs careful mapping for all states
-        self.style.map('TCombobox',
-            fieldbackground=[('readonly', theme_colors["entry_bg"])],
-            foreground=[('readonly', theme_colors["entry_fg"])],
-            selectbackground=[('readonly', theme_colors["entry_bg"])], # Dropdown list bg
-            selectforeground=[('readonly', theme_colors["entry_fg"])], # Dropdown list fg
-            background= [('readonly', theme_colors["entry_bg"])] # Arrow button bg
-        )
-        self.style.configure("TCombobox", lightcolor=[('readonly', theme_colors["entry_bg"])], # border
-                                         darkcolor=[('readonly', theme_colors["entry_bg"])]) # border
-
-
-        self.style.configure("Treeview", background=theme_colors["tree_bg"], foreground=theme_colors["tree_fg"],
-                             fieldbackground=theme_colors["tree_bg"], font=('Helvetica', tree_row_font_size),
-                             rowheight=int(font_size * 1.8)) # Adjust row height based on font
-        self.style.configure("Treeview.Heading", background=theme_colors["button_bg"], foreground=theme_colors["button_fg"],
-                             font=('Helvetica', tree_heading_font_size, 'bold'), relief="flat", padding=(3,3))
-        self.style.map("Treeview.Heading", relief=[('active','groove'),('pressed','sunken')])
-        self.style.map("Treeview",
-                       background=[('selected', theme_colors["tree_selected_bg"])],
-                       foreground=[('selected', theme_colors["tree_selected_fg"])])
-
-        self.style.configure("TNotebook", background=theme_colors["bg"])
-        self.style.configure("TNotebook.Tab", background=theme_colors["tab_bg"], foreground=theme_colors["tab_fg"],
-                             padding=[font_size, font_size//2], font=('Helvetica', font_size)) # Generous padding
-        self.style.map("TNotebook.Tab",
-                       background=[('selected', theme_colors["tab_selected_bg"])],
-                       foreground=[('selected', theme_colors["tab_selected_fg"])],
-                       font=[('selected', ('Helvetica', font_size, 'bold'))]) # Bold active tab
-
-        self.style.configure("TCheckbutton", background=theme_colors["bg"], foreground=theme_colors["fg"],
-                             indicatorforeground=theme_colors["fg"], indicatorbackground=theme_colors["entry_bg"])
-        self.style.map("TCheckbutton", background=[('active', theme_colors["bg"])])
-        
-        self.style.configure("TLabelframe", background=theme_colors["bg"], bordercolor=theme_colors.get("labelframe_fg", theme_colors["fg"]))
-        self.style.configure("TLabelframe.Label", background=theme_colors["bg"], foreground=theme_colors["labelframe_fg"],
-                             font=('Helvetica', font_size, 'bold'))
-        
-        # Apply to specific important labels
-        if hasattr(self, 'main_heading_gs'):
-            self.main_heading_gs.configure(font=('Arial', heading_font_size, 'bold'), foreground=theme_colors["heading_fg"])
-        if hasattr(self, 'main_heading_bd'):
-            self.main_heading_bd.configure(font=('Arial', heading_font_size, 'bold'), foreground=theme_colors["heading_fg"])
-        if hasattr(self, 'main_heading_help'):
-            self.main_heading_help.configure(font=('Arial', heading_font_size, 'bold'), foreground=theme_colors["heading_fg"])
+        spec = get_theme_spec(self.app_settings.get('theme', 'Light'), font_size)
+        restyled = spec is not self.applied_theme_spec
+        if restyled:
+            if self.applied_theme_spec is None: self.style.theme_use('default') # Once; styles set after it persist
+            headings = [getattr(self, name) for name in ('main_heading_gs', 'main_heading_bd', 'main_heading_help') if hasattr(self, name)]
+            for what, name, options in theme_spec_changes(self.applied_theme_spec, spec):
+                if what == 'window': self.window.configure(**options)
+                elif what == 'heading':
+                    for label in headings: label.configure(**options)
+                else: getattr(self.style, what)(name, **options)
+            self.applied_theme_spec = spec
 
         # --- Update dynamic text based on tax/currency ---
         tax_name = self.app_settings.get('tax_name', 'Tax')
         tax_rate = self.app_settings.get('tax_rate', 0.0)
-        tax_checkbox_label = f"Include {tax_name} ({tax_rate:.1f}%)"
-        price_ex_tax_header = f"Price (ex {tax_name})"
-
-        if hasattr(self, 'gst_check_invoice'): self.gst_check_invoice.config(text=tax_checkbox_label)
-        if hasattr(self, 'gst_check_quote'): self.gst_check_quote.config(text=tax_checkbox_label)
-        if hasattr(self, 'items_tree'):
-            self.items_tree.heading('GST', text=tax_name); self.items_tree.heading('Price', text=price_ex_tax_header)
-        if hasattr(self, 'quote_items_tree'):
-            self.quote_items_tree.heading('GST', text=tax_name); self.quote_items_tree.heading('Price', text=price_ex_tax_header)
-        if hasattr(self, 'items_library_tree'):
-            self.items_library_tree.heading('Price', text=price_ex_tax_header)
-        if hasattr(self, 'item_price_ex_tax_label_widget'):
-            self.item_price_ex_tax_label_widget.config(text=f"Price (ex {tax_name}):")
-
-        if hasattr(self, 'subtotal_label'): self.update_total()
-        if hasattr(self, 'subtotal_label_quote'): self.update_total_quote()
-        
-        self.update_items_list() # Item library tree content
-        if hasattr(self, 'items_tree') and self.items_tree.get_children():
-            self.repopulate_treeview_with_current_settings(self.items_tree, 'invoice')
-        if hasattr(self, 'quote_items_tree') and self.quote_items_tree.get_children():
-            self.repopulate_treeview_with_current_settings(self.quote_items_tree, 'quote')
-        
-        self.window.update_idletasks() # Ensure all style changes are rendered
+        pricing = (self._get_currency_symbol(), tax_name, tax_rate, self.app_settings.get('tax_rounding', 'document'))
+        repriced, self.applied_pricing = pricing != self.applied_pricing, pricing
+        if repriced:
+            tax_checkbox_label = f"Include {tax_name} ({tax_rate:.1f}%)"
+            price_ex_tax_header = f"Price (ex {tax_name})"
+
+            if hasattr(self, 'gst_check_invoice'): self.gst_check_invoice.config(text=tax_checkbox_label)
+            if hasattr(self, 'gst_check_quote'): self.gst_check_quote.config(text=tax_checkbox_label)
+            if hasattr(self, 'items_tree'):
+                self.items_tree.heading('GST', text=tax_name); self.items_tree.heading('Price', text=price_ex_tax_header)
+            if hasattr(self, 'quote_items_tree'):
+                self.quote_items_tree.heading('GST', text=tax_name); self.quote_items_tree.heading('Price', text=price_ex_tax_header)
+            if hasattr(self, 'items_library_tree'):
+                self.items_library_tree.heading('Price', text=price_ex_tax_header)
+                self.items_library_tree.refresh() # Re-reads the rows in view, for the currency symbol
+            if hasattr(self, 'item_price_ex_tax_label_widget'):
+                self.item_price_ex_tax_label_widget.config(text=f"Price (ex {tax_name}):")
+
+            for draft in self.drafts.values(): draft.set_pricing(tax_rate, pricing[3]) # Reprices open lines
+            if hasattr(self, 'items_tree') and self.drafts['invoice']:
+                self.repopulate_treeview_with_current_settings(self.items_tree, 'invoice')
+            if hasattr(self, 'quote_items_tree') and self.drafts['quote']:
+                self.repopulate_treeview_with_current_settings(self.quote_items_tree, 'quote')
+        if repriced or restyled: # Totals carry the currency and the font size
+            if hasattr(self, 'subtotal_label'): self.update_total()
+            if hasattr(self, 'subtotal_label_quote'): self.update_total_quote()
+            self.window.update_idletasks() # Ensure all changes are rendered
 
     def repopulate_treeview_with_current_settings(self, tree, doc_type):
-        # ... (same as before, ensure it uses _get_currency_symbol() and _get_current_tax_rate_decimal())
-        current_items_data = []
-        for item_id_in_tree in tree.get_children():
-            values = tree.item(item_id_in_tree, 'values')
-            original_item_id, qty_str = values[0], values[3]
-            try: qty = float(qty_str)
-            except ValueError: qty = 0
-            original_item_info = next((i for i in self.items if i['id'] == original_item_id), None)
-            if original_item_info:
-                 current_items_data.append({'id': original_item_id, 'qty': qty, 'name': original_item_info['name'], 'description': original_item_info['description'], 'price': original_item_info['price']})
-
-        tree.delete(*tree.get_children())
-        tax_rate_decimal = self._get_current_tax_rate_decimal()
-        currency_symbol = self._get_currency_symbol()
-        apply_tax_for_this_doc = (self.gst_var.get() if doc_type == 'invoice' and hasattr(self, 'gst_var') else
-                                  self.gst_var_quote.get() if doc_type == 'quote' and hasattr(self, 'gst_var_quote') else False)
-
-        for item_data in current_items_data:
-            price_ex_tax, qty = item_data['price'], item_data['qty']
-            tax_amount = price_ex_tax * qty * tax_rate_decimal if apply_tax_for_this_doc else 0
-            total_inc_tax = (price_ex_tax * qty) + tax_amount
-            tree.insert('', 'end', values=(
-                item_data['id'], item_data['name'], item_data['description'], f"{qty:.2f}",
-                f"{currency_symbol}{price_ex_tax:.2f}", f"{currency_symbol}{tax_amount:.2f}", f"{currency_symbol}{total_inc_tax:.2f}"
-            ))
+        """Re-render every row of a document from its draft, e.g. after the currency or tax rate changed."""
+        for row_id, values in self.drafts[doc_type].display_rows(self._get_currency_symbol()):
+            if tree.exists(row_id): tree.item(row_id, values=values)
+            else: tree.insert('', 'end', iid=row_id, values=values)
         if doc_type == 'invoice': self.update_total()
         elif doc_type == 'quote': self.update_total_quote()
 
@@ -636,7 +2869,8 @@ class InvoiceSystem:
         if phone and not self.validate_phone(phone): messagebox.showerror("Error", "Valid phone (>=10 digits)."); return
         for key, entry in self.business_entries.items(): self.business_details[key] = entry.get().strip()
         try:
-            with open(BUSINESS_DETAILS_FILE, 'w') as f: json.dump(self.business_details, f, indent=4)
+            write_json_atomic(BUSINESS_DETAILS_FILE, self.business_details) # Written now, as in save_app_settings
+            invalidate_pdf_templates()
             messagebox.showinfo("Success", "Business details saved!")
             self.update_ui_for_app_settings() # Crucial to reflect currency symbol change
         except Exception as e: messagebox.showerror("Error", f"Failed to save business details: {e}")
@@ -677,7 +2911,7 @@ class InvoiceSystem:
 
         clients_tab_content = ttk.Frame(clients_notebook)
         clients_notebook.add(clients_tab_content, text='Clients')
-        self.clients_tree = ttk.Treeview(clients_tab_content, columns=('Name', 'Email', 'Address', 'Phone'), show='headings')
+        self.clients_tree = VirtualTreeview(clients_tab_content, columns=('Name', 'Email', 'Address', 'Phone'))
         for col_name in ('Name', 'Email', 'Address', 'Phone'):
             self.clients_tree.heading(col_name, text=col_name)
             self.clients_tree.column(col_name, width=150, minwidth=100, stretch=tk.YES)
@@ -686,7 +2920,7 @@ class InvoiceSystem:
 
         prospects_tab_content = ttk.Frame(clients_notebook)
         clients_notebook.add(prospects_tab_content, text='Prospects')
-        self.prospects_tree = ttk.Treeview(prospects_tab_content, columns=('Name', 'Email', 'Address', 'Phone'), show='headings')
+        self.prospects_tree = VirtualTreeview(prospects_tab_content, columns=('Name', 'Email', 'Address', 'Phone'))
         for col_name in ('Name', 'Email', 'Address', 'Phone'):
             self.prospects_tree.heading(col_name, text=col_name)
             self.prospects_tree.column(col_name, width=150, minwidth=100, stretch=tk.YES)
@@ -737,42 +2971,40 @@ class InvoiceSystem:
     def add_client(self):
         data = self._get_client_prospect_entry_values()
         if not all(data.values()): messagebox.showerror("Error", "All fields are required!"); return
-        self.clients.append(data)
-        self.update_clients_list(); self.save_clients_prospects(); self._clear_client_prospect_entries()
+        data['id'] = self.generate_contact_id(); self.contacts.add(data, 'client')
+        self.update_clients_list(); self.save_clients_prospects([('client', data)]); self._clear_client_prospect_entries()
         self.update_client_dropdown(); self.update_quote_client_dropdown()
 
     def add_prospect(self):
         data = self._get_client_prospect_entry_values()
         if not all(data.values()): messagebox.showerror("Error", "All fields are required!"); return
-        self.prospects.append(data)
-        self.update_prospects_list(); self.save_clients_prospects(); self._clear_client_prospect_entries()
+        data['id'] = self.generate_contact_id(); self.contacts.add(data, 'prospect')
+        self.update_prospects_list(); self.save_clients_prospects([('prospect', data)]); self._clear_client_prospect_entries()
         self.update_quote_client_dropdown()
 
     def convert_to_client(self):
         selected = self.prospects_tree.selection()
         if not selected: messagebox.showerror("Error", "Select prospect to convert."); return
-        index = self.prospects_tree.index(selected[0])
-        prospect = self.prospects.pop(index)
-        self.clients.append(prospect)
-        self.update_prospects_list(); self.update_clients_list(); self.save_clients_prospects()
+        contact = self.contacts.set_kind(selected[0], 'client') # Rows are keyed by contact id
+        self.update_prospects_list(); self.update_clients_list(); self.save_clients_prospects([('client', contact)])
         self.update_client_dropdown(); self.update_quote_client_dropdown()
 
     def edit_selected_client_prospect(self):
         selected_id = self.clients_tree.selection() or self.prospects_tree.selection()
         if not selected_id: messagebox.showerror("Error", "Select item to edit."); return
-        tree = self.clients_tree if self.clients_tree.selection() else self.prospects_tree
-        data_list = self.clients if self.clients_tree.selection() else self.prospects
-        index = tree.index(selected_id[0])
-        item_data = data_list[index] # This is a dictionary
-        self._set_client_prospect_entry_values(item_data)
-        self.edit_client_button.config(text="Save", command=lambda current_item=item_data: self.save_client_prospect_edit(current_item))
+        contact = self.contacts.get(selected_id[0])
+        if not contact: messagebox.showerror("Error", "Contact not found."); return
+        self._set_client_prospect_entry_values(contact)
+        self.edit_client_button.config(text="Save", command=lambda contact_id=contact['id']: self.save_client_prospect_edit(contact_id))
 
 
-    def save_client_prospect_edit(self, item_to_update): # item_to_update is a dict from self.clients/self.prospects
+    def save_client_prospect_edit(self, contact_id):
         new_data = self._get_client_prospect_entry_values()
         if not all(new_data.values()): messagebox.showerror("Error", "All fields required."); return
-        item_to_update.update(new_data) # Update the original dictionary in the list
-        self.update_clients_list(); self.update_prospects_list(); self.save_clients_prospects()
+        if contact_id not in self.contacts: messagebox.showerror("Error", "Contact was deleted.")
+        else:
+            contact = self.contacts.update(contact_id, new_data)
+            self.update_clients_list(); self.update_prospects_list(); self.save_clients_prospects([(self.contacts.kind_of(contact_id), contact)])
         self._clear_client_prospect_entries()
         self.update_client_dropdown(); self.update_quote_client_dropdown()
         self.edit_client_button.config(text="Edit", command=self.edit_selected_client_prospect)
@@ -783,35 +3015,39 @@ class InvoiceSystem:
         selected_id = self.clients_tree.selection() or self.prospects_tree.selection()
         if not selected_id: messagebox.showerror("Error", "Select item to delete."); return
         if messagebox.askyesno("Confirm Delete", "Delete selected item?"):
-            if self.clients_tree.selection():
-                self.clients.pop(self.clients_tree.index(selected_id[0]))
+            if selected_id[0] not in self.contacts: return
+            kind = self.contacts.kind_of(selected_id[0]); self.contacts.delete(selected_id[0])
+            if kind == 'client':
                 self.update_clients_list(); self.update_client_dropdown(); self.update_quote_client_dropdown()
             else:
-                self.prospects.pop(self.prospects_tree.index(selected_id[0]))
                 self.update_prospects_list(); self.update_quote_client_dropdown()
-            self.save_clients_prospects()
+            self.save_clients_prospects(deleted=[selected_id[0]])
 
     def update_clients_list(self):
-        self.clients_tree.delete(*self.clients_tree.get_children())
-        for client in self.clients: self.clients_tree.insert('', 'end', values=(client['name'], client['email'], client['address'], client['phone']))
+        self.clients_tree.set_keys(self.contacts.members['client'], self._contact_row_values, self.contacts.changes['client'])
 
     def update_prospects_list(self):
-        self.prospects_tree.delete(*self.prospects_tree.get_children())
-        for prospect in self.prospects: self.prospects_tree.insert('', 'end', values=(prospect['name'], prospect['email'], prospect['address'], prospect['phone']))
+        self.prospects_tree.set_keys(self.contacts.members['prospect'], self._contact_row_values, self.contacts.changes['prospect'])
+
+    def _contact_row_values(self, contact_id):
+        contact = self.contacts.get(contact_id)
+        return (contact['name'], contact['email'], contact['address'], contact['phone']) if contact else None
 
     def load_clients_prospects(self):
-        # ... (same as before)
         try:
-            if os.path.exists(CLIENTS_PROSPECTS_FILE):
-                with open(CLIENTS_PROSPECTS_FILE, 'r') as f: data = json.load(f)
-                self.clients = data.get('clients', [])
-                self.prospects = data.get('prospects', [])
-        except FileNotFoundError: self.clients, self.prospects = [], []
-        except json.JSONDecodeError: print(f"Error decoding {CLIENTS_PROSPECTS_FILE}"); self.clients, self.prospects = [], []
+            clients, prospects, self.contact_counter = self.storage.load_contacts()
+        except (json.JSONDecodeError, sqlite3.Error) as e: print(f"Error loading contacts: {e}"); clients, prospects = [], []
+        counter = assign_contact_ids(clients, prospects, self.contact_counter)
+        self.contacts = ContactDirectory(clients, prospects)
+        if counter != self.contact_counter: self.contact_counter = counter; self.save_clients_prospects()
+
 
+    def save_clients_prospects(self, changed=None, deleted=None):
+        """changed: (kind, contact) pairs; deleted: contact ids. Without either the whole store is rewritten."""
+        self.storage.save_contacts(self.contacts.clients, self.contacts.prospects, self.contact_counter, changed, deleted)
 
-    def save_clients_prospects(self):
-        with open(CLIENTS_PROSPECTS_FILE, 'w') as f: json.dump({'clients': self.clients, 'prospects': self.prospects}, f, indent=4)
+    def generate_contact_id(self):
+        self.contact_counter = self.number_allocator.next_counter('contact', self.contact_counter); return f"CONT{self.contact_counter:04d}"
 
     def create_items_tab(self):
         # items_tab_frame = ttk.Frame(self.notebook) # Already self.items_tab_frame
@@ -820,7 +3056,7 @@ class InvoiceSystem:
 
 
         price_ex_tax_header = f"Price (ex {self.app_settings.get('tax_name', 'Tax')})"
-        self.items_library_tree = ttk.Treeview(items_tab_frame, columns=('ID', 'Name', 'Description', 'Price'), show='headings')
+        self.items_library_tree = VirtualTreeview(items_tab_frame, columns=('ID', 'Name', 'Description', 'Price'))
         self.items_library_tree.heading('ID', text='ID'); self.items_library_tree.heading('Name', text='Name')
         self.items_library_tree.heading('Description', text='Description'); self.items_library_tree.heading('Price', text=price_ex_tax_header)
         for col, wid, stretch_val in [('ID', 70, tk.NO), ('Name', 200, tk.YES), ('Description', 300, tk.YES), ('Price', 100, tk.NO)]: 
@@ -862,8 +3098,8 @@ class InvoiceSystem:
         if not name or not desc: messagebox.showerror("Error", "Name/Desc required."); return
         if price < 0: messagebox.showerror("Error", "Price cannot be negative."); return
         item_id = self.generate_item_id()
-        self.items.append({'id': item_id, 'name': name, 'description': desc, 'price': price})
-        self.save_items(); self.update_items_list(); self.clear_item_entries()
+        item = self.items.append({'id': item_id, 'name': name, 'description': desc, 'price': price})
+        self.save_items(changed=[item]); self.update_items_list(); self.clear_item_entries()
         self.update_item_selection(); self.update_item_selection_quote()
 
     def edit_library_item(self):
@@ -871,7 +3107,7 @@ class InvoiceSystem:
         selected = self.items_library_tree.selection()
         if not selected: messagebox.showerror("Error", "Select item to edit."); return
         item_id_from_tree = self.items_library_tree.item(selected[0], 'values')[0]
-        item_to_edit = next((item for item in self.items if item['id'] == item_id_from_tree), None)
+        item_to_edit = self.items.get(item_id_from_tree)
         if not item_to_edit: messagebox.showerror("Error", "Item not found."); return
         
         edit_win = tk.Toplevel(self.window); edit_win.title("Edit Library Item"); edit_win.geometry("450x200"); edit_win.transient(self.window); edit_win.grab_set()
@@ -900,8 +3136,9 @@ class InvoiceSystem:
             except ValueError: messagebox.showerror("Error", "Valid price.", parent=edit_win); return
             if not name or not desc: messagebox.showerror("Error", "Name/Desc required.", parent=edit_win); return
             if price < 0: messagebox.showerror("Error", "Price >= 0.", parent=edit_win); return
-            item_to_edit.update({'name': name, 'description': desc, 'price': price})
-            self.save_items(); self.update_items_list()
+            if item_id_from_tree not in self.items: messagebox.showerror("Error", "Item was deleted.", parent=edit_win); return
+            item = self.items.update(item_id_from_tree, {'name': name, 'description': desc, 'price': price})
+            self.save_items(changed=[item]); self.update_items_list()
             self.update_item_selection(); self.update_item_selection_quote()
             edit_win.destroy()
         
@@ -915,8 +3152,8 @@ class InvoiceSystem:
         if not selected: messagebox.showerror("Error", "Please select an item to delete!"); return
         if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this item?"):
             item_id_from_tree = self.items_library_tree.item(selected[0], 'values')[0]
-            self.items = [item for item in self.items if item['id'] != item_id_from_tree]
-            self.save_items(); self.update_items_list()
+            self.items.remove_ids([item_id_from_tree])
+            self.save_items(deleted=[item_id_from_tree]); self.update_items_list()
             self.update_item_selection(); self.update_item_selection_quote()
 
 
@@ -925,28 +3162,25 @@ class InvoiceSystem:
 
     def update_items_list(self): # Item library tree
         if not hasattr(self, 'items_library_tree'): return # UI not ready
-        self.items_library_tree.delete(*self.items_library_tree.get_children())
-        currency_symbol = self._get_currency_symbol()
-        for item in self.items:
-            self.items_library_tree.insert('', 'end', values=(
-                item['id'], item['name'], item['description'], f"{currency_symbol}{item['price']:.2f}"
-            ))
+        self.items_library_tree.set_keys(self.items.by_id, self._item_row_values, self.items.changes) # Rows are formatted as they scroll into view
+
+    def _item_row_values(self, item_id):
+        item = self.items.get(item_id)
+        return (item['id'], item['name'], item['description'], f"{self._get_currency_symbol()}{price_text(to_price_units(item['price']))}") if item else None
 
     def load_items(self):
-        try:
-            if os.path.exists(ITEMS_FILE):
-                with open(ITEMS_FILE, 'r') as f: data = json.load(f)
-                self.items = data.get('items', [])
-                self.item_counter = data.get('counter', 0)
-        except FileNotFoundError: self.items, self.item_counter = [], 0
-        except json.JSONDecodeError: print(f"Error decoding {ITEMS_FILE}"); self.items, self.item_counter = [], 0
+        try: items, self.item_counter = self.storage.load_items()
+        except (json.JSONDecodeError, sqlite3.Error) as e: print(f"Error loading items: {e}"); items, self.item_counter = [], 0
+        self.items = ItemCatalog(items)
 
 
-    def save_items(self):
-        with open(ITEMS_FILE, 'w') as f: json.dump({'items': self.items, 'counter': self.item_counter}, f, indent=4)
+    def save_items(self, changed=None, deleted=None):
+        """changed: item dicts added or edited; deleted: item ids. Without either the whole store is rewritten."""
+        self.storage.save_items(self.items, self.item_counter, changed, deleted)
 
     def generate_item_id(self):
-        self.item_counter += 1; return f"ITEM{self.item_counter:04d}"
+        # Allocated through sequences.json so instances sharing the data directory never reuse an id
+        self.item_counter = self.number_allocator.next_counter('item', self.item_counter); return f"ITEM{self.item_counter:04d}"
 
 
     def create_invoice_tab(self):
@@ -973,7 +3207,7 @@ class InvoiceSystem:
         
         self.gst_var = tk.BooleanVar(value=self.app_settings.get('apply_tax_default', True))
         tax_label_text_inv = f"Include {self.app_settings.get('tax_name', 'Tax')} ({self.app_settings.get('tax_rate', 0.0):.1f}%)"
-        self.gst_check_invoice = ttk.Checkbutton(client_frame_inv, text=tax_label_text_inv, variable=self.gst_var, command=self.update_total)
+        self.gst_check_invoice = ttk.Checkbutton(client_frame_inv, text=tax_label_text_inv, variable=self.gst_var, command=lambda: self.toggle_document_tax('invoice'))
         self.gst_check_invoice.grid(row=4, column=0, columnspan=2, pady=3, sticky="w")
         
         items_section_inv = ttk.LabelFrame(invoice_frame, text="Items")
@@ -1062,7 +3296,7 @@ class InvoiceSystem:
 
         self.gst_var_quote = tk.BooleanVar(value=self.app_settings.get('apply_tax_default', True))
         tax_label_text_quo = f"Include {self.app_settings.get('tax_name', 'Tax')} ({self.app_settings.get('tax_rate', 0.0):.1f}%)"
-        self.gst_check_quote = ttk.Checkbutton(client_frame_quo, text=tax_label_text_quo, variable=self.gst_var_quote, command=self.update_total_quote)
+        self.gst_check_quote = ttk.Checkbutton(client_frame_quo, text=tax_label_text_quo, variable=self.gst_var_quote, command=lambda: self.toggle_document_tax('quote'))
         self.gst_check_quote.grid(row=4, column=0, columnspan=2, pady=3, sticky="w")
 
         items_section_quo = ttk.LabelFrame(quote_frame, text="Items")
@@ -1132,19 +3366,34 @@ class InvoiceSystem:
         # self.notebook.add(history_frame_tab, text='History')
         history_frame_tab = self.history_frame_tab
 
-        self.history_tree = ttk.Treeview(history_frame_tab, columns=('Date', 'Type', 'Client', 'Total', 'PDF Path'), show='headings')
-        for col_name in ('Date', 'Type', 'Client', 'Total', 'PDF Path'):
+        filter_frame = ttk.Frame(history_frame_tab)
+        filter_frame.pack(fill='x', padx=10, pady=(10,0))
+        self.history_filter_vars = {name: tk.StringVar(value='All' if name == 'type' else '')
+                                    for name in ('client', 'type', 'date_from', 'date_to', 'min_total', 'max_total')}
+        for label, name, width in (("Client:", 'client', 18), ("Type:", 'type', 8), ("From:", 'date_from', 11),
+                                   ("To:", 'date_to', 11), ("Min Total:", 'min_total', 9), ("Max Total:", 'max_total', 9)):
+            ttk.Label(filter_frame, text=label).pack(side='left', padx=(0,2))
+            if name == 'type': widget = ttk.Combobox(filter_frame, textvariable=self.history_filter_vars[name], values=('All', 'Invoice', 'Quote'), state='readonly', width=width)
+            else: widget = ttk.Entry(filter_frame, textvariable=self.history_filter_vars[name], width=width)
+            widget.pack(side='left', padx=(0,8))
+            self.history_filter_vars[name].trace_add('write', lambda *args: self._schedule_history_filter())
+        ttk.Button(filter_frame, text="Clear", command=self.clear_history_filters).pack(side='left')
+        self.history_filter_status = ttk.Label(filter_frame, text="")
+        self.history_filter_status.pack(side='left', padx=10)
+
+        self.history_tree = VirtualTreeview(history_frame_tab, columns=('Number', 'Date', 'Type', 'Client', 'Total', 'PDF Path'), block_rows=HISTORY_PAGE_SIZE)
+        for col_name in ('Number', 'Date', 'Type', 'Client', 'Total', 'PDF Path'):
             self.history_tree.heading(col_name, text=col_name)
             sw = self.window.winfo_screenwidth()
-            col_width = int(sw * 0.15) if col_name != 'PDF Path' else int(sw * 0.30) # PDF Path wider
+            col_width = int(sw * 0.30) if col_name == 'PDF Path' else int(sw * 0.08) if col_name == 'Number' else int(sw * 0.12) # PDF Path wider
             self.history_tree.column(col_name, width=col_width, minwidth=80, stretch=tk.YES)
-        self.history_tree.pack(expand=True, fill='both', padx=10, pady=(10,5))
-        ttk.Button(history_frame_tab, text="Open Selected PDF", command=self.open_selected_pdf).pack(pady=(5,10))
-        # self.update_history_display() # Called in __init__
-
+        self.history_tree.pack(expand=True, fill='both', padx=10, pady=(5,5))
+        history_buttons = ttk.Frame(history_frame_tab)
+        history_buttons.pack(pady=(5,10))
+        ttk.Button(history_buttons, text="Open Selected PDF", command=self.open_selected_pdf).pack(side='left', padx=5)
+        ttk.Button(history_buttons, text="Client Statement", command=self.export_client_statement).pack(side='left', padx=5)
+        # Rows are read the first time the tab is shown (on_tab_changed)
 
-    def _get_current_tax_rate_decimal(self):
-        return self.app_settings.get('tax_rate', 0.0) / 100.0
 
     def _get_currency_symbol(self):
         return self.business_details.get('currency_symbol', '$')
@@ -1152,27 +3401,22 @@ class InvoiceSystem:
     def _get_tax_name(self):
         return self.app_settings.get('tax_name', 'Tax')
 
-    def add_item_logic(self, item_selection_widget, item_quantity_widget, treeview_widget, apply_tax_var, update_total_func):
+    def add_item_logic(self, item_selection_widget, item_quantity_widget, treeview_widget, draft, apply_tax_var, update_total_func):
         # ... (same as before)
         try:
             selected_item_str = item_selection_widget.get()
             if not selected_item_str: messagebox.showerror("Error", "Please select an item!"); return
             item_id = selected_item_str.split(' - ')[0]
-            item_info = next((i for i in self.items if i['id'] == item_id), None)
+            item_info = self.items.get(item_id)
             if not item_info: messagebox.showerror("Error", "Selected item not found!"); return
             qty_str = item_quantity_widget.get()
             if not qty_str: messagebox.showerror("Error", "Please enter quantity!"); return
             qty = float(qty_str)
             if qty <= 0: messagebox.showerror("Error", "Quantity must be > 0!"); return
 
-            price_ex_tax = item_info['price']
-            tax_amount = price_ex_tax * qty * self._get_current_tax_rate_decimal() if apply_tax_var.get() else 0
-            total_inc_tax = (price_ex_tax * qty) + tax_amount
-            currency_sym = self._get_currency_symbol()
-            treeview_widget.insert('', 'end', values=(
-                item_info['id'], item_info['name'], item_info['description'], f"{qty:.2f}",
-                f"{currency_sym}{price_ex_tax:.2f}", f"{currency_sym}{tax_amount:.2f}", f"{currency_sym}{total_inc_tax:.2f}"
-            ))
+            line = LineItem(item_info['id'], item_info['name'], item_info['description'], qty, item_info['price'], apply_tax_var.get())
+            row_id = draft.add(line)
+            treeview_widget.insert('', 'end', iid=row_id, values=draft.row_values(row_id, self._get_currency_symbol()))
             update_total_func()
             item_quantity_widget.delete(0, tk.END); item_quantity_widget.insert(0,"1")
             item_selection_widget.set('')
@@ -1180,209 +3424,186 @@ class InvoiceSystem:
         except Exception as e: messagebox.showerror("Error", f"Unexpected error: {e}")
 
 
-    def add_item(self): self.add_item_logic(self.item_selection, self.item_quantity, self.items_tree, self.gst_var, self.update_total)
-    def add_item_quote(self): self.add_item_logic(self.item_selection_quote, self.item_quantity_quote, self.quote_items_tree, self.gst_var_quote, self.update_total_quote)
+    def add_item(self): self.add_item_logic(self.item_selection, self.item_quantity, self.items_tree, self.drafts['invoice'], self.gst_var, self.update_total)
+    def add_item_quote(self): self.add_item_logic(self.item_selection_quote, self.item_quantity_quote, self.quote_items_tree, self.drafts['quote'], self.gst_var_quote, self.update_total_quote)
 
     def remove_selected_item(self):
-        if self.items_tree.selection(): self.items_tree.delete(self.items_tree.selection()[0]); self.update_total()
+        if self.items_tree.selection():
+            row_id = self.items_tree.selection()[0]; self.drafts['invoice'].remove(row_id); self.items_tree.delete(row_id); self.update_total()
     def remove_selected_item_quote(self):
-        if self.quote_items_tree.selection(): self.quote_items_tree.delete(self.quote_items_tree.selection()[0]); self.update_total_quote()
+        if self.quote_items_tree.selection():
+            row_id = self.quote_items_tree.selection()[0]; self.drafts['quote'].remove(row_id); self.quote_items_tree.delete(row_id); self.update_total_quote()
+
+    def toggle_document_tax(self, doc_type):
+        # The checkbox applies to every line of the document, so their tax column is redone too
+        tax_var, tree = (self.gst_var, self.items_tree) if doc_type == 'invoice' else (self.gst_var_quote, self.quote_items_tree)
+        self.drafts[doc_type].set_taxed(tax_var.get())
+        self.repopulate_treeview_with_current_settings(tree, doc_type)
     
-    def update_total_generic(self, treeview, subtotal_label_widget, tax_label_widget, total_label_widget, tax_var_for_doc):
-        # ... (ensure font is applied to total_label_widget if needed, or handle in update_ui_for_app_settings)
-        subtotal, tax_total_for_doc = 0, 0
+    def update_total_generic(self, draft, subtotal_label_widget, tax_label_widget, total_label_widget):
         currency_sym = self._get_currency_symbol()
-        current_tax_rate_decimal = self._get_current_tax_rate_decimal()
-        for item_row_id in treeview.get_children():
-            values = treeview.item(item_row_id, 'values')
-            try:
-                price_str = values[4].replace(currency_sym, '')
-                item_price_ex_tax = float(price_str)
-                item_qty = float(values[3])
-            except (IndexError, ValueError) as e:
-                print(f"Error parsing tree values: {values} - {e}"); continue 
-            line_subtotal = item_price_ex_tax * item_qty
-            subtotal += line_subtotal
-            if tax_var_for_doc.get(): tax_total_for_doc += line_subtotal * current_tax_rate_decimal
-        total_amount = subtotal + tax_total_for_doc
-        subtotal_label_widget.config(text=f"Subtotal: {currency_sym}{subtotal:.2f}")
-        tax_label_widget.config(text=f"{self._get_tax_name()}: {currency_sym}{tax_total_for_doc:.2f}")
+        subtotal, tax_total_for_doc, total_amount = map(cents_text, draft.totals())
+        subtotal_label_widget.config(text=f"Subtotal: {currency_sym}{subtotal}")
+        tax_label_widget.config(text=f"{self._get_tax_name()}: {currency_sym}{tax_total_for_doc}")
         
         font_size = int(self.app_settings.get('font_size', 12))
-        total_label_widget.config(text=f"Total: {currency_sym}{total_amount:.2f}", font=('Helvetica', font_size + 2, 'bold')) # Apply bold here too
+        total_label_widget.config(text=f"Total: {currency_sym}{total_amount}", font=('Helvetica', font_size + 2, 'bold')) # Apply bold here too
 
 
-    def update_total(self): self.update_total_generic(self.items_tree, self.subtotal_label, self.gst_label, self.total_label, self.gst_var)
-    def update_total_quote(self): self.update_total_generic(self.quote_items_tree, self.subtotal_label_quote, self.gst_label_quote, self.total_label_quote, self.gst_var_quote)
-
-    def generate_pdf(self, data, doc_type):
-        # ... (same as before, but ensure it uses _get_tax_name() and _get_currency_symbol() for PDF content)
-        pdf_file = f"{doc_type.capitalize()}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf" # underscore in time
-        doc = SimpleDocTemplate(pdf_file, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
-        story = []
-        styles = getSampleStyleSheet()
-        font_size_pdf = 10 # Base font size for PDF
-        
-        # PDF Styles
-        title_style = ParagraphStyle('PdfTitle', parent=styles['h1'], fontSize=18, spaceAfter=0.8*cm, alignment=1, textColor=colors.HexColor("#002b36"))
-        heading_style = ParagraphStyle('PdfHeading', parent=styles['h2'], fontSize=font_size_pdf + 2, spaceBefore=0.4*cm, spaceAfter=0.15*cm, textColor=colors.HexColor("#268bd2"))
-        normal_style = ParagraphStyle('PdfNormal', parent=styles['Normal'], fontSize=font_size_pdf, leading=font_size_pdf+2)
-        normal_bold_style = ParagraphStyle('PdfNormalBold', parent=normal_style, fontName='Helvetica-Bold')
-        table_header_style = ParagraphStyle('PdfTableHeader', parent=normal_bold_style, alignment=1, textColor=colors.whitesmoke)
-        table_cell_style = ParagraphStyle('PdfTableCell', parent=normal_style, alignment=0) # Left default
-        table_cell_right_style = ParagraphStyle('PdfTableCellRight', parent=table_cell_style, alignment=2) # Right
-
-        # --- Header ---
-        story.append(Paragraph(f"{self.business_details.get('name', 'Your Business Name')}", title_style)) # Use title style for business name
-        story.append(Paragraph(f"{self.business_details.get('address', 'Your Address')}", normal_style))
-        if self.business_details.get('phone'): story.append(Paragraph(f"Phone: {self.business_details['phone']}", normal_style))
-        if self.business_details.get('email'): story.append(Paragraph(f"Email: {self.business_details['email']}", normal_style))
-        tax_id_label_pdf = DEFAULT_COUNTRY_DATA.get(self.app_settings.get('selected_country'), {}).get('tax_id_label', 'Tax ID')
-        tax_id_value_pdf = self.business_details.get('tax_identifier_value', '')
-        if tax_id_value_pdf: story.append(Paragraph(f"{tax_id_label_pdf}: {tax_id_value_pdf}", normal_style))
-        story.append(Spacer(1, 0.8*cm))
-
-        story.append(Paragraph(f"<b>{doc_type.capitalize()}</b>", ParagraphStyle('DocTypeTitle', fontSize=16, alignment=0, spaceAfter=0.2*cm)))
-        story.append(Paragraph(f"Date: {datetime.now().strftime('%d %B %Y')}", normal_style))
-        story.append(Spacer(1, 0.5*cm))
-
-        story.append(Paragraph("Bill To:", heading_style))
-        story.append(Paragraph(f"{data['client_name']}", normal_bold_style))
-        story.append(Paragraph(f"{data['client_address']}", normal_style))
-        story.append(Paragraph(f"{data['client_email']}", normal_style))
-        story.append(Spacer(1, 0.8*cm))
-
-        currency_sym_pdf = self._get_currency_symbol()
-        tax_name_pdf = self._get_tax_name()
-        item_data_for_pdf = [[
-            Paragraph("Description", table_header_style), Paragraph("Qty", table_header_style),
-            Paragraph(f"Unit Price ({currency_sym_pdf})", table_header_style),
-            Paragraph(f"{tax_name_pdf} ({currency_sym_pdf})", table_header_style),
-            Paragraph(f"Total ({currency_sym_pdf})", table_header_style)
-        ]]
-        for item_values in data['items']: # item_id, name, description, qty, price_str, tax_str, total_str
-            desc_text = f"<b>{item_values[1]}</b><br/><font size='{font_size_pdf-1}'>{item_values[2]}</font>"
-            item_data_for_pdf.append([
-                Paragraph(desc_text, table_cell_style), Paragraph(str(item_values[3]), table_cell_right_style),
-                Paragraph(item_values[4].replace(currency_sym_pdf, ''), table_cell_right_style),
-                Paragraph(item_values[5].replace(currency_sym_pdf, ''), table_cell_right_style),
-                Paragraph(item_values[6].replace(currency_sym_pdf, ''), table_cell_right_style)
-            ])
-
-        page_width = A4[0] - 3*cm # margins
-        col_widths = [page_width*0.40, page_width*0.10, page_width*0.18, page_width*0.12, page_width*0.20]
-        
-        table = Table(item_data_for_pdf, colWidths=col_widths, repeatRows=1)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#268bd2")), # Header background
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, 0), 'CENTER'), # Header text center
-            ('ALIGN', (0, 1), (0, -1), 'LEFT'),   # Description left
-            ('ALIGN', (1, 1), (-1, -1), 'RIGHT'), # Other columns right
-            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-            ('TOPPADDING', (0, 0), (-1, 0), 8),
-            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
-            ('INNERGRID', (0,0), (-1,-1), 0.25, colors.lightgrey)
-        ]))
-        story.append(table)
-        story.append(Spacer(1, 0.5*cm))
-
-        totals_style_right = ParagraphStyle('TotalsRight', parent=normal_style, alignment=2)
-        totals_bold_style_right = ParagraphStyle('TotalsBoldRight', parent=normal_bold_style, alignment=2)
-        story.append(Paragraph(f"Subtotal: {currency_sym_pdf}{data['subtotal']}", totals_style_right))
-        story.append(Paragraph(f"{tax_name_pdf}: {currency_sym_pdf}{data['tax']}", totals_style_right))
-        story.append(Paragraph(f"<b>Total: {currency_sym_pdf}{data['total']}</b>", ParagraphStyle('TotalAmountPdf', parent=totals_bold_style_right, fontSize=font_size_pdf+2)))
-        story.append(Spacer(1, 0.8*cm))
-
-        if doc_type == 'invoice':
-            story.append(Paragraph("Payment Details:", heading_style))
-            if self.business_details.get('bank'): story.append(Paragraph(f"Bank: {self.business_details['bank']}", normal_style))
-            if self.business_details.get('bsb'): story.append(Paragraph(f"BSB: {self.business_details['bsb']}", normal_style))
-            if self.business_details.get('account'): story.append(Paragraph(f"Account No: {self.business_details['account']}", normal_style))
-            story.append(Spacer(1, 0.5*cm))
-        if self.business_details.get('invoice_terms'):
-            story.append(Paragraph("Terms & Conditions:", heading_style))
-            story.append(Paragraph(self.business_details['invoice_terms'].replace('\n', '<br/>\n'), normal_style))
-        try: doc.build(story); return pdf_file
-        except Exception as e: messagebox.showerror("PDF Error", f"Failed: {e}"); return None
-
+    def update_total(self): self.update_total_generic(self.drafts['invoice'], self.subtotal_label, self.gst_label, self.total_label)
+    def update_total_quote(self): self.update_total_generic(self.drafts['quote'], self.subtotal_label_quote, self.gst_label_quote, self.total_label_quote)
 
     def save_document(self, doc_type):
         # ... (same as before)
-        items_list_for_pdf = []
-        tree = self.items_tree if doc_type == 'invoice' else self.quote_items_tree
+        draft = self.drafts[doc_type]
         client_name_widget = self.client_name if doc_type == 'invoice' else self.quote_client_name
         client_email_widget = self.client_email if doc_type == 'invoice' else self.quote_client_email
         client_address_widget = self.client_address if doc_type == 'invoice' else self.quote_client_address
-        tax_var_for_doc = self.gst_var if doc_type == 'invoice' else self.gst_var_quote
 
         if not client_name_widget.get(): messagebox.showerror("Error", "Client Name is required."); return
 
-        subtotal_val, tax_val = 0, 0
         currency_sym = self._get_currency_symbol()
-        current_tax_rate_decimal = self._get_current_tax_rate_decimal()
-
-        for item_row_id in tree.get_children():
-            values = list(tree.item(item_row_id, 'values')) # Make a mutable copy
-            items_list_for_pdf.append(values)
-            try:
-                price_ex_tax_numeric = float(values[4].replace(currency_sym, ''))
-                qty_numeric = float(values[3])
-            except (IndexError, ValueError) as e:
-                print(f"Error parsing values for PDF total: {values} - {e}"); continue
-            line_subtotal = price_ex_tax_numeric * qty_numeric
-            subtotal_val += line_subtotal
-            if tax_var_for_doc.get(): tax_val += line_subtotal * current_tax_rate_decimal
-        total_val = subtotal_val + tax_val
+        items_list_for_pdf = draft.rows(currency_sym)
+        subtotal_val, tax_val, total_val = map(cents_text, draft.totals())
 
         data_for_pdf = {
             'client_name': client_name_widget.get(), 'client_email': client_email_widget.get(),
             'client_address': client_address_widget.get(), 'items': items_list_for_pdf,
-            'subtotal': f"{subtotal_val:.2f}", 'tax': f"{tax_val:.2f}", 'total': f"{total_val:.2f}"
+            'subtotal': subtotal_val, 'tax': tax_val, 'total': total_val
         }
-        pdf_file = self.generate_pdf(data_for_pdf, doc_type)
-        if pdf_file:
-            messagebox.showinfo("PDF Generated", f"{doc_type.capitalize()} PDF: {pdf_file}.")
+        client_name = client_name_widget.get()
+        key = self.render_cache.key_for(data_for_pdf, doc_type, self.business_details, self.app_settings) if self.render_cache else None
+        number = self.render_cache.lookup(key) if key else None
+        if number: # Already issued with this content: hand back that document rather than a duplicate under a new number
+            pdf_file = document_pdf_path(doc_type, number)
+            if not os.path.exists(pdf_file): self.render_cache.fetch(key, pdf_file)
+            self.update_render_cache_stats()
+            messagebox.showinfo("PDF Generated", f"Identical to {doc_type} {number}, which was reused: {pdf_file}."); return
+        number = self.number_allocator.allocate(doc_type)[0]
+        data_for_pdf['number'] = number
+
+        def _on_rendered(pdf_file, error):
+            if error:
+                self.add_to_history(void_history_entry(doc_type, number, client_name, str(error)))
+                self.update_history_display()
+                if isinstance(error, RenderCancelled): return # Closing; the void entry is all that is needed
+                messagebox.showerror("PDF Error", f"Failed: {error}\n{number} has been recorded as void."); return
+            messagebox.showinfo("PDF Generated", f"{doc_type.capitalize()} {number} PDF: {pdf_file}.")
             history_entry = {
                 'date': datetime.now().strftime('%Y-%m-%d %H:%M'), 'type': doc_type.capitalize(),
-                'client': client_name_widget.get(), 'total': f"{currency_sym}{total_val:.2f}",
-                'pdf_path': os.path.abspath(pdf_file)
+                'client': client_name, 'total': float(total_val), 'currency': currency_sym,
+                'pdf_path': os.path.abspath(pdf_file), 'number': number
             }
-            self.add_to_history(history_entry) # This calls save_history_data
+            try: self.storage.save_documents({number: data_for_pdf}) # Lets statements re-render the document
+            except Exception as e: print(f"Error saving {number}: {e}")
+            self.add_to_history(history_entry) # Appended to the storage backend
             self.update_history_display()
+            self.update_render_cache_stats()
 
+        # Rendered off the main thread; the form stays usable for the next document meanwhile
+        self.render_queue.submit(data_for_pdf, doc_type, self.business_details, self.app_settings, _on_rendered,
+                                 cache=self.render_cache, pdf_file=document_pdf_path(doc_type, number))
 
-    def add_to_history(self, entry):
-        self.history_records.append(entry)
-        self.save_history_data()
-
-    def load_history_data(self):
-        try:
-            if os.path.exists(HISTORY_DATA_FILE):
-                with open(HISTORY_DATA_FILE, 'r') as f: self.history_records = json.load(f)
-            else: self.history_records = []
-        except Exception as e: print(f"Error loading history: {e}"); self.history_records = []
 
-    def save_history_data(self):
-        try:
-            with open(HISTORY_DATA_FILE, 'w') as f: json.dump(self.history_records, f, indent=4)
+    def add_to_history(self, entry):
+        try: self.storage.append_history([entry])
         except Exception as e: print(f"Error saving history: {e}")
 
+    def on_tab_changed(self, event=None):
+        if not self.history_loaded and self.notebook.select() == str(self.history_frame_tab):
+            self.history_loaded = True; self.update_history_display()
+
+    @staticmethod
+    def _history_row_values(entry):
+        doc_type_text = entry['type'] + (' (Void)' if entry.get('status') == 'Void' else '')
+        return (entry.get('number', ''), entry['date'], doc_type_text, entry['client'], history_total_text(entry), entry['pdf_path'])
+
+    def _history_filters(self):
+        """HistoryIndex.query() arguments for the History filters, or None if none is set. Dates are
+        YYYY-MM-DD; a field that doesn't parse (yet) is left out."""
+        values = {name: var.get().strip() for name, var in self.history_filter_vars.items()}
+        filters = {}
+        if values['client']: filters['client'] = values['client']
+        if values['type'] != 'All': filters['doc_type'] = values['type']
+        for name, end in (('date_from', '0000'), ('date_to', '2359')):
+            try: filters[name] = history_date_key(datetime.strptime(values[name], '%Y-%m-%d').strftime('%Y-%m-%d ') + end)
+            except ValueError: pass
+        for name in ('min_total', 'max_total'):
+            try: filters[name] = float(values[name].lstrip(self._get_currency_symbol()))
+            except ValueError: pass
+        return filters or None
+
+    def _schedule_history_filter(self):
+        if self._history_filter_job: self.window.after_cancel(self._history_filter_job)
+        self._history_filter_job = self.window.after(SearchableCombobox.DEBOUNCE_MS, self._apply_history_filters)
+
+    def _apply_history_filters(self):
+        self._history_filter_job = None; self.update_history_display()
+
+    def clear_history_filters(self):
+        for name, var in self.history_filter_vars.items(): var.set('All' if name == 'type' else '')
+
+    def _continue_history_index(self):
+        self._history_index_job = None; self.update_history_display()
+
     def update_history_display(self):
-        if not hasattr(self, 'history_tree'): return
-        self.history_tree.delete(*self.history_tree.get_children())
-        for entry in reversed(self.history_records): # Newest first
-            self.history_tree.insert('', 'end', values=(
-                entry['date'], entry['type'], entry['client'], entry['total'], entry['pdf_path']
-            ))
+        """Point the History tab at the stored history, newest first, or at the records matching its
+        filters. Only the rows in view are read. Filtering goes through a HistoryIndex, built a chunk
+        per event-loop turn the first time and brought up to date with new records after that."""
+        if not hasattr(self, 'history_tree') or not self.history_loaded or self._history_index_job: return
+        filters = self._history_filters()
+        same_view, self.history_filters_shown = filters == self.history_filters_shown, filters
+        try:
+            total = self.storage.history_count()
+            if filters and (self.history_index is None or not self.history_index.is_current(self.storage)): self.history_index = HistoryIndex() # New, or rewritten
+            if filters and not self.history_index.build(self.storage):
+                self.history_filters_shown = None # Shown once indexing is done
+                self.history_filter_status.config(text=f"Indexing history... {len(self.history_index):,} of {total:,}")
+                self._history_index_job = self.window.after(1, self._continue_history_index); return
+        except Exception as e: print(f"Error loading history: {e}"); return
+        if not filters:
+            self.history_filter_status.config(text="")
+            # Keys count from the oldest record, so they stay put as records are added; so does a scrolled view
+            offset = self.history_tree.offset + total - self.history_tree.total if same_view and self.history_tree.offset else 0
+            def _fetch(start, count):
+                return [(f"H{total - 1 - start - n}", self._history_row_values(entry)) for n, entry in enumerate(self.storage.history_page(start, count))]
+            self.history_tree.set_source(lambda: total, _fetch, offset)
+            return
+        matches, keys = self.history_index.query(**filters), self.history_index.keys
+        self.history_filter_status.config(text=f"{len(matches):,} of {len(keys):,} documents")
+        def _fetch_matches(start, count):
+            positions = [int(matches[len(matches) - 1 - n]) for n in range(start, min(start + count, len(matches)))] # Newest first
+            return [(f"H{p}", self._history_row_values(entry)) for p, entry in zip(positions, self.storage.history_records([keys[p] for p in positions]))]
+        self.history_tree.set_source(lambda: len(matches), _fetch_matches, None if same_view else 0)
+
+    def export_client_statement(self):
+        selected = self.history_tree.selection()
+        if not selected: messagebox.showerror("Error", "Select a document to export its client's statement."); return
+        client = self.history_tree.item(selected[0], 'values')[3]
+        safe_client = ''.join(ch if ch.isalnum() else '_' for ch in client)
+        pdf_file = unique_pdf_path(f"Statement_{safe_client}")
+        business_details, app_settings = dict(self.business_details), dict(self.app_settings)
+        count = 0
+        def _counted(records):
+            nonlocal count
+            for record in records: count += 1; yield record
+        def _build():
+            # The history is streamed on the render worker, through a storage handle of its own (SQLite connections belong to one thread)
+            storage = open_storage(app_settings)
+            try: build_statement(_counted(filter_history_records(storage.iter_history(), client=client)), pdf_file,
+                                 business_details, app_settings, f"Statement - {client}", storage.document_data)
+            finally: storage.close()
+        def _on_done(pdf_file, error):
+            if isinstance(error, RenderCancelled): return
+            if error: messagebox.showerror("PDF Error", f"Failed: {error}"); return
+            messagebox.showinfo("Statement Generated", f"Statement for {client} ({count} documents): {pdf_file}.")
+        self.render_queue.submit_task(f"Statement for {client}", pdf_file, _build, _on_done)
 
     def open_selected_pdf(self):
         # ... (same as before)
         selected = self.history_tree.selection()
         if selected:
-            pdf_file_path = self.history_tree.item(selected[0], 'values')[4]
+            pdf_file_path = self.history_tree.item(selected[0], 'values')[5]
             if os.path.exists(pdf_file_path):
                 try:
                     if sys.platform == "win32": os.startfile(pdf_file_path)
@@ -1393,19 +3614,19 @@ class InvoiceSystem:
 
     def update_client_dropdown(self):
         if hasattr(self, 'client_dropdown'):
-            self.client_dropdown['values'] = sorted([c['name'] for c in self.clients])
+            self.client_dropdown['values'] = sorted([c['name'] for c in self.contacts.clients])
             self.client_var.set('')
 
     def update_quote_client_dropdown(self):
         if hasattr(self, 'quote_client_dropdown'):
-            all_contacts = [c['name'] for c in self.clients] + [p['name'] for p in self.prospects]
-            self.quote_client_dropdown['values'] = sorted(list(set(all_contacts)))
+            self.quote_client_dropdown['values'] = sorted({c['name'] for c in self.contacts.by_id.values()})
             self.quote_client_var.set('')
 
     def on_client_selected(self, event):
         # ... (same as before)
         name = self.client_var.get()
-        client = next((c for c in self.clients if c['name'] == name), None)
+        matches = self.contacts.find_by_name(name, 'client')
+        client = next((c for c in matches if c['name'] == name), matches[0] if matches else None)
         if client:
             self.client_name.delete(0, tk.END); self.client_name.insert(0, client['name'])
             self.client_email.delete(0, tk.END); self.client_email.insert(0, client['email'])
@@ -1415,60 +3636,56 @@ class InvoiceSystem:
     def on_quote_client_selected(self, event):
         # ... (same as before)
         name = self.quote_client_var.get()
-        contact = next((c for c in self.clients if c['name'] == name), None) or \
-                  next((p for p in self.prospects if p['name'] == name), None)
+        matches = sorted(self.contacts.find_by_name(name), key=lambda c: (c['name'] != name, self.contacts.kind_of(c['id']) != 'client'))
+        contact = matches[0] if matches else None # Exact spelling first, then clients before prospects
         if contact:
             self.quote_client_name.delete(0, tk.END); self.quote_client_name.insert(0, contact['name'])
             self.quote_client_email.delete(0, tk.END); self.quote_client_email.insert(0, contact['email'])
             self.quote_client_address.delete(0, tk.END); self.quote_client_address.insert(0, contact['address'])
 
 
-    def edit_item_in_doc_tree(self, tree, apply_tax_var, update_total_func):
-        # ... (same as before)
+    def edit_item_in_doc_tree(self, tree, draft, update_total_func):
         selected = tree.selection()
         if not selected: messagebox.showerror("Error", "Select item to edit quantity."); return
-        values = tree.item(selected[0], 'values')
-        item_id, item_name, item_desc, current_qty_str = values[0], values[1], values[2], values[3]
+        if selected[0] not in draft.row_index: return
+        line = draft.line(selected[0])
         edit_win = tk.Toplevel(self.window); edit_win.title("Edit Item Quantity"); edit_win.geometry("350x150"); edit_win.transient(self.window); edit_win.grab_set()
         
         theme_colors = DARK_THEME if self.app_settings.get('theme') == 'Dark' else LIGHT_THEME
         edit_win.configure(bg=theme_colors["bg"])
 
-        ttk.Label(edit_win, text=f"Item: {item_name[:30]}...").grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
+        ttk.Label(edit_win, text=f"Item: {line.name[:30]}...").grid(row=0, column=0, columnspan=2, padx=5, pady=5, sticky="w")
         ttk.Label(edit_win, text="New Quantity:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
-        qty_entry = ttk.Entry(edit_win, width=10); qty_entry.grid(row=1, column=1, padx=5, pady=5, sticky="w"); qty_entry.insert(0, current_qty_str); qty_entry.select_range(0, tk.END); qty_entry.focus_set()
+        qty_entry = ttk.Entry(edit_win, width=10); qty_entry.grid(row=1, column=1, padx=5, pady=5, sticky="w"); qty_entry.insert(0, f"{line.qty:.2f}"); qty_entry.select_range(0, tk.END); qty_entry.focus_set()
         def _save():
             try:
                 new_qty = float(qty_entry.get())
                 if new_qty <= 0: messagebox.showerror("Error", "Quantity must be > 0!", parent=edit_win); return
-                original_item_info = next((i for i in self.items if i['id'] == item_id), None)
-                if not original_item_info: messagebox.showerror("Error", "Base item not in library!", parent=edit_win); return
-                price_ex_tax = original_item_info['price']
-                tax_amount = price_ex_tax * new_qty * self._get_current_tax_rate_decimal() if apply_tax_var.get() else 0
-                total_inc_tax = (price_ex_tax * new_qty) + tax_amount
-                currency_sym = self._get_currency_symbol()
-                tree.item(selected[0], values=(
-                    item_id, item_name, item_desc, f"{new_qty:.2f}", f"{currency_sym}{price_ex_tax:.2f}",
-                    f"{currency_sym}{tax_amount:.2f}", f"{currency_sym}{total_inc_tax:.2f}"
-                ))
+                if selected[0] not in draft.row_index: edit_win.destroy(); return # Removed meanwhile
+                draft.set_qty(selected[0], new_qty)
+                tree.item(selected[0], values=draft.row_values(selected[0], self._get_currency_symbol()))
                 update_total_func(); edit_win.destroy()
             except ValueError: messagebox.showerror("Error", "Valid quantity required!", parent=edit_win)
         ttk.Button(edit_win, text="Save Changes", command=_save).grid(row=2, column=0, columnspan=2, pady=10)
 
 
-    def edit_invoice_item(self, event=None): self.edit_item_in_doc_tree(self.items_tree, self.gst_var, self.update_total)
-    def edit_quote_item(self, event=None): self.edit_item_in_doc_tree(self.quote_items_tree, self.gst_var_quote, self.update_total_quote)
+    def edit_invoice_item(self, event=None): self.edit_item_in_doc_tree(self.items_tree, self.drafts['invoice'], self.update_total)
+    def edit_quote_item(self, event=None): self.edit_item_in_doc_tree(self.quote_items_tree, self.drafts['quote'], self.update_total_quote)
+
+    def _item_choices(self):
+        # One search index for both item comboboxes, rebuilt only when the choices changed
+        items = sorted([f"{i['id']} - {i['name']}" for i in self.items])
+        if getattr(self, 'item_choices', None) is None or self.item_choices.values != items: self.item_choices = SearchIndex(items)
+        return self.item_choices
 
     def update_item_selection(self):
         if hasattr(self, 'item_selection'):
-            items = sorted([f"{i['id']} - {i['name']}" for i in self.items])
-            self.item_selection.configure(values=items)
+            self.item_selection.configure(values=self._item_choices())
             self.item_selection.set('')
 
     def update_item_selection_quote(self):
         if hasattr(self, 'item_selection_quote'):
-            items = sorted([f"{i['id']} - {i['name']}" for i in self.items])
-            self.item_selection_quote.configure(values=items)
+            self.item_selection_quote.configure(values=self._item_choices())
             self.item_selection_quote.set('')
 
     def create_new_item(self): # Modal for creating a library item
@@ -1495,8 +3712,8 @@ class InvoiceSystem:
             if not name or not desc: messagebox.showerror("Error", "Name/Desc required!", parent=edit_win); return
             if price < 0: messagebox.showerror("Error", "Price >= 0!", parent=edit_win); return
             item_id = self.generate_item_id()
-            self.items.append({'id': item_id, 'name': name, 'description': desc, 'price': price})
-            self.save_items(); self.update_items_list()
+            item = self.items.append({'id': item_id, 'name': name, 'description': desc, 'price': price})
+            self.save_items(changed=[item]); self.update_items_list()
             self.update_item_selection(); self.update_item_selection_quote()
             edit_win.destroy()
         
@@ -1582,9 +3799,493 @@ For any issues or questions, please create a ticket on GitHub.
         frame.columnconfigure(0, weight=1)
         frame.rowconfigure(1, weight=1)
 
+    def on_close(self):
+        pending = self.render_queue.pending_count()
+        if pending and not messagebox.askyesno("Rendering in Progress", f"{pending} document(s) are still rendering. Quit anyway? Documents not yet started are cancelled and their numbers recorded as void."):
+            return
+        if pending: self.render_queue.cancel_pending()
+        self.storage.close(); self.writer.close()
+        self.window.destroy()
+
     def run(self):
         self.window.mainloop()
 
-if __name__ == "__main__":
+# --- Headless Batch Mode ---
+def load_headless_state():
+    """Read app settings, business details, contacts and the item library from the same files the GUI uses."""
+    app_settings = dict(DEFAULT_APP_SETTINGS)
+    if os.path.exists(APP_CONFIG_FILE):
+        with open(APP_CONFIG_FILE, 'r') as f: loaded_settings = json.load(f)
+        for key, default_value in app_settings.items(): app_settings[key] = loaded_settings.get(key, default_value)
+    business_details = {
+        'name': '', 'address': '', 'phone': '', 'email': '',
+        'tax_identifier_value': '', 'bank': '', 'bsb': '', 'account': '',
+        'logo': '', 'invoice_terms': '',
+        'currency_symbol': DEFAULT_COUNTRY_DATA.get(app_settings['selected_country'], DEFAULT_COUNTRY_DATA['Custom'])['currency_symbol']
+    }
+    if os.path.exists(BUSINESS_DETAILS_FILE):
+        with open(BUSINESS_DETAILS_FILE, 'r') as f: loaded_details = json.load(f)
+        for key, default_value in business_details.items(): business_details[key] = loaded_details.get(key, default_value)
+    storage = open_storage(app_settings)
+    clients, prospects, counter = storage.load_contacts()
+    assign_contact_ids(clients, prospects, counter) # Older files have contacts without ids; these stay in memory
+    contacts = ContactDirectory(clients, prospects)
+    items = {i['id']: i for i in storage.load_items()[0]}
+    storage.close()
+    return app_settings, business_details, contacts, items
+
+
+def read_batch_manifest(path):
+    """Return a list of document specs from a JSON or CSV manifest.
+
+    JSON: a list (or {"documents": [...]}) of objects with doc_type, client_name, optional client_email,
+    client_address and apply_tax, and items as [{"id": "ITEM0001", "qty": 2}] or
+    [{"name": ..., "description": ..., "price": ..., "qty": ...}] for ad-hoc lines.
+    CSV: one row per line item with the same column names plus a doc_ref column grouping rows into documents.
+    """
+    if path.lower().endswith('.csv'):
+        documents, by_ref = [], {}
+        with open(path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                ref = row.get('doc_ref') or str(len(by_ref))
+                if ref not in by_ref:
+                    by_ref[ref] = {key: row[key] for key in ('doc_type', 'client_name', 'client_email', 'client_address', 'apply_tax') if row.get(key)}
+                    by_ref[ref]['items'] = []
+                    documents.append(by_ref[ref])
+                line = {key: row[key] for key in ('id', 'name', 'description', 'price', 'qty') if row.get(key)}
+                if 'item_id' in row and row['item_id']: line['id'] = row['item_id']
+                by_ref[ref]['items'].append(line)
+        for doc in documents:
+            if 'apply_tax' in doc: doc['apply_tax'] = doc['apply_tax'].strip().lower() in ('1', 'true', 'yes', 'y')
+        return documents
+    with open(path, 'r') as f: data = json.load(f)
+    return data.get('documents', []) if isinstance(data, dict) else data
+
+
+def build_batch_document(spec, app_settings, business_details, contacts, items):
+    """Turn a manifest spec into the data_for_pdf dict that save_document would have produced."""
+    doc_type = spec.get('doc_type', 'invoice').lower()
+    if doc_type not in ('invoice', 'quote'): raise ValueError(f"Unknown doc_type '{doc_type}'")
+    client_name = spec.get('client_name', '').strip()
+    if not client_name: raise ValueError("client_name is required")
+    # By name (clients before prospects), else by the manifest's email
+    matches = contacts.find_by_name(client_name, 'client') or contacts.find_by_name(client_name) or contacts.find_by_email(spec.get('client_email', ''))
+    contact = matches[0] if matches else {}
+    apply_tax = spec.get('apply_tax', app_settings.get('apply_tax_default', True))
+    currency_sym = business_details.get('currency_symbol', '$')
+
+    draft = DocumentDraft(app_settings.get('tax_rate', 0.0), app_settings.get('tax_rounding', 'document'))
+    for line in spec.get('items', []):
+        qty = float(line.get('qty', 1))
+        if qty <= 0: raise ValueError(f"Quantity must be > 0 (got {qty})")
+        if 'id' in line and line['id'] in items: item_info = items[line['id']]
+        elif 'id' in line and 'price' not in line: raise ValueError(f"Item '{line['id']}' not found in {ITEMS_FILE}")
+        else: item_info = {'id': line.get('id', ''), 'name': line.get('name', ''), 'description': line.get('description', ''), 'price': float(line['price'])}
+        draft.add(LineItem(item_info['id'], item_info['name'], item_info['description'], qty, item_info['price'], apply_tax))
+    subtotal_val, tax_val, total_val = map(cents_text, draft.totals())
+    data = {
+        'client_name': client_name,
+        'client_email': spec.get('client_email', contact.get('email', '')),
+        'client_address': spec.get('client_address', contact.get('address', '')),
+        'items': draft.rows(currency_sym), 'subtotal': subtotal_val, 'tax': tax_val, 'total': total_val
+    }
+    return doc_type, data
+
+
+def _render_batch_job(job):
+    # Runs in a worker process; must stay a module-level function so it can be pickled.
+    index, data, doc_type, business_details, app_settings, pdf_file = job
+    started = time.perf_counter()
+    try:
+        render_pdf(data, doc_type, business_details, app_settings, pdf_file)
+        return index, pdf_file, time.perf_counter() - started, None
+    except Exception as e:
+        return index, pdf_file, time.perf_counter() - started, str(e)
+
+
+def run_batch(manifest_path, workers=None, output_dir='.'):
+    """Render every document in a manifest across a process pool and record them in history with one write."""
+    app_settings, business_details, contacts, items = load_headless_state()
+    specs = read_batch_manifest(manifest_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs, failures, documents = [], 0, []
+    for index, spec in enumerate(specs):
+        try: documents.append((index,) + build_batch_document(spec, app_settings, business_details, contacts, items))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[{index + 1}/{len(specs)}] skipped: {e}"); failures += 1
+    # One contiguous block per document type, reserved up front and handed to workers with each job
+    allocator = DocumentNumberAllocator()
+    blocks = {doc_type: iter(allocator.allocate(doc_type, sum(1 for d in documents if d[1] == doc_type)))
+              for doc_type in sorted({d[1] for d in documents})}
+    for index, doc_type, data in documents:
+        data['number'] = next(blocks[doc_type])
+        jobs.append((index, data, doc_type, business_details, app_settings, document_pdf_path(doc_type, data['number'], output_dir)))
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Rendering {len(jobs)} document(s) with {workers} worker process(es)...")
+    jobs_by_index = {job[0]: job for job in jobs}
+    history_entries = {}
+    def _record(result):
+        index, pdf_file, elapsed, error = result
+        _, data, doc_type, _, _, _ = jobs_by_index[index]
+        if error:
+            print(f"[{index + 1}/{len(specs)}] FAILED after {elapsed:.3f}s: {error} ({data['number']} recorded as void)")
+            history_entries[index] = void_history_entry(doc_type, data['number'], data['client_name'], error)
+            return
+        print(f"[{index + 1}/{len(specs)}] {pdf_file} in {elapsed:.3f}s")
+        history_entries[index] = {
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M'), 'type': doc_type.capitalize(),
+            'client': data['client_name'], 'total': float(data['total']), 'currency': business_details.get('currency_symbol', '$'),
+            'pdf_path': os.path.abspath(pdf_file), 'number': data['number']
+        }
+    started = time.perf_counter()
+    futures = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_render_batch_job, job) for job in jobs]
+            try:
+                for future in as_completed(futures): _record(future.result())
+            except BaseException:
+                for future in futures: future.cancel() # Don't start the rest; they are recorded as void below
+                raise
+    finally:
+        # A broken pool (a worker killed) or Ctrl-C still records what finished, and voids the numbers of the rest
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is None and future.result()[0] not in history_entries:
+                _record(future.result())
+        for index, data, doc_type, _, _, _ in jobs:
+            if index not in history_entries:
+                history_entries[index] = void_history_entry(doc_type, data['number'], data['client_name'], "Batch stopped before this document was rendered")
+        if history_entries:
+            storage = open_storage(app_settings)
+            storage.save_documents({jobs_by_index[i][1]['number']: jobs_by_index[i][1] for i, entry in history_entries.items() if entry.get('status') != 'Void'})
+            storage.append_history([history_entries[i] for i in sorted(history_entries)]) # Manifest order, one write
+            storage.close()
+    wall = time.perf_counter() - started
+
+    rendered = sum(1 for entry in history_entries.values() if entry.get('status') != 'Void')
+    failures += len(history_entries) - rendered
+    rate = rendered / wall if wall > 0 else 0.0
+    print(f"Done: {rendered} rendered, {failures} failed in {wall:.2f}s ({rate:.1f} docs/s)")
+    return 1 if failures else 0
+
+
+def run_statement(client=None, date_from=None, date_to=None, pdf_file=None):
+    app_settings, business_details, _, _ = load_headless_state()
+    storage = open_storage(app_settings)
+    title = "Statement" + (f" - {client}" if client else "")
+    if date_from or date_to: title += f" ({date_from or '...'} to {date_to or '...'})"
+    pdf_file = pdf_file or unique_pdf_path('Statement')
+    started = time.perf_counter()
+    build_statement(filter_history_records(storage.iter_history(), client, date_from, date_to), pdf_file, business_details, app_settings, title,
+                    storage.document_data)
+    storage.close()
+    print(f"Wrote {pdf_file} in {time.perf_counter() - started:.2f}s")
+    return 0
+
+
+# --- Backups ---
+# A backup repository stores every file as a list of content-defined chunks, each kept once under its
+# SHA-256 (zlib-compressed) in chunks/. A snapshot is a small JSON manifest in snapshots/ listing the
+# files and their chunk hashes. Files whose size and mtime match the previous snapshot reuse its chunk
+# list without being read, and an edit inside a file only produces new chunks around the edit, so a
+# backup costs time and space in proportion to what changed.
+BACKUP_DATA_FILES = (APP_CONFIG_FILE, BUSINESS_DETAILS_FILE, CLIENTS_PROSPECTS_FILE, ITEMS_FILE, HISTORY_DATA_FILE,
+                     HISTORY_JOURNAL_FILE, HISTORY_JOURNAL_FILE + '.compacting', HISTORY_GENERATION_FILE, SEQUENCES_FILE, SQLITE_DB_FILE)
+CHUNK_MIN, CHUNK_AVG_BITS, CHUNK_MAX = 2048, 13, 65536 # ~8 KB average chunks
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([b])).digest()[:8], 'little') for b in range(256)] # Fixed, so boundaries never move between runs
+
+CHUNK_SCAN_BLOCK = 1 << 20 # Bytes hashed per NumPy pass, bounding its temporary arrays
+
+def _boundary_candidates(data):
+    """Every position whose last CHUNK_AVG_BITS bytes give a gear hash ending in CHUNK_AVG_BITS zero bits,
+    as a NumPy array. Only those bytes reach the masked bits, so this is iter_chunks' boundary test
+    wherever the hash has run that long, worked out for all positions at once."""
+    mask, gear, found = (1 << CHUNK_AVG_BITS) - 1, np.array(_GEAR, dtype=np.uint64).astype(np.uint32), []
+    for block_start in range(0, len(data), CHUNK_SCAN_BLOCK):
+        first = max(block_start - CHUNK_AVG_BITS + 1, 0) # Overlap, so the block's first positions see a full window
+        g = gear[np.frombuffer(data, dtype=np.uint8, count=min(block_start + CHUNK_SCAN_BLOCK, len(data)) - first, offset=first)]
+        h = g.copy()
+        for k in range(1, CHUNK_AVG_BITS): h[k:] += g[:len(g) - k] << k
+        hits = np.flatnonzero((h & mask) == 0) + first
+        found.append(hits[hits >= block_start])
+    return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+def iter_chunks(data):
+    """Split bytes at content-defined boundaries (gear rolling hash), so an insertion only changes nearby chunks.
+    With NumPy the boundaries are found by _boundary_candidates; the chunks are the same either way."""
+    mask, limit, gear, start, length = (1 << CHUNK_AVG_BITS) - 1, (1 << 64) - 1, _GEAR, 0, len(data)
+    candidates = _boundary_candidates(data) if np is not None and length > CHUNK_MIN else None
+    while start < length:
+        end = min(start + CHUNK_MAX, length)
+        h, i = 0, start + CHUNK_MIN
+        # The hash restarts at each chunk, so it is only positional after CHUNK_AVG_BITS bytes; before that, and without NumPy, step through
+        scan_end = end if candidates is None else min(i + CHUNK_AVG_BITS - 1, end)
+        while i < scan_end:
+            h = ((h << 1) + gear[data[i]]) & limit
+            if not h & mask: end = i + 1; break
+            i += 1
+        else:
+            if candidates is not None and i < end:
+                k = np.searchsorted(candidates, i)
+                if k < len(candidates) and candidates[k] < end: end = int(candidates[k]) + 1
+        yield data[start:end]
+        start = end
+
+class BackupRepository:
+    def __init__(self, path=BACKUP_REPO_DIR):
+        self.path = path
+        self.chunks_dir = os.path.join(path, 'chunks')
+        self.snapshots_dir = os.path.join(path, 'snapshots')
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def _put_chunk(self, chunk):
+        """Store a chunk unless present; returns (digest, bytes written)."""
+        digest = hashlib.sha256(chunk).hexdigest()
+        chunk_path = self._chunk_path(digest)
+        if os.path.exists(chunk_path): return digest, 0
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        packed = zlib.compress(chunk, 6)
+        tmp_file = f"{chunk_path}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f: f.write(packed)
+        os.replace(tmp_file, chunk_path)
+        return digest, len(packed)
+
+    def _get_chunk(self, digest):
+        with open(self._chunk_path(digest), 'rb') as f: chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest: raise ValueError(f"Chunk {digest} is corrupt")
+        return chunk
+
+    def snapshots(self):
+        """Snapshot ids, oldest first."""
+        if not os.path.isdir(self.snapshots_dir): return []
+        return sorted(name[:-5] for name in os.listdir(self.snapshots_dir) if name.endswith('.json'))
+
+    def manifest(self, snapshot_id):
+        with open(os.path.join(self.snapshots_dir, snapshot_id + '.json'), 'r') as f: return json.load(f)
+
+    def backup(self, source_dir='.', files=None):
+        """Snapshot source_dir; returns (snapshot id, files read, new chunks, bytes added to the repository)."""
+        if files is None: files = default_backup_files(source_dir)
+        previous = self.snapshots()
+        known = {entry['path']: entry for entry in self.manifest(previous[-1])['files']} if previous else {}
+        entries, files_read, new_chunks, added_bytes = [], 0, 0, 0
+        for rel_path in files:
+            full_path = os.path.join(source_dir, rel_path)
+            try: st = os.stat(full_path)
+            except FileNotFoundError: continue
+            entry = {'path': rel_path, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            old = known.get(rel_path)
+            if old and (old['size'], old['mtime_ns']) == (entry['size'], entry['mtime_ns']):
+                entry['chunks'] = old['chunks'] # Unchanged since the last snapshot; not even read
+            else:
+                with open(full_path, 'rb') as f: data = f.read()
+                entry['chunks'], files_read = [], files_read + 1
+                for chunk in iter_chunks(data):
+                    digest, written = self._put_chunk(chunk)
+                    entry['chunks'].append(digest)
+                    if written: new_chunks += 1; added_bytes += written
+            entries.append(entry)
+        snapshot_id = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        write_json_atomic(os.path.join(self.snapshots_dir, snapshot_id + '.json'),
+                          {'created': datetime.now().isoformat(timespec='seconds'), 'source': os.path.abspath(source_dir), 'files': entries})
+        return snapshot_id, files_read, new_chunks, added_bytes
+
+    def restore(self, snapshot_id, target_dir):
+        """Rebuild every file of a snapshot under target_dir; returns the number of files written."""
+        manifest = self.manifest(snapshot_id)
+        for entry in manifest['files']:
+            full_path = os.path.join(target_dir, entry['path'])
+            os.makedirs(os.path.dirname(full_path) or '.', exist_ok=True)
+            tmp_file = f"{full_path}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                for digest in entry['chunks']: f.write(self._get_chunk(digest))
+            os.replace(tmp_file, full_path)
+            os.utime(full_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return len(manifest['files'])
+
+def default_backup_files(source_dir='.'):
+    """The data files, the saved document contents and every generated PDF in source_dir. Derived files (items.bin, pdf_cache/) are left out."""
+    if os.path.exists(os.path.join(source_dir, SQLITE_DB_FILE)):
+        conn = sqlite3.connect(os.path.join(source_dir, SQLITE_DB_FILE))
+        try: conn.execute("PRAGMA wal_checkpoint(TRUNCATE)") # Fold the WAL in so the .db file alone is complete
+        finally: conn.close()
+    pdfs = sorted(name for name in os.listdir(source_dir) if name.lower().endswith('.pdf'))
+    documents_dir = os.path.join(source_dir, DOCUMENTS_DIR)
+    documents = sorted(f"{DOCUMENTS_DIR}/{name}" for name in os.listdir(documents_dir) if name.endswith('.json')) if os.path.isdir(documents_dir) else []
+    return [name for name in BACKUP_DATA_FILES if os.path.exists(os.path.join(source_dir, name))] + documents + pdfs
+
+def run_backup(repo_path=BACKUP_REPO_DIR):
+    started = time.perf_counter()
+    snapshot_id, files_read, new_chunks, added_bytes = BackupRepository(repo_path).backup()
+    print(f"Snapshot {snapshot_id}: {files_read} changed file(s) read, {new_chunks} new chunk(s), "
+          f"{added_bytes / 1024:.1f} KB added in {time.perf_counter() - started:.2f}s")
+    return 0
+
+def run_list_backups(repo_path=BACKUP_REPO_DIR):
+    repo = BackupRepository(repo_path)
+    for snapshot_id in repo.snapshots():
+        files = repo.manifest(snapshot_id)['files']
+        print(f"{snapshot_id}  {len(files)} file(s), {sum(entry['size'] for entry in files) / 1024:.1f} KB")
+    return 0
+
+def run_restore(snapshot_id, target_dir, repo_path=BACKUP_REPO_DIR):
+    repo = BackupRepository(repo_path)
+    if snapshot_id == 'latest': snapshot_id = (repo.snapshots() or [None])[-1]
+    if snapshot_id not in repo.snapshots(): print(f"No snapshot '{snapshot_id}' in {repo_path}"); return 1
+    if os.path.abspath(target_dir) == os.path.abspath('.'):
+        print("Restore into a separate directory, check it, then copy the files back."); return 1
+    print(f"Restored {repo.restore(snapshot_id, target_dir)} file(s) from {snapshot_id} into {target_dir}")
+    return 0
+
+
+# --- Rendering Benchmarks ---
+BENCH_SIZES = (1, 10, 100, 1000, 10000)
+BENCH_BUSINESS_DETAILS = {
+    'name': 'Benchmark Pty Ltd', 'address': '1 Example Street, Sydney NSW 2000', 'phone': '0290000000',
+    'email': 'accounts@example.com', 'tax_identifier_value': '12 345 678 901', 'bank': 'Example Bank',
+    'bsb': '000-000', 'account': '12345678', 'logo': '', 'invoice_terms': 'Payment due within 14 days.\nThank you for your business.',
+    'currency_symbol': '$'
+}
+
+def synthesize_document(rows):
+    """Deterministic document with the given number of line items and long, wrapping descriptions."""
+    items = []
+    for i in range(rows):
+        qty, price = (i % 7) + 1, 10 + (i * 37 % 990) / 10
+        tax = price * qty * 0.1
+        description = f"Usage charge for service period {i % 12 + 1}, metered across regions " + "with extended detail " * (3 + i % 5)
+        items.append([f"ITEM{i % 9999 + 1:04d}", f"Line item {i + 1}", description, f"{qty:.2f}",
+                      f"${price:.2f}", f"${tax:.2f}", f"${price * qty + tax:.2f}"])
+    return {'client_name': 'Benchmark Client', 'client_email': 'client@example.com', 'client_address': '2 Sample Road',
+            'items': items, 'subtotal': '0.00', 'tax': '0.00', 'total': '0.00'}
+
+def _peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KiB elsewhere
+
+def _bench_case(rows, repeat, workdir):
+    # Runs in its own process so peak RSS belongs to this case alone.
+    data = synthesize_document(rows)
+    pdf_file = os.path.join(workdir, f"bench_{rows}.pdf")
+    app_settings = dict(DEFAULT_APP_SETTINGS)
+    started = time.perf_counter()
+    template = get_pdf_template('invoice', BENCH_BUSINESS_DETAILS, app_settings)
+    template_s = time.perf_counter() - started
+    story_times, build_times, total_times = [], [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        story = template.build_story(data)
+        built_story = time.perf_counter()
+        doc = SimpleDocTemplate(pdf_file, pagesize=A4, topMargin=1.5*cm, bottomMargin=1.5*cm, leftMargin=1.5*cm, rightMargin=1.5*cm)
+        doc.build(story)
+        finished = time.perf_counter()
+        story_times.append(built_story - started); build_times.append(finished - built_story); total_times.append(finished - started)
+    return {
+        'rows': rows, 'repeat': repeat, 'streamed': rows >= LARGE_DOCUMENT_ROWS,
+        'template_s': template_s, 'story_s': statistics.median(story_times), 'build_s': statistics.median(build_times),
+        'wall_s': statistics.median(total_times), 'peak_rss_mb': _peak_rss_mb(), 'output_bytes': os.path.getsize(pdf_file)
+    }
+
+def compare_bench_results(results, baseline, threshold):
+    """Return a list of human-readable regressions of results against baseline."""
+    regressions = []
+    for rows, case in results['cases'].items():
+        base = baseline.get('cases', {}).get(rows)
+        if not base: continue
+        for metric in ('wall_s', 'peak_rss_mb', 'output_bytes'):
+            new_value, old_value = case.get(metric), base.get(metric)
+            if new_value is None or not old_value: continue
+            change = (new_value - old_value) / old_value
+            if change > threshold:
+                regressions.append(f"{rows} rows: {metric} {old_value:.4g} -> {new_value:.4g} (+{change:.0%})")
+    return regressions
+
+def run_benchmarks(sizes=BENCH_SIZES, repeat=3, output=None, baseline=None, save_baseline=None, threshold=0.15):
+    """Time generate_pdf's story-building and doc.build phases over synthetic documents of increasing size."""
+    results = {
+        'meta': {'date': datetime.now().strftime('%Y-%m-%d %H:%M'), 'python': platform.python_version(),
+                 'reportlab': REPORTLAB_VERSION, 'platform': platform.platform(), 'repeat': repeat},
+        'cases': {}
+    }
+    print(f"{'rows':>7} {'template':>9} {'story':>9} {'build':>9} {'wall':>9} {'peak RSS':>10} {'size':>11}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for rows in sizes:
+            with ProcessPoolExecutor(max_workers=1) as pool: case = pool.submit(_bench_case, rows, repeat, workdir).result()
+            results['cases'][str(rows)] = case
+            rss = f"{case['peak_rss_mb']:.1f} MB" if case['peak_rss_mb'] is not None else "n/a"
+            print(f"{rows:>7} {case['template_s']:>8.3f}s {case['story_s']:>8.3f}s {case['build_s']:>8.3f}s "
+                  f"{case['wall_s']:>8.3f}s {rss:>10} {case['output_bytes']:>9,} B" + ("  (streamed: rows built during build)" if case['streamed'] else ""))
+
+    if output:
+        with open(output, 'w') as f: json.dump(results, f, indent=4)
+    if save_baseline:
+        with open(save_baseline, 'w') as f: json.dump(results, f, indent=4)
+        print(f"Baseline saved to {save_baseline}")
+    if baseline:
+        with open(baseline, 'r') as f: regressions = compare_bench_results(results, json.load(f), threshold)
+        if regressions:
+            print(f"Regressions against {baseline} (threshold {threshold:.0%}):")
+            for line in regressions: print(f"  {line}")
+            return 1
+        print(f"No regressions against {baseline} (threshold {threshold:.0%}).")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='megabooks.py', description="Megabooks invoice & quote generator. Runs the GUI when no command is given.")
+    subparsers = parser.add_subparsers(dest='command')
+    batch_parser = subparsers.add_parser('batch', help="Render documents from a JSON/CSV manifest without opening a window")
+    batch_parser.add_argument('manifest', help="Path to a .json or .csv manifest")
+    batch_parser.add_argument('-j', '--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    batch_parser.add_argument('-o', '--output-dir', default='.', help="Directory for generated PDFs (default: current directory)")
+    statement_parser = subparsers.add_parser('statement', help="Combine documents from history into one bookmarked PDF")
+    statement_parser.add_argument('--client', help="Only this client's documents")
+    statement_parser.add_argument('--from', dest='date_from', help="First day to include (YYYY-MM-DD)")
+    statement_parser.add_argument('--to', dest='date_to', help="Last day to include (YYYY-MM-DD)")
+    statement_parser.add_argument('-o', '--output', default=None, help="Output PDF (default: Statement_<timestamp>.pdf)")
+    bench_parser = subparsers.add_parser('bench', help="Benchmark PDF rendering on synthetic documents")
+    bench_parser.add_argument('--sizes', default=','.join(str(s) for s in BENCH_SIZES), help="Comma-separated line item counts")
+    bench_parser.add_argument('--repeat', type=int, default=3, help="Renders per size; the median time is reported")
+    bench_parser.add_argument('-o', '--output', default=None, help="Write results as JSON")
+    bench_parser.add_argument('--save-baseline', default=None, help="Store results as a baseline JSON file")
+    bench_parser.add_argument('--baseline', default=None, help="Compare against a stored baseline; exits 1 on regression")
+    bench_parser.add_argument('--threshold', type=float, default=0.15, help="Allowed slowdown/growth before flagging (default 0.15)")
+    migrate_parser = subparsers.add_parser('migrate-sqlite', help="Import the JSON stores into a SQLite database and switch to it")
+    migrate_parser.add_argument('--force', action='store_true', help="Overwrite a database that already holds records")
+    backup_parser = subparsers.add_parser('backup', help="Take an incremental, deduplicated snapshot of the data files and PDFs")
+    backup_parser.add_argument('--repo', default=BACKUP_REPO_DIR, help=f"Backup repository (default: {BACKUP_REPO_DIR})")
+    backups_parser = subparsers.add_parser('backups', help="List the snapshots in a backup repository")
+    backups_parser.add_argument('--repo', default=BACKUP_REPO_DIR, help=f"Backup repository (default: {BACKUP_REPO_DIR})")
+    restore_parser = subparsers.add_parser('restore', help="Rebuild a snapshot into a directory")
+    restore_parser.add_argument('snapshot', help="Snapshot id from 'backups', or 'latest'")
+    restore_parser.add_argument('target', help="Directory to restore into (not the live data directory)")
+    restore_parser.add_argument('--repo', default=BACKUP_REPO_DIR, help=f"Backup repository (default: {BACKUP_REPO_DIR})")
+    args = parser.parse_args(argv)
+
+    if args.command == 'bench':
+        sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+        return run_benchmarks(sizes, args.repeat, args.output, args.baseline, args.save_baseline, args.threshold)
+    if args.command == 'batch':
+        return run_batch(args.manifest, workers=args.workers, output_dir=args.output_dir)
+    if args.command == 'statement':
+        return run_statement(args.client, args.date_from, args.date_to, args.output)
+    if args.command == 'backup':
+        return run_backup(args.repo)
+    if args.command == 'backups':
+        return run_list_backups(args.repo)
+    if args.command == 'restore':
+        return run_restore(args.snapshot, args.target, args.repo)
+    if args.command == 'migrate-sqlite':
+        return migrate_json_to_sqlite(force=args.force)
     app = InvoiceSystem()
-    app.run()
\ No newline at end of file
+    app.run()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file